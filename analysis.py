@@ -0,0 +1,191 @@
+"""Data flow and control flow analyses over the IR of a function (see `ir`).
+Each one takes an `ir._Function` and returns its result without changing
+the function; `passes._Analyses` keeps them until a transform makes them
+stale.
+"""
+
+import ir
+
+
+def _liveness(fn):
+    """Return (live_in, live_out), dicts from each block to the set of
+    temporaries whose values may still be read after its start and its end
+    """
+    uses = {}
+    defs = {}
+    for block in fn.blocks:
+        use, def_ = set(), set()
+        for ins in block.instrs:
+            use.update(t for t in ir._uses(ins) if t not in def_)
+            if ins.dst is not None:
+                def_.add(ins.dst)
+        uses[block], defs[block] = use, def_
+    live_in = {block: set() for block in fn.blocks}
+    live_out = {block: set() for block in fn.blocks}
+    changed = True
+    while changed:
+        changed = False
+        for block in reversed(fn.blocks):
+            out = set()
+            for succ in block.succs:
+                out |= live_in[succ]
+            in_ = uses[block] | (out - defs[block])
+            if in_ != live_in[block] or out != live_out[block]:
+                live_in[block], live_out[block] = in_, out
+                changed = True
+    return live_in, live_out
+
+
+def _live_across(block, live_out):
+    """Yield (ins, live) for the instructions of `block` from last to first,
+    with `live` the set of temporaries live just after `ins`
+    """
+    live = set(live_out[block])
+    for ins in reversed(block.instrs):
+        yield ins, live
+        live = set(live)
+        if ins.dst is not None:
+            live.discard(ins.dst)
+        live.update(ir._uses(ins))
+
+
+def _reaching(fn):
+    """Return a dict from each block to the set of definitions (the
+    instructions writing a temporary) that may reach its start. Every
+    temporary read in `fn` also has an 'undef' definition reaching from the
+    entry, for the paths on which nothing is assigned to it
+    """
+    undefined = {}
+    for block in fn.blocks:
+        for ins in block.instrs:
+            for t in ir._uses(ins):
+                if t not in undefined:
+                    undefined[t] = ir._Ins('undef', t, ())
+    gen = {}
+    killed = {}
+    for block in fn.blocks:
+        last = {}
+        for ins in block.instrs:
+            if ins.dst is not None:
+                last[ins.dst] = ins
+        gen[block] = set(last.values())
+        killed[block] = set(last)
+    reach_in = {block: set() for block in fn.blocks}
+    reach_out = {block: set(gen[block]) for block in fn.blocks}
+    entry = fn.blocks[0]
+    changed = True
+    while changed:
+        changed = False
+        for block in fn.blocks:
+            in_ = set(undefined.values()) if block is entry else set()
+            for pred in block.preds:
+                in_ |= reach_out[pred]
+            out = gen[block] | {d for d in in_ if d.dst not in killed[block]}
+            if in_ != reach_in[block] or out != reach_out[block]:
+                reach_in[block], reach_out[block] = in_, out
+                changed = True
+    return reach_in
+
+
+def _defs_by_temp(defs):
+    """Group a set of definitions by the temporary they write
+    """
+    by_temp = {}
+    for d in defs:
+        by_temp.setdefault(d.dst, set()).add(d)
+    return by_temp
+
+
+def _order(fn):
+    """Return the blocks of `fn` in reverse postorder
+    """
+    seen = set()
+    post = []
+    stack = [(fn.blocks[0], iter(fn.blocks[0].succs))]
+    seen.add(fn.blocks[0])
+    while stack:
+        block, succs = stack[-1]
+        for succ in succs:
+            if succ not in seen:
+                seen.add(succ)
+                stack.append((succ, iter(succ.succs)))
+                break
+        else:
+            stack.pop()
+            post.append(block)
+    post.reverse()
+    return post
+
+
+def _dominators(fn):
+    """Return a dict from each block to its immediate dominator, the entry
+    block mapping to itself (Cooper, Harvey and Kennedy's algorithm)
+    """
+    order = _order(fn)
+    index = {block: k for k, block in enumerate(order)}
+    entry = order[0]
+    idom = {entry: entry}
+    changed = True
+    while changed:
+        changed = False
+        for block in order[1:]:
+            new = None
+            for pred in block.preds:
+                if pred not in idom:
+                    continue
+                if new is None:
+                    new = pred
+                    continue
+                a, b = pred, new
+                while a is not b:
+                    while index[a] > index[b]:
+                        a = idom[a]
+                    while index[b] > index[a]:
+                        b = idom[b]
+                new = a
+            if idom.get(block) is not new:
+                idom[block] = new
+                changed = True
+    return idom
+
+
+def _dominates(idom, a, b):
+    """Return whether block `a` dominates block `b`
+    """
+    while b is not a:
+        parent = idom[b]
+        if parent is b:
+            return False
+        b = parent
+    return True
+
+
+def _loops(fn):
+    """Return the natural loops of `fn` as (header, set of blocks) pairs,
+    innermost first. Loops sharing a header are merged
+    """
+    idom = _dominators(fn)
+    bodies = {}
+    for block in fn.blocks:
+        for succ in block.succs:
+            if _dominates(idom, succ, block):
+                # A back edge: the loop is everything that reaches `block`
+                # without going through the header
+                body = bodies.setdefault(succ, {succ})
+                stack = [block]
+                while stack:
+                    b = stack.pop()
+                    if b not in body:
+                        body.add(b)
+                        stack.extend(b.preds)
+    return sorted(bodies.items(), key=lambda loop: len(loop[1]))
+
+
+def _loop_depths(fn):
+    """Return a dict from each block to the number of loops it is in
+    """
+    depths = {block: 0 for block in fn.blocks}
+    for _, body in _loops(fn):
+        for block in body:
+            depths[block] += 1
+    return depths
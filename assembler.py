@@ -0,0 +1,91 @@
+"""Reading back the assembly text the compiler emits. `_parse` turns it into
+the `codegen._Instr` list it was formatted from, and `_layout` places that
+in memory the way the assembler does: from address 0, one word for each
+instruction and `.dc` and as many as a `.dw` reserves, with labels naming
+the address of whatever follows them.
+"""
+
+import codegen
+import error
+
+_WORD_BYTES = codegen.WORD // codegen.BYTE
+_OPCODES = {name: op for op, name in enumerate(codegen._names)}
+# Opcodes whose second operand is a displacement, written c(rb)
+_DISPLACED = {codegen.LA, codegen.LD, codegen.ST}
+
+
+def _parse(text):
+    """Return the list of `codegen._Instr` that `text` is the assembly of.
+    Raises `error.AssemblyError` on a line the compiler couldn't have
+    emitted
+    """
+    instrs = []
+    for n, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        if line == 'END':
+            instrs.append(codegen._Instr(codegen.END, ()))
+            break
+        label, sep, rest = line.partition(':')
+        if sep and label.isidentifier():
+            instrs.append(codegen._Instr(codegen.LABEL, (label,)))
+            rest = rest.strip()
+            if not rest:
+                continue
+            if rest.startswith('.dw') or rest.startswith('.dc'):
+                # The label is part of the directive
+                instrs.pop()
+                instrs.append(codegen._Instr(_OPCODES[rest[:3]], (
+                    label, _operand(rest[3:].strip(), n))))
+                continue
+            line = rest
+        name, _, operands = line.partition(' ')
+        op = _OPCODES.get(name)
+        if op is None or op == codegen.LABEL or op in codegen._DATA or \
+                op == codegen.END:
+            error._asm_error("Unknown instruction {} on line {}".format(
+                name, n))
+        args = [a.strip() for a in operands.split(',')] if operands else []
+        if op in _DISPLACED and len(args) == 2:
+            offset, _, base = args[1].partition('(')
+            if not base.endswith(')'):
+                error._asm_error("Bad address {} on line {}".format(
+                    args[1], n))
+            args = [args[0], offset, base[:-1]]
+        instrs.append(codegen._Instr(op, tuple(_operand(a, n)
+                                               for a in args)))
+    return instrs
+
+
+def _operand(text, n):
+    if not text:
+        error._asm_error("Missing operand on line {}".format(n))
+    try:
+        return int(text, 0)
+    except ValueError:
+        return text
+
+
+def _layout(instrs):
+    """Return (labels, words): the address of each label, and for each word
+    of the memory image the index in `instrs` of the instruction there, or
+    of the `.dw` or `.dc` it belongs to
+    """
+    labels = {}
+    words = []
+    for k, ins in enumerate(instrs):
+        op = ins.op
+        if op == codegen.END:
+            break
+        if op == codegen.LABEL:
+            labels[ins.args[0]] = len(words) * _WORD_BYTES
+        elif op == codegen.DW:
+            labels[ins.args[0]] = len(words) * _WORD_BYTES
+            words.extend([k] * ins.args[1])
+        elif op == codegen.DC:
+            labels[ins.args[0]] = len(words) * _WORD_BYTES
+            words.append(k)
+        else:
+            words.append(k)
+    return labels, words
@@ -0,0 +1,137 @@
+"""Compile many sources at once across a pool of worker processes, skipping
+those whose output is already in the cache.
+"""
+
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cache
+import compiler
+import error
+
+SOURCE_SUFFIX = ".rc"
+OUTPUT_SUFFIX = ".s"
+
+# The compiler of this worker process, reused for every job it runs
+_worker_compiler = None
+
+
+def _expand(sources):
+    """Turn the source arguments (files, directories or glob patterns) into a
+    sorted list of source files without duplicates
+    """
+    paths = []
+    for s in sources:
+        if os.path.isdir(s):
+            pattern = os.path.join(s, "**", "*" + SOURCE_SUFFIX)
+            paths.extend(glob.glob(pattern, recursive=True))
+        elif glob.has_magic(s):
+            paths.extend(glob.glob(s, recursive=True))
+        else:
+            paths.append(s)
+    return sorted(set(paths))
+
+
+def _output_path(path, out_dir):
+    root = path[:-len(SOURCE_SUFFIX)] if path.endswith(SOURCE_SUFFIX) \
+        else path
+    if out_dir is not None:
+        root = os.path.join(out_dir, os.path.basename(root))
+    return root + OUTPUT_SUFFIX
+
+
+def _init_worker(options):
+    global _worker_compiler
+    _worker_compiler = compiler.Compiler(**options)
+
+
+def _compile_one(source):
+    """Compile `source` in a worker. Return (assembly, error message,
+    seconds taken)
+    """
+    start = time.perf_counter()
+    try:
+        asm, msg = _worker_compiler.compile(source), None
+    except error.CompileError as e:
+        asm, msg = None, str(e)
+    return asm, msg, time.perf_counter() - start
+
+
+def _compile_many(sources, out_dir=None, jobs=None, options=None,
+                  cache_dir=None, cache_size=None, use_cache=True):
+    """Compile every source named by `sources`, writing `<name>.s` next to
+    each (or into `out_dir`), and print a per-file and total report. Return
+    the number of files that failed
+    """
+    options = options or {}
+    start = time.perf_counter()
+    paths = _expand(sources)
+    outputs = {}
+    for path in paths:
+        out = _output_path(path, out_dir)
+        if out in outputs:
+            error._error("{} and {} would both be written to {}".format(
+                outputs[out], path, out))
+        outputs[out] = path
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+    c = cache._Cache(cache_dir, cache_size) if use_cache else None
+    # Hash and look up every source up front so that only misses are sent to
+    # the workers
+    results = {}
+    pending = {}
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                source = f.read()
+        except IOError as e:
+            results[path] = (None, str(e), 0.0, False)
+            continue
+        key = None
+        if c is not None:
+            key = cache._key(c, source, options)
+            t = time.perf_counter()
+            asm = cache._get(c, key)
+            if asm is not None:
+                results[path] = (asm, None, time.perf_counter() - t, True)
+                continue
+        pending[path] = (source, key)
+    if pending:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                 initargs=(options,)) as pool:
+            futures = {path: pool.submit(_compile_one, source)
+                       for path, (source, _) in pending.items()}
+            for path, fut in futures.items():
+                asm, msg, seconds = fut.result()
+                results[path] = (asm, msg, seconds, False)
+                key = pending[path][1]
+                if asm is not None and key is not None:
+                    cache._put(c, key, asm)
+    failed = 0
+    compile_time = 0.0
+    for path in paths:
+        asm, msg, seconds, hit = results[path]
+        compile_time += seconds
+        if asm is None:
+            failed += 1
+            print("{}: error: {}".format(path, msg))
+            continue
+        with open(_output_path(path, out_dir), "w") as f:
+            f.write(asm)
+        print("{}: {:.1f} ms{}".format(path, seconds * 1000,
+                                       " (cached)" if hit else ""))
+    if c is not None:
+        cache._evict(c)
+    total = len(paths)
+    summary = "{} files, {} failed, {:.1f} ms compiling, {:.1f} ms total" \
+        .format(total, failed, compile_time * 1000,
+                (time.perf_counter() - start) * 1000)
+    if c is not None:
+        lookups = c.hits + c.misses
+        rate = 100.0 * c.hits / lookups if lookups else 0.0
+        summary += ", cache hits {}/{} ({:.0f}%)".format(c.hits, lookups,
+                                                        rate)
+    print(summary)
+    return failed
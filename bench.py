@@ -0,0 +1,242 @@
+"""Benchmarks of how fast the compiler is and how good the code it emits is.
+Every program in bench/ and a few generated ones of increasing size are
+compiled at each -O level, recording the best compile time out of a few,
+the peak memory allocated while compiling and the number of instructions
+emitted. The programs in bench/ are then run in the simulator for the
+instructions executed, loads, stores and modelled cycles, and the final
+values of their globals, which have to agree across the levels.
+
+The results are written as JSON and compared with a stored baseline, with
+every change either way reported.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import compiler
+import error
+import simulator
+
+_BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "bench")
+_BASELINE = os.path.join(_BENCH_DIR, "baseline.json")
+_LEVELS = (0, 1, 2)
+# Number of functions in each generated program
+_SYNTHETIC_SIZES = (50, 200)
+_REPEAT = 3
+# Metrics that come out the same on every run, and the relative change
+# below which the others are taken to be noise
+_EXACT = ('instructions', 'executed', 'loads', 'stores', 'cycles')
+_NOISY = ('compile_seconds', 'peak_bytes')
+_NOISE = 0.10
+
+
+def _synthetic(functions, seed=0):
+    """Return the source of a program of `functions` functions for testing
+    how compile time scales. Each function has a few locals, loops and ifs,
+    and calls some of the ones before it
+    """
+    rnd = random.Random(seed)
+    lines = ["var g{}".format(i) for i in range(8)]
+    # Number of parameters of each function
+    arity = []
+    for f in range(functions):
+        params = ["p{}".format(i) for i in range(rnd.randrange(4))]
+        arity.append(len(params))
+        names = params + ["v{}".format(i) for i in range(4)]
+        lines.append("function f{}({}){{".format(f, ", ".join(params)))
+        lines.extend("    var v{} = {}".format(i, rnd.randrange(100))
+                     for i in range(4))
+        for _ in range(rnd.randrange(3, 8)):
+            target = rnd.choice(names)
+            value = _synthetic_expression(rnd, names, arity[:f])
+            if rnd.random() < 0.3:
+                lines.append("    while({} < {}){{".format(
+                    target, rnd.randrange(1, 50)))
+                lines.append("        {} = {} + 1".format(target, target))
+                lines.append("        g{} = g{} + {}".format(
+                    rnd.randrange(8), rnd.randrange(8), value))
+                lines.append("    }")
+            elif rnd.random() < 0.5:
+                lines.append("    if({} > {}){{".format(
+                    _synthetic_expression(rnd, names, arity[:f]), target))
+                lines.append("        {} = {}".format(target, value))
+                lines.append("    }")
+            else:
+                lines.append("    {} = {}".format(target, value))
+        lines.append("    return({})".format(
+            _synthetic_expression(rnd, names, arity[:f])))
+        lines.append("}")
+    lines.append("function main(){")
+    lines.extend("    g{} = f{}({})".format(i % 8, f, ", ".join(
+        str(i + k) for k in range(arity[f])))
+                 for i, f in enumerate(range(0, functions, 7)))
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def _synthetic_expression(rnd, names, arity):
+    """Return an expression over `names` that may call one of the functions
+    whose numbers of parameters are `arity`
+    """
+    operands = [rnd.choice(names), str(rnd.randrange(1000))]
+    if arity and rnd.random() < 0.2:
+        callee = rnd.randrange(len(arity))
+        operands.append("f{}({})".format(callee, ", ".join(
+            rnd.choice(names) for _ in range(arity[callee]))))
+    rnd.shuffle(operands)
+    return " {} ".format(rnd.choice("+-*&|")).join(operands)
+
+
+def _programs():
+    """Return (name, source, run) for every benchmark, `run` being whether
+    it is run as well as compiled
+    """
+    programs = []
+    for name in sorted(os.listdir(_BENCH_DIR)):
+        if name.endswith(".rc"):
+            with open(os.path.join(_BENCH_DIR, name), "rb") as f:
+                programs.append((name[:-3], f.read(), True))
+    for n in _SYNTHETIC_SIZES:
+        programs.append(("synthetic-{}".format(n),
+                         _synthetic(n).encode(), False))
+    return programs
+
+
+def _measure(source, level, repeat, run):
+    """Return the metrics of compiling `source` at -O`level`, and of running
+    it if `run`
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        asm = compiler.Compiler(opt_level=level).compile(source)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    compiler.Compiler(opt_level=level).compile(source)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    program = simulator.assemble(asm)
+    metrics = {'compile_seconds': round(best, 6), 'peak_bytes': peak,
+               'instructions': len(program.code)}
+    if run:
+        result = simulator.run(program)
+        stats = result.stats()
+        metrics.update({'executed': stats['instructions'],
+                        'loads': stats['loads'], 'stores': stats['stores'],
+                        'cycles': stats['cycles'],
+                        'globals': {label: result.value(label)
+                                    for label in sorted(program.labels)
+                                    if label.startswith("GL")}})
+    return metrics
+
+
+def _run_all(levels, repeat):
+    """Return the results of every benchmark at every level in `levels`,
+    and a list of the benchmarks whose globals differ between levels
+    """
+    results = {}
+    mismatches = []
+    for name, source, run in _programs():
+        results[name] = {}
+        for level in levels:
+            results[name]["-O{}".format(level)] = _measure(source, level,
+                                                           repeat, run)
+        values = [m['globals'] for m in results[name].values()
+                  if 'globals' in m]
+        if any(v != values[0] for v in values):
+            mismatches.append(name)
+    return results, mismatches
+
+
+def _compare(results, baseline):
+    """Return lines describing every change from `baseline` to `results`,
+    and the numbers of improvements and regressions among them
+    """
+    lines = []
+    better = worse = 0
+    for name, levels in sorted(results.items()):
+        for level, metrics in sorted(levels.items()):
+            old = baseline.get(name, {}).get(level)
+            if old is None:
+                lines.append("{} {}: new".format(name, level))
+                continue
+            if 'globals' in metrics and metrics['globals'] != \
+                    old.get('globals'):
+                lines.append("{} {}: globals changed: {} -> {}".format(
+                    name, level, old.get('globals'), metrics['globals']))
+            for key in _EXACT + _NOISY:
+                if key not in metrics or key not in old:
+                    continue
+                a, b = old[key], metrics[key]
+                change = (b - a) / a if a else 0.0
+                if a == b or (key in _NOISY and abs(change) < _NOISE):
+                    continue
+                if b < a:
+                    better += 1
+                else:
+                    worse += 1
+                lines.append("{} {}: {} {} -> {} ({:+.1f}%)".format(
+                    name, level, key, a, b, 100 * change))
+    return lines, better, worse
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description="Benchmark compile speed and the code compiled")
+    p.add_argument("-O", dest="levels", type=str,
+                   default=",".join(str(level) for level in _LEVELS),
+                   help="comma separated -O levels to benchmark (default: "
+                   + "0,1,2)")
+    p.add_argument("--repeat", type=int, default=_REPEAT,
+                   help="times each program is compiled, keeping the "
+                   + "fastest (default: 3)")
+    p.add_argument("-o", dest="output", type=str, default=None,
+                   help="write the results as JSON to this file")
+    p.add_argument("--baseline", type=str, default=_BASELINE,
+                   help="results to compare with (default: "
+                   + "bench/baseline.json)")
+    p.add_argument("--save-baseline", action="store_true",
+                   help="store the results as the new baseline")
+    args = p.parse_args()
+    levels = [int(level) for level in args.levels.split(",")]
+    try:
+        results, mismatches = _run_all(levels, args.repeat)
+    except (error.CompileError, error.SimulationError) as e:
+        print(e)
+        sys.exit(1)
+    text = json.dumps(results, indent=2, sort_keys=True) + "\n"
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(text)
+    for name, levels_ in sorted(results.items()):
+        for level, m in sorted(levels_.items()):
+            print("{:<16} {:<4} {:>9.4f}s {:>9}B {:>6} instrs{}".format(
+                name, level, m['compile_seconds'], m['peak_bytes'],
+                m['instructions'], "" if 'executed' not in m else
+                " {:>9} executed {:>9} cycles".format(m['executed'],
+                                                       m['cycles'])))
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        lines, better, worse = _compare(results, baseline)
+        print("Against {}: {} better, {} worse".format(args.baseline, better,
+                                                      worse))
+        for line in lines:
+            print("  " + line)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            f.write(text)
+    if mismatches:
+        print("Globals differ between levels: " + ", ".join(mismatches))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""On-disk cache of compiled assembly, addressed by the hash of everything
+that can change the output: the source bytes, the compiler's own code and
+the compile options.
+"""
+
+import hashlib
+import os
+
+# Directory of the compiler's modules, all of whose code is taken to
+# determine the assembly produced for a source
+_COMPILER_DIR = os.path.dirname(os.path.abspath(__file__))
+_DEFAULT_MAX_BYTES = 64 << 20
+_SUFFIX = ".s"
+
+
+def _default_dir():
+    base = os.environ.get("XDG_CACHE_HOME",
+                          os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "rsrcc")
+
+
+def _compiler_version():
+    """Hash of the source of every module in `_COMPILER_DIR`, so that any
+    change to the compiler invalidates everything it cached before
+    """
+    h = hashlib.sha256()
+    for name in sorted(os.listdir(_COMPILER_DIR)):
+        if name.endswith(".py"):
+            h.update(name.encode())
+            with open(os.path.join(_COMPILER_DIR, name), "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+class _Cache:
+    """A directory of `<key>.s` files holding at most `max_bytes` of
+    assembly. A hit refreshes the file's mtime so eviction drops the least
+    recently used entries first.
+    """
+    __slots__ = ('path', 'max_bytes', 'version', 'hits', 'misses')
+
+    def __init__(self, path=None, max_bytes=None):
+        self.path = path if path is not None else _default_dir()
+        self.max_bytes = max_bytes if max_bytes is not None \
+            else _DEFAULT_MAX_BYTES
+        self.version = _compiler_version()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.path, exist_ok=True)
+
+
+def _key(cache, source, options):
+    h = hashlib.sha256()
+    h.update(cache.version.encode("ascii"))
+    h.update(repr(sorted(options.items())).encode("utf-8"))
+    h.update(b"\0")
+    h.update(source)
+    return h.hexdigest()
+
+
+def _entry_path(cache, key):
+    return os.path.join(cache.path, key + _SUFFIX)
+
+
+def _get(cache, key):
+    """Return the cached assembly for `key`, or None on a miss
+    """
+    path = _entry_path(cache, key)
+    try:
+        with open(path, "r") as f:
+            asm = f.read()
+        os.utime(path)
+    except OSError:
+        cache.misses += 1
+        return None
+    cache.hits += 1
+    return asm
+
+
+def _put(cache, key, asm):
+    path = _entry_path(cache, key)
+    # Write to a private name first so a concurrent reader never sees a
+    # partial entry
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(asm)
+    os.replace(tmp, path)
+
+
+def _evict(cache):
+    """Delete least recently used entries until the cache fits in
+    `max_bytes`. Return the number of entries removed
+    """
+    entries = []
+    total = 0
+    with os.scandir(cache.path) as it:
+        for e in it:
+            if not e.name.endswith(_SUFFIX):
+                continue
+            st = e.stat()
+            entries.append((st.st_mtime, st.st_size, e.path))
+            total += st.st_size
+    removed = 0
+    entries.sort()
+    for _, size, path in entries:
+        if total <= cache.max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
@@ -0,0 +1,75 @@
+"""Whole program call graph. Once every function has been compiled, the
+functions that can't be reached from the code outside of them (the global
+variable initializers and the jump to main) are dropped. A function is only
+ever referred to by a `lar` of its label, for a call or a tail call. In a
+module, which has no main, every function can be called by the programs it
+is linked into (see `linker`), so none are dropped.
+"""
+
+import codegen
+import parser
+
+
+def _graph(ctx):
+    """Return a dict from the label of every function to the set of labels
+    of the functions it refers to, and the set of those referred to from
+    outside of any function
+    """
+    labels = {label for _, label, _, _ in ctx.functions}
+    out = ctx.out
+    graph = {}
+    roots = set()
+    covered = 0
+    for _, label, start, end in ctx.functions:
+        roots.update(_refs(out[covered:start], labels))
+        graph[label] = _refs(out[start:end], labels)
+        covered = end
+    roots.update(_refs(out[covered:], labels))
+    if parser.MAIN_LABEL not in labels:
+        roots = labels
+    return graph, roots
+
+
+def _refs(instrs, labels):
+    return {i.args[1] for i in instrs
+            if i.op == codegen.LAR and i.args[1] in labels}
+
+
+def _reachable(graph, roots):
+    seen = set()
+    stack = list(roots)
+    while stack:
+        label = stack.pop()
+        if label not in seen:
+            seen.add(label)
+            stack.extend(graph[label])
+    return seen
+
+
+def _prune(ctx):
+    """Remove the functions that can't be reached and report how much code
+    dead code elimination saved in all
+    """
+    graph, roots = _graph(ctx)
+    reachable = _reachable(graph, roots)
+    removed = []
+    size = 0
+    out = []
+    covered = 0
+    for identifier, label, start, end in ctx.functions:
+        out.extend(ctx.out[covered:start])
+        if label in reachable:
+            out.extend(ctx.out[start:end])
+        else:
+            removed.append(identifier)
+            # Less its label
+            size += end - start - 1
+        covered = end
+    out.extend(ctx.out[covered:])
+    ctx.out = out
+    ctx.functions = [f for f in ctx.functions if f[1] in reachable]
+    ctx.report.append(
+        "dce: removed {} unreachable instructions and {} functions ({} "
+        "instructions){}".format(ctx.unreachable, len(removed), size,
+                                 ": " + ", ".join(removed) if removed
+                                 else ""))
@@ -1,5 +1,10 @@
 """Functions to generate assembly code. Retargeting to a
 new architecture simply requires a change of the assembly output.
+
+Instructions are not printed as they are generated. Each one is recorded in
+the `out` list of the compilation context `ctx` (see `compiler.Compiler`) as
+an opcode id plus a tuple of operands, and the whole program is formatted in
+one go by `_format` once compilation is done.
 """
 
 PRIMARY = "r1"
@@ -9,287 +14,597 @@ BRANCH_TARGET = "r3"
 ZERO = "r0"
 RETURN = "r18"
 RETURN_VAL = "r19"
+# Scratch registers for intermediate values of expressions, used as a stack
+TEMPS = tuple("r{}".format(n) for n in range(4, 18))
+# Registers a function must give back unchanged to its caller
+CALLEE_SAVE = tuple("r{}".format(n) for n in range(20, 30))
 STACK = "r31"
 BASE = "r30"
 WORD = 32
 BYTE = 8
 
+# Opcode ids, indexes into `_names` and `_formats`
+(LABEL, DW, DC, LAR, LA, LD, ST, ADD, ADDI, SUB, NEG, MUL, DIV, AND, OR, NOT,
+ SHR, SHRA, SHL, BR, BRL, BRZR, BRNZ, BRPL, BRMI, STOP, END) = range(27)
+_names = ('label', '.dw', '.dc', 'lar', 'la', 'ld', 'st', 'add', 'addi', 'sub',
+          'neg', 'mul', 'div', 'and', 'or', 'not', 'shr', 'shra', 'shl', 'br',
+          'brl', 'brzr', 'brnz', 'brpl', 'brmi', 'stop', 'END')
+_formats = (
+    "{}:\t", "{}:\t.dw\t{}", "{}:\t.dc\t{}", "lar {}, {}", "la {}, {}({})",
+    "ld {}, {}({})", "st {}, {}({})", "add {}, {}, {}", "addi {}, {}, {}",
+    "sub {}, {}, {}", "neg {}, {}", "mul {}, {}, {}", "div {}, {}, {}",
+    "and {}, {}, {}", "or {}, {}, {}", "not {}, {}", "shr {}, {}, {}",
+    "shra {}, {}, {}", "shl {}, {}, {}", "br {}", "brl {}, {}",
+    "brzr {}, {}", "brnz {}, {}", "brpl {}, {}", "brmi {}, {}", "stop",
+    "END",
+)
+
+
+class _Instr:
+    """One emitted instruction, label or directive. `line` is the source line
+    it was emitted for, or None if it was made up by an optimizer or isn't
+    for any line
+    """
+    __slots__ = ('op', 'args', 'line')
+
+    def __init__(self, op, args, line=None):
+        self.op = op
+        self.args = args
+        self.line = line
+
+    def __str__(self):
+        return _formats[self.op].format(*self.args)
+
+
+def _emit(ctx, op, *args):
+    ctx.out.append(_Instr(op, args, ctx.line))
+
+
+def _format(instrs):
+    """Return the assembly text for the list of instructions `instrs`
+    """
+    formats = _formats
+    return "\n".join([formats[i.op].format(*i.args) for i in instrs]) + "\n"
+
+
+#################################################
+# Instruction Analysis                          #
+#################################################
+
+# Three register ALU ops: ra <- rb op rc
+_ALU3 = {ADD, SUB, MUL, DIV, AND, OR}
+# ra <- op(rb or rc) with one register source
+_ALU2 = {ADDI, NEG, NOT}
+_SHIFTS = {SHR, SHRA, SHL}
+# Branches within a function: br rb and the conditional brxx rb, rc
+_BRANCHES = {BR, BRZR, BRNZ, BRPL, BRMI}
+# Directives for words of data: .dw reserves a number of words holding 0,
+# and .dc one word holding a constant
+_DATA = {DW, DC}
+# Instructions that end a straight line run of code
+_BARRIERS = {LABEL, DW, DC, BR, BRL, BRZR, BRNZ, BRPL, BRMI, STOP, END}
+
+
+def _is_reg(x):
+    return isinstance(x, str) and x.startswith('r') and x[1:].isdigit()
+
+
+def _writes(i):
+    """Return the register written by instruction `i`, or None
+    """
+    if i.op in _BARRIERS or i.op == ST:
+        return None
+    return i.args[0]
 
-def _alloc_global(label):
+
+def _reads(i):
+    """Return a tuple of the registers read by instruction `i`. A base
+    register of r0 means "no base" and isn't counted
+    """
+    op, a = i.op, i.args
+    if op in _ALU3:
+        return a[1], a[2]
+    if op in _ALU2:
+        return a[1],
+    if op in _SHIFTS:
+        return (a[1], a[2]) if _is_reg(a[2]) else (a[1],)
+    if op == LA or op == LD:
+        return (a[2],) if a[2] != ZERO else ()
+    if op == ST:
+        return (a[0], a[2]) if a[2] != ZERO else (a[0],)
+    if op == BR:
+        return a[0],
+    if op == BRL:
+        return a[1],
+    if op == BRZR or op == BRNZ or op == BRPL or op == BRMI:
+        return a[0], a[1]
+    return ()
+
+
+def _replace_reads(i, old, new):
+    """Return a copy of instruction `i` that reads register `new` wherever it
+    read `old`. The register `i` writes is left alone
+    """
+    op, a = i.op, i.args
+    if op in _ALU3 or op in _ALU2 or op in _SHIFTS:
+        first = 1
+    elif op == LA or op == LD:
+        first = 2
+    else:
+        first = 0
+    args = a[:first] + tuple(new if x == old else x for x in a[first:])
+    return _Instr(op, args, i.line)
+
+
+def _alloc_global(ctx, label):
     # Allocate 1 32-bit word for the global and label this memory location
-    print(label + ":\t.dw\t1")
+    _emit(ctx, DW, label, 1)
+
+
+def _const_global(ctx, label, value):
+    # Allocate 1 32-bit word holding `value` from the start and label it
+    _emit(ctx, DC, label, value)
 
 
-def _alloc_stack(num_bytes):
-    _addi(STACK, STACK, int(-num_bytes))
+def _alloc_stack(ctx, num_bytes):
+    _addi(ctx, STACK, STACK, int(-num_bytes))
 
 
-def _dealloc_stack(num_bytes):
-    _addi(STACK, STACK, int(num_bytes))
+def _dealloc_stack(ctx, num_bytes):
+    _addi(ctx, STACK, STACK, int(num_bytes))
 
 
 #################################################
 # Branch Operations                             #
 #################################################
 
-def _brl_def():
-    _brl(RETURN, BRANCH_TARGET)
+def _brl_def(ctx):
+    _brl(ctx, RETURN, BRANCH_TARGET)
 
 
-def _brl(ra, rb):
+def _brl(ctx, ra, rb):
     """Branch to rb storing PC in ra
     """
-    print("brl {}, {}".format(ra, rb))
+    _emit(ctx, BRL, ra, rb)
 
 
-def _br_def():
-    _br(BRANCH_TARGET)
+def _br_def(ctx):
+    _br(ctx, BRANCH_TARGET)
 
 
-def _br(rb):
-    print("br {}".format(rb))
+def _br(ctx, rb):
+    _emit(ctx, BR, rb)
 
 
-def _brzr_def():
+def _brzr_def(ctx):
     # By default, branch to BRANCH_TARGET testing PRIMARY
-    _brzr(BRANCH_TARGET, PRIMARY)
+    _brzr(ctx, BRANCH_TARGET, PRIMARY)
 
 
-def _brzr(rb, rc):
+def _brzr(ctx, rb, rc):
     # Branch to rb if rc is zero
-    print('brzr {}, {}'.format(rb, rc))
+    _emit(ctx, BRZR, rb, rc)
 
 
-def _brnz_def():
+def _brnz_def(ctx):
     # By default, branch to BRANCH_TARGET testing PRIMARY
-    _brnz(BRANCH_TARGET, PRIMARY)
+    _brnz(ctx, BRANCH_TARGET, PRIMARY)
 
 
-def _brnz(rb, rc):
+def _brnz(ctx, rb, rc):
     # Branch to rb if rc is non-zero
-    print('brnz {}, {}'.format(rb, rc))
+    _emit(ctx, BRNZ, rb, rc)
+
+
+def _brpl(ctx, rb, rc):
+    # Branch to rb if rc is positive or zero
+    _emit(ctx, BRPL, rb, rc)
+
+
+def _brmi(ctx, rb, rc):
+    # Branch to rb if rc is negative
+    _emit(ctx, BRMI, rb, rc)
 
 
 #################################################
 # Comp Operations                               #
 #################################################
 
-def _cmp_def(op):
-    _cmp(STATUS, SECONDARY, PRIMARY, op)
+def _cmp_def(ctx, op):
+    _cmp(ctx, STATUS, SECONDARY, PRIMARY, op)
 
 
-def _cmp(ra, rb, rc, op):
+def _cmp(ctx, ra, rb, rc, op):
     """Compare rb and rc using the operator op. Put the result in ra. If
     the comparision is true, ra will be non zero, otherwise it will be zero
     """
-    _sub(ra, rb, rc)
+    _sub(ctx, ra, rb, rc)
+    _cmp_diff(ctx, ra, ra, op)
+
+
+def _cmp_diff(ctx, ra, rc, op):
+    """Put the result of comparing two values with op in ra, as `_cmp` does,
+    given their difference in rc
+    """
     # Note that we don't have to do anything extra for `!=` because the
     # subtraction handles that for us
     if op == '<' or op == '>=':
         # In both cases, we just need to check the sign bit
         # For <, true if sign bit is set (rb-rc < 0)
-        _shra(ra, ra, WORD-1)
+        _shra(ctx, ra, rc, WORD-1)
         if op == '>=':
             # true if sign bit is cleared, to comply with interface, need to
             # not the result
-            _logical_not(ra, ra)
+            _bitwise_not(ctx, ra, ra)
     elif op == '>' or op == '<=':
         # For >, rb-rc is strictly positive so its negative is strictly
         # negative, then we just check the sign (-0 = 0 so the sign will
         # still be 0)
-        _neg(ra, ra)
-        _shra(ra, ra, WORD-1)
+        _neg(ctx, ra, rc)
+        _shra(ctx, ra, ra, WORD-1)
         if op == '<=':
-            _logical_not(ra, ra)
+            _bitwise_not(ctx, ra, ra)
     elif op == '==':
-        _logical_not(ra, ra)
+        _logical_not(ctx, ra, rc)
+    elif ra != rc:
+        _load_address(ctx, ra, rc, 0)
 
 
 #################################################
 # Arith Operations                              #
 #################################################
 
-def _bitwise_or(ra, rb, rc):
+def _bitwise_or(ctx, ra, rb, rc):
     """Bitwise or rb and rc and put result in ra
     """
-    print("or {}, {}, {}".format(ra, rb, rc))
+    _emit(ctx, OR, ra, rb, rc)
 
 
-def _logical_or(ra, rb, rc):
-    """Logical or rb and rc and put result in ra
-    Right now, there is no instruction for logical or so this just does the
-    same thing as `_bitwise_or`
-    """
-    print("or {}, {}, {}".format(ra, rb, rc))
-
-
-def _bitwise_and(ra, rb, rc):
+def _bitwise_and(ctx, ra, rb, rc):
     """Bitwise and rb and rc and put result in ra
     """
-    print("and {}, {}, {}".format(ra, rb, rc))
+    _emit(ctx, AND, ra, rb, rc)
 
 
-def _logical_and(ra, rb, rc):
-    """Logical and rb and rc and put result in ra
-    Right now, there is no instruction for logical and so this just does the
-    same thing as `_bitwise_and`
+def _bitwise_not(ctx, ra, rc):
+    """Bitwise not rc and put result in ra
     """
-    print("and {}, {}, {}".format(ra, rb, rc))
+    _emit(ctx, NOT, ra, rc)
 
 
-def _bitwise_not(ra, rc):
-    """Bitwise not rc and put result in ra
+def _truth(ctx, ra, rc):
+    """Put -1 in ra if rc is non zero, otherwise 0. x | -x has its sign bit
+    set for every x but 0. Uses SECONDARY as scratch
     """
-    print("not {}, {}".format(ra, rc))
+    _neg(ctx, SECONDARY, rc)
+    _bitwise_or(ctx, ra, rc, SECONDARY)
+    _shra(ctx, ra, ra, WORD-1)
 
 
-def _logical_not(ra, rc):
-    """Logical not rc and put result in ra
-    Right now, there is no instruction for logical not so this just does the
-    same thing as `_bitwise_not`
+def _logical_not(ctx, ra, rc):
+    """Logical not rc and put result in ra: -1 if rc is zero, otherwise 0
     """
-    print("not {}, {}".format(ra, rc))
+    _truth(ctx, ra, rc)
+    _bitwise_not(ctx, ra, ra)
 
 
-def _add(ra, rb, rc):
-    print("add {}, {}, {}".format(ra, rb, rc))
+def _add(ctx, ra, rb, rc):
+    _emit(ctx, ADD, ra, rb, rc)
 
 
-def _addi(ra, rb, c):
-    print("addi {}, {}, {}".format(ra, rb, c))
+def _addi(ctx, ra, rb, c):
+    _emit(ctx, ADDI, ra, rb, c)
 
 
-def _sub(ra, rb, rc):
-    print("sub {}, {}, {}".format(ra, rb, rc))
+def _sub(ctx, ra, rb, rc):
+    _emit(ctx, SUB, ra, rb, rc)
 
 
-def _neg(ra, rc):
-    print("neg {}, {}".format(ra, rc))
+def _neg(ctx, ra, rc):
+    _emit(ctx, NEG, ra, rc)
 
 
-def _mul(ra, rb, rc):
-    print("mul {}, {}, {}".format(ra, rb, rc))
+def _mul(ctx, ra, rb, rc):
+    _emit(ctx, MUL, ra, rb, rc)
 
 
-def _div(ra, rb, rc):
-    print("div {}, {}, {}".format(ra, rb, rc))
+def _div(ctx, ra, rb, rc):
+    _emit(ctx, DIV, ra, rb, rc)
 
 
-def _shr(ra, rb, r_c):
+def _shr(ctx, ra, rb, r_c):
     """Shift rb right (logically) by either register rc or constant c and put
     result in ra
     """
-    print("shr {}, {}, {}".format(ra, rb, r_c))
+    _emit(ctx, SHR, ra, rb, r_c)
 
 
-def _shra(ra, rb, r_c):
+def _shra(ctx, ra, rb, r_c):
     """Shift rb right (arithmetically, i.e., sign extend) by either register
     rc or constant c and put result in ra
     """
-    print("shra {}, {}, {}".format(ra, rb, r_c))
+    _emit(ctx, SHRA, ra, rb, r_c)
 
 
-def _shl(ra, rb, r_c):
+def _shl(ctx, ra, rb, r_c):
     """Shift rb left (logically) by either register rc or constant c and put
     result in ra
     """
-    print("shl {}, {}, {}".format(ra, rb, r_c))
+    _emit(ctx, SHL, ra, rb, r_c)
+
+
+#################################################
+# Constant Folding                              #
+#################################################
+
+# Range of the signed 17 bit immediate of addi/la/ld/st
+IMM_MIN = -(1 << 16)
+IMM_MAX = (1 << 16) - 1
+
+
+def _fits_imm(c):
+    return IMM_MIN <= c <= IMM_MAX
+
+
+def _wrap(v):
+    """Reduce the integer `v` to the signed value a WORD bit register holding
+    it would have
+    """
+    v &= (1 << WORD) - 1
+    return v - (1 << WORD) if v >> (WORD - 1) else v
+
+
+def _fold(op, b, c):
+    """Return the value of `b op c` for constants b and c, computed the same
+    way as the code emitted for op would at run time. Return None if it
+    can't be computed at compile time (division by zero)
+    """
+    if op == '+':
+        return _wrap(b + c)
+    if op == '-':
+        return _wrap(b - c)
+    if op == '*':
+        return _wrap(b * c)
+    if op == '/':
+        if c == 0:
+            return None
+        q = abs(b) // abs(c)
+        return _wrap(q if (b < 0) == (c < 0) else -q)
+    if op == '|':
+        return b | c
+    if op == '&':
+        return b & c
+    if op == '<<':
+        return _wrap(b << (c & (WORD - 1)))
+    if op == '>>':
+        return b >> (c & (WORD - 1))
+    if op == '||':
+        return -1 if b or c else 0
+    if op == '&&':
+        return -1 if b and c else 0
+    return _fold_cmp(b, c, op)
+
+
+def _fold_cmp(b, c, op):
+    """The value `_cmp` leaves in ra when rb is b and rc is c
+    """
+    r = _wrap(b - c)
+    if op == '<' or op == '>=':
+        r = -1 if r < 0 else 0
+        if op == '>=':
+            r = ~r
+    elif op == '>' or op == '<=':
+        r = -1 if _wrap(-r) < 0 else 0
+        if op == '<=':
+            r = ~r
+    elif op == '==':
+        r = -1 if r == 0 else 0
+    return r
+
+
+#################################################
+# Strength Reduction                            #
+#################################################
+
+def _log2(n):
+    """Return k if n is 2**k, otherwise None
+    """
+    if n <= 0 or n & (n - 1):
+        return None
+    return n.bit_length() - 1
+
+
+def _mul_shifts(c):
+    """Return (a, b, op) such that multiplying by abs(c) is
+    (x << a) op (x << b), with op None when it is just x << a, or None if
+    there is no such pair
+    """
+    m = abs(c)
+    a = _log2(m)
+    if a is not None:
+        return a, None, None
+    low = m & -m
+    a = _log2(m - low)
+    if a is not None:
+        return a, _log2(low), '+'
+    a = _log2(m + low)
+    if a is not None:
+        return a, _log2(low), '-'
+    return None
+
+
+def _mul_const(ctx, ra, rb, c):
+    """Multiply rb by the constant c into ra with shifts and adds. Return
+    False, emitting nothing, if c needs more than two shifts. Uses SECONDARY
+    as scratch
+    """
+    if c == 0:
+        _load_address(ctx, ra, ZERO, 0)
+        return True
+    shifts = _mul_shifts(c)
+    if shifts is None:
+        return False
+    a, b, op = shifts
+    if op is None:
+        _shift_const(ctx, SHL, ra, rb, a)
+    else:
+        _shl(ctx, SECONDARY, rb, a)
+        _shift_const(ctx, SHL, ra, rb, b)
+        if op == '+':
+            _add(ctx, ra, ra, SECONDARY)
+        else:
+            _sub(ctx, ra, SECONDARY, ra)
+    if c < 0:
+        _neg(ctx, ra, ra)
+    return True
+
+
+def _div_const(ctx, ra, rb, c):
+    """Divide rb by the constant c into ra, truncating toward zero like div,
+    when c is a power of two or minus one. Return False, emitting nothing,
+    otherwise. Uses SECONDARY as scratch
+    """
+    k = _log2(abs(c))
+    if k is None:
+        return False
+    if k > 0:
+        # An arithmetic shift rounds down, so first add 2**k - 1 to a
+        # negative dividend to make it round toward zero instead
+        if k == 1:
+            _shr(ctx, SECONDARY, rb, WORD - 1)
+        else:
+            _shra(ctx, SECONDARY, rb, WORD - 1)
+            _shr(ctx, SECONDARY, SECONDARY, WORD - k)
+        _add(ctx, ra, rb, SECONDARY)
+        _shra(ctx, ra, ra, k)
+        rb = ra
+    if c < 0:
+        _neg(ctx, ra, rb)
+    elif ra != rb:
+        _load_address(ctx, ra, rb, 0)
+    return True
+
+
+def _shift_const(ctx, op, ra, rb, n):
+    """Shift rb by the constant n into ra with op (SHL, SHR or SHRA). Only
+    the low bits of n count, as they do for a shift by a register
+    """
+    n &= WORD - 1
+    if n == 0:
+        # A shift count of 0 in the instruction means shift by rc instead
+        if ra != rb:
+            _load_address(ctx, ra, rb, 0)
+        return
+    _emit(ctx, op, ra, rb, n)
 
 
 #################################################
 # Stack Operations                              #
 #################################################
 
-def _pop_primary():
-    _pop(PRIMARY)
+def _pop_primary(ctx):
+    _pop(ctx, PRIMARY)
 
 
-def _pop_secondary():
-    _pop(SECONDARY)
+def _pop_secondary(ctx):
+    _pop(ctx, SECONDARY)
 
 
-def _pop(reg):
+def _pop(ctx, reg):
     # Move SP first b/c it points off the end of the stack
-    _addi(STACK, STACK, WORD // BYTE)
-    _load(reg, 0, STACK)
+    _addi(ctx, STACK, STACK, WORD // BYTE)
+    _load(ctx, reg, 0, STACK)
 
 
-def _push_primary():
-    _push(PRIMARY)
+def _push_primary(ctx):
+    _push(ctx, PRIMARY)
 
 
-def _push_secondary():
-    _push(SECONDARY)
+def _push_secondary(ctx):
+    _push(ctx, SECONDARY)
 
 
-def _push_ret():
-    _push(RETURN)
+def _push_ret(ctx):
+    _push(ctx, RETURN)
 
 
-def _push(reg):
-    _store(reg, 0, STACK)
-    _addi(STACK, STACK, -WORD // BYTE)
+def _push(ctx, reg):
+    _store(ctx, reg, 0, STACK)
+    _addi(ctx, STACK, STACK, -WORD // BYTE)
 
 
 #################################################
 # LD/ST Operations                              #
 #################################################
 
-def _load_primary_address(rb, c2):
-    _load_address(PRIMARY, rb, c2)
+def _load_primary_address(ctx, rb, c2):
+    _load_address(ctx, PRIMARY, rb, c2)
 
 
-def _load_address(ra, rb, c2):
-    print("la {}, {}({})".format(ra, c2, rb))
+def _load_address(ctx, ra, rb, c2):
+    _emit(ctx, LA, ra, c2, rb)
 
 
-def _load_primary_address_relative(addr):
-    _load_address_relative(PRIMARY, addr)
+def _load_primary_address_relative(ctx, addr):
+    _load_address_relative(ctx, PRIMARY, addr)
 
 
-def _load_branch_address_relative(addr):
-    _load_address_relative(BRANCH_TARGET, addr)
+def _load_branch_address_relative(ctx, addr):
+    _load_address_relative(ctx, BRANCH_TARGET, addr)
 
 
-def _load_address_relative(reg, addr):
-    print("lar {}, {}".format(reg, addr))
+def _load_address_relative(ctx, reg, addr):
+    _emit(ctx, LAR, reg, addr)
 
 
-def _load_primary_abs(offset):
-    _load_primary(offset, ZERO)
+def _load_primary_abs(ctx, offset):
+    _load_primary(ctx, offset, ZERO)
 
 
-def _load_primary(offset, base):
-    _load(PRIMARY, offset, base)
+def _load_primary(ctx, offset, base):
+    _load(ctx, PRIMARY, offset, base)
 
 
-def _load_abs(reg, offset):
-    _load(reg, offset, ZERO)
+def _load_abs(ctx, reg, offset):
+    _load(ctx, reg, offset, ZERO)
 
 
-def _load(reg, offset, base):
-    print("ld {}, {}({})".format(reg, offset, base))
+def _load(ctx, reg, offset, base):
+    _emit(ctx, LD, reg, offset, base)
 
 
-def _store_primary_abs(offset):
-    _store_primary(offset, ZERO)
+def _store_primary_abs(ctx, offset):
+    _store_primary(ctx, offset, ZERO)
 
 
-def _store_primary(offset, base):
-    _store(PRIMARY, offset, base)
+def _store_primary(ctx, offset, base):
+    _store(ctx, PRIMARY, offset, base)
 
 
-def _store_abs(reg, offset):
-    _store(reg, offset, ZERO)
+def _store_abs(ctx, reg, offset):
+    _store(ctx, reg, offset, ZERO)
 
 
-def _store(reg, offset, base):
-    print("st {}, {}({})".format(reg, offset, base))
+def _store(ctx, reg, offset, base):
+    _emit(ctx, ST, reg, offset, base)
 
 
 #################################################
 # PostLabel                                     #
 #################################################
 
-def _post_label(label):
-    print("{}:\t".format(label))
+def _post_label(ctx, label):
+    _emit(ctx, LABEL, label)
+
+
+#################################################
+# Program Control                               #
+#################################################
+
+def _stop(ctx):
+    _emit(ctx, STOP)
+
+
+def _end(ctx):
+    # Marks the end of the assembly source
+    _emit(ctx, END)
@@ -0,0 +1,257 @@
+"""The compiler driver. A `Compiler` owns all of the state needed to compile
+a program (tokens, symbol tables, label counter and emitted instructions), so
+any number of them can be used side by side in one process.
+"""
+
+import callgraph
+import codegen
+import linker
+import parser
+import passes
+import peephole
+import pgo
+import scanner
+import stats
+import syntax
+
+# Optimizations each -O level turns on, on top of those of the levels below it
+_LEVEL_OPTIMIZATIONS = (
+    (),
+    ('peephole', 'const-fold', 'reg-exprs', 'reg-vars', 'cond-branch',
+     'strength', 'loop-rotate', 'loop-hoist', 'inline', 'tail-calls',
+     'omit-frames', 'dce'),
+    ('ir', 'cse', 'copy-prop'),
+)
+OPTIMIZATIONS = tuple(o for level in _LEVEL_OPTIMIZATIONS for o in level)
+# Bytes the data section is aligned to, so which words of it share a cache
+# line doesn't depend on the length of the code
+_DATA_ALIGN = 16
+# Label of the words padding the code up to the data section
+_PAD_LABEL = "PAD"
+
+
+def _optimizations(opt_level, flags):
+    """Return the set of optimizations enabled by `opt_level` and then the
+    `flags`, each of which is an optimization name to turn on or `no-<name>`
+    to turn it off
+    """
+    opts = set()
+    for level in _LEVEL_OPTIMIZATIONS[:max(opt_level, 0) + 1]:
+        opts.update(level)
+    for f in flags:
+        if f.startswith('no-'):
+            opts.discard(f[3:])
+        else:
+            opts.add(f)
+    return opts
+
+
+class Compiler:
+    """Compiles RSRC programs to assembly text. The state of a compilation
+    lives on the instance and is reset at the start of each one, so a
+    `Compiler` can be reused for many programs but must not be shared by two
+    threads at once.
+    """
+
+    def __init__(self, opt_level=0, flags=(), peephole_window=None,
+                 inline_threshold=None, profile_generate=False,
+                 profile_use=None, keep_stats=False):
+        # 0 emits the code exactly as it is parsed, 1 optimizes it as it is
+        # emitted and 2 and up optimizes it in the IR (see `passes`).
+        # `flags` turn single optimizations on or off (see `_optimizations`).
+        # `profile_generate` adds counters to the code for making a profile,
+        # and `profile_use` is a profile to optimize by (see `pgo`).
+        # `keep_stats` keeps statistics of each compilation (see `stats`).
+        # Both are on as long as what `_reset` makes for them isn't None
+        self.opt_level = opt_level
+        self.opts = _optimizations(opt_level, flags)
+        self.peephole_window = peephole_window if peephole_window is not None \
+            else peephole._DEFAULT_WINDOW
+        self.inline_threshold = inline_threshold \
+            if inline_threshold is not None \
+            else parser._DEFAULT_INLINE_THRESHOLD
+        self.profile = profile_use
+        self.counters = [] if profile_generate else None
+        self.stats = stats._Stats() if keep_stats else None
+        self._reset()
+
+    def compile(self, source, objects=()):
+        """Compile the bytes-like `source` and return the assembly text.
+        The functions and globals exported by the `linker` objects in
+        `objects` can be used as if declared first. Raises
+        `error.CompileError` if the program is invalid
+        """
+        return self._run(scanner._tokenize, source, objects)
+
+    def compile_file(self, f, objects=()):
+        """Compile the source read from the binary file object `f`, which may
+        be a regular file or a stream such as stdin
+        """
+        return self._run(scanner._open, f, objects)
+
+    def line_table(self):
+        """Return the function and source line of each line of the assembly
+        of the last program compiled, as a list of (function, line)
+        """
+        return _line_table(self)
+
+    def statistics(self):
+        """Return the statistics of the last program compiled, as a dict
+        (see `stats`). Only for a `Compiler` made with `keep_stats=True`
+        """
+        return stats._collect(self)
+
+    def _reset(self):
+        if self.stats is not None:
+            self.stats = stats._Stats()
+        self.ts = None
+        # Really a stack of symbol tables so that we can track different
+        # scopes. `symtab[0]` is the global symbol table
+        self.symtab = [{}]
+        self.label_count = 0
+        # Name of the function being parsed
+        self.function = None
+        # Label the calls to it in tail position jump back to, if any
+        self.tail_label = None
+        self.local_offset = parser._init_local_offset
+        # Names assigned anywhere in the body of the function being parsed
+        self.assigned = None
+        # Number of `codegen.TEMPS` registers holding saved operands
+        self.temp_depth = 0
+        # Words pushed on the stack below the locals by the expression being
+        # parsed
+        self.pushed = 0
+        # Number of calls to each name in the program, if known
+        self.calls = None
+        # (name, exit label, stack offset) of each function being inlined,
+        # innermost last
+        self.inlining = []
+        # Number of `codegen.TEMPS` registers holding operands while each
+        # loop runs, by the label at its head, when it isn't zero
+        self.live_temps = {}
+        # Instructions emitted so far, in program order
+        self.out = []
+        # Source line of the statement the code being emitted is for
+        self.line = None
+        # Out of line code of the function being parsed, which goes after
+        # the rest of it, and the labels at the head of all such code (see
+        # `loops`)
+        self.cold_code = []
+        self.cold_labels = set()
+        # With `profile_generate`, the (label, kind, function, line, label of
+        # the enclosing one) of every counter, the labels of the counters of
+        # the bodies each (function, line) is in and the label of the one
+        # being parsed (see `pgo`)
+        if self.counters is not None:
+            self.counters = []
+        self.counted = {}
+        self.region = None
+        # With `profile_use`, the times the body being parsed ran, if known
+        self.frequency = None
+        # (name, label, start, end) of the code of each function in `out`,
+        # from its label
+        self.functions = []
+        # Number of instructions dropped because they could never run
+        self.unreachable = 0
+        # Lines describing what the optimizers did
+        self.report = []
+
+    def _run(self, tokenize, source, objects):
+        """Compile `source`, which `tokenize` turns into tokens, against
+        `objects`
+        """
+        self._reset()
+        stats._start(self)
+        try:
+            linker._declare(self, objects)
+            self.ts = tokenize(source)
+            _prolog(self)
+            if 'ir' in self.opts:
+                # Through the syntax tree and the IR rather than straight
+                # from the tokens
+                with stats._phase(self, 'parse'):
+                    program = syntax._program(self)
+                with stats._phase(self, 'ir'):
+                    passes._program(self, program)
+                # Not needed by the phases after
+                del program
+            else:
+                with stats._phase(self, 'parse'):
+                    parser._program(self)
+            if 'dce' in self.opts:
+                with stats._phase(self, 'dce'):
+                    callgraph._prune(self)
+            data = _epilog(self)
+            if 'peephole' in self.opts:
+                with stats._phase(self, 'peephole'):
+                    _peephole(self)
+            _data_section(self, data)
+            with stats._phase(self, 'format'):
+                return codegen._format(self.out)
+        finally:
+            if self.stats is not None:
+                stats._finish(self)
+
+
+def _prolog(ctx):
+    # Initialize stack pointer and base pointer
+    codegen._load_address_relative(ctx, codegen.STACK, 0xFFF8)
+    codegen._load_address_relative(ctx, codegen.BASE, 0xFFFC)
+
+
+def _epilog(ctx):
+    """End the code in `ctx.out` with a stop and take the words of data out
+    of it. Return them for `_data_section`
+    """
+    ctx.line = None
+    pgo._words(ctx)
+    data = [ins for ins in ctx.out if ins.op in codegen._DATA]
+    ctx.out = [ins for ins in ctx.out if ins.op not in codegen._DATA]
+    if not ctx.out or ctx.out[-1].op != codegen.STOP:
+        codegen._stop(ctx)
+    return data
+
+
+def _data_section(ctx, data):
+    """Lay out the words of data `data` after the code in `ctx.out`, which
+    must be final, from the next address aligned to `_DATA_ALIGN`
+    """
+    ctx.line = None
+    words = sum(1 for ins in ctx.out if ins.op != codegen.LABEL)
+    pad = -words % (_DATA_ALIGN // (codegen.WORD // codegen.BYTE))
+    if data and pad:
+        codegen._emit(ctx, codegen.DW, _PAD_LABEL, pad)
+    ctx.out.extend(data)
+    codegen._end(ctx)
+
+
+def _peephole(ctx):
+    before = len(ctx.out)
+    ctx.out, rules = peephole._optimize(ctx.out, ctx.peephole_window)
+    removed = before - len(ctx.out)
+    ctx.report.append("peephole: removed {} of {} instructions ({:.1f}%)"
+                      .format(removed, before, 100.0 * removed / before))
+    for rule, n in rules.items():
+        ctx.report.append("  {}: {}".format(rule, n))
+
+
+def _line_table(ctx):
+    """Return the name of the function and the source line of each
+    instruction in `ctx.out`, as a list of (function, line). Instructions
+    an optimizer made up have the line of the one before them, as a line
+    table carries a line forward until the next one starts, but not past
+    a label, where control can come from elsewhere. The function is None
+    for the code before the first one
+    """
+    names = {label: name for name, label, _, _ in ctx.functions}
+    table = []
+    function = line = None
+    for ins in ctx.out:
+        if ins.op == codegen.LABEL:
+            if ins.args[0] in names:
+                function = names[ins.args[0]]
+            line = None
+        elif ins.line is not None:
+            line = ins.line
+        table.append((function, line))
+    return table
@@ -0,0 +1,152 @@
+"""Machine code for the RSRC. `_encode` turns the instructions of a program
+straight into the 32 bit words of its memory image, laid out as `assembler`
+does, so the image can be loaded into the hardware or another simulator
+without assembling the text. The labels are placed by `assembler._layout`
+and the words encoded once all their addresses are known. Every word is one
+of the formats
+
+    op<31..27> ra<26..22> c1<21..0>                     lar
+    op<31..27> ra<26..22> rb<21..17> c2<16..0>          la, ld, st, addi
+    op<31..27> ra<26..22> rb<21..17> rc<16..12> c3<11..0>
+
+with c1 and c2 signed. `lar` is relative to the address of the instruction
+after it, so the value it loads, whether an address or a constant, must be
+within 22 bits of that. The shifts take their count from c3<4..0>, or from
+rc when that is 0, and the branches their condition from c3<2..0>. The RSRC
+has no mul or div, so they get two of its unused opcodes. A `.dw` reserves
+words holding 0 and a `.dc` one holding its constant, and the image is big
+endian, as the RSRC is.
+"""
+
+import array
+import sys
+
+import assembler
+import codegen
+import error
+
+_WORD_BYTES = codegen.WORD // codegen.BYTE
+_OPCODES = {
+    codegen.LD: 1, codegen.ST: 3, codegen.LA: 5, codegen.LAR: 6,
+    codegen.BR: 8, codegen.BRZR: 8, codegen.BRNZ: 8, codegen.BRPL: 8,
+    codegen.BRMI: 8, codegen.BRL: 9, codegen.ADD: 12, codegen.ADDI: 13,
+    codegen.SUB: 14, codegen.NEG: 15, codegen.MUL: 16, codegen.DIV: 17,
+    codegen.AND: 20, codegen.OR: 22, codegen.NOT: 24, codegen.SHR: 26,
+    codegen.SHRA: 27, codegen.SHL: 28, codegen.STOP: 31,
+}
+# Branch conditions
+_ALWAYS = 1
+_CONDITIONS = {codegen.BRZR: 2, codegen.BRNZ: 3, codegen.BRPL: 4,
+               codegen.BRMI: 5}
+_C1_BITS = 22
+_C2_BITS = 17
+# Bits of c3 a shift count can use
+_COUNT_BITS = 5
+
+
+def _encode(instrs):
+    """Return the memory image of `instrs` as an array of words. Raises
+    `error.AssemblyError` if an instruction can't be encoded, such as one
+    whose constant doesn't fit in its field
+    """
+    labels, words = assembler._layout(instrs)
+    image = array.array('I', bytes(_WORD_BYTES * len(words)))
+    for w, k in enumerate(words):
+        ins = instrs[k]
+        if ins.op == codegen.DC:
+            image[w] = _field(_value(ins.args[1], labels, ins), codegen.WORD,
+                              ins)
+        elif ins.op != codegen.DW:
+            image[w] = _word(ins, w * _WORD_BYTES, labels)
+    return image
+
+
+def _word(ins, address, labels):
+    """Return the word encoding `ins`, which is at `address`
+    """
+    op, a = ins.op, ins.args
+    if op not in _OPCODES:
+        error._asm_error("Can't encode {}".format(ins))
+    word = _OPCODES[op] << 27
+    if op == codegen.STOP:
+        return word
+    if op == codegen.LAR:
+        disp = _value(a[1], labels, ins) - address - _WORD_BYTES
+        return word | _reg(a[0], ins) << 22 | _field(disp, _C1_BITS, ins)
+    if op in assembler._DISPLACED:
+        return word | _reg(a[0], ins) << 22 | _reg(a[2], ins) << 17 | \
+            _field(_value(a[1], labels, ins), _C2_BITS, ins)
+    if op == codegen.ADDI:
+        return word | _reg(a[0], ins) << 22 | _reg(a[1], ins) << 17 | \
+            _field(_value(a[2], labels, ins), _C2_BITS, ins)
+    if op in codegen._ALU3:
+        return word | _reg(a[0], ins) << 22 | _reg(a[1], ins) << 17 | \
+            _reg(a[2], ins) << 12
+    if op == codegen.NEG or op == codegen.NOT:
+        return word | _reg(a[0], ins) << 22 | _reg(a[1], ins) << 12
+    if op in codegen._SHIFTS:
+        word |= _reg(a[0], ins) << 22 | _reg(a[1], ins) << 17
+        if codegen._is_reg(a[2]):
+            return word | _reg(a[2], ins) << 12
+        count = _value(a[2], labels, ins)
+        if not 0 <= count < 1 << _COUNT_BITS:
+            error._asm_error("Shift count {} of {} doesn't fit in {} "
+                             "bits".format(count, ins, _COUNT_BITS))
+        return word | count
+    if op == codegen.BR:
+        return word | _reg(a[0], ins) << 17 | _ALWAYS
+    if op == codegen.BRL:
+        return word | _reg(a[0], ins) << 22 | _reg(a[1], ins) << 17 | \
+            _ALWAYS
+    # Conditional branches: to rb if rc passes the test
+    return word | _reg(a[0], ins) << 17 | _reg(a[1], ins) << 12 | \
+        _CONDITIONS[op]
+
+
+def _reg(x, ins):
+    if not codegen._is_reg(x) or int(x[1:]) >= codegen.WORD:
+        error._asm_error("Expected a register in {}, got {}".format(ins, x))
+    return int(x[1:])
+
+
+def _value(x, labels, ins):
+    """Return the number the operand `x` of `ins` stands for: itself, or
+    the address of the label it names
+    """
+    if isinstance(x, int):
+        return x
+    if x in labels:
+        return labels[x]
+    try:
+        return int(x, 0)
+    except ValueError:
+        error._asm_error("Undefined label {} in {}".format(x, ins))
+
+
+def _field(v, bits, ins):
+    """Return the signed `v` as a field of `bits` bits. Raises
+    `error.AssemblyError` if it doesn't fit
+    """
+    if not -(1 << bits - 1) <= v < 1 << bits - 1:
+        error._asm_error("{} in {} doesn't fit in a {} bit field".format(
+            v, ins, bits))
+    return v & ((1 << bits) - 1)
+
+
+#################################################
+# Images                                        #
+#################################################
+
+def _binary(image):
+    """Return the array of words `image` as big endian bytes
+    """
+    if sys.byteorder == 'little':
+        image = array.array('I', image)
+        image.byteswap()
+    return image.tobytes()
+
+
+def _hex(image):
+    """Return the array of words `image` as text, one word in hex a line
+    """
+    return "".join(["{:08x}\n".format(w) for w in image])
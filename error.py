@@ -1,13 +1,38 @@
 """Functions that signal an error has been encountered
 """
 
-import sys
+
+class CompileError(Exception):
+    """Raised when the source program can't be compiled
+    """
+
+
+class AssemblyError(Exception):
+    """Raised when assembly text can't be read back
+    """
+
+
+class LinkError(Exception):
+    """Raised when object files can't be linked into a program
+    """
+
+
+class SimulationError(Exception):
+    """Raised when a simulated program does something the machine can't
+    """
 
 
 def _error(msg):
-    print(msg)
-    sys.exit()
+    raise CompileError(msg)
 
 
 def _expected(value):
     _error("Expected: " + str(value))
+
+
+def _asm_error(msg):
+    raise AssemblyError(msg)
+
+
+def _link_error(msg):
+    raise LinkError(msg)
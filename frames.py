@@ -0,0 +1,117 @@
+"""Prologue and epilogue elision. Every function starts by pushing its return
+address and its caller sets up a base pointer for it, but a function that
+makes no calls (a leaf) never needs to free up RETURN, so it can keep its
+return address there and return straight to it. A leaf that doesn't use its
+frame either, with all of its variables in registers, doesn't need a base
+pointer at all: its arguments are read off the stack pointer as soon as it
+is entered, and callers skip saving and setting up the base pointer around
+calls to it.
+"""
+
+import codegen
+
+_WORD_BYTES = codegen.WORD // codegen.BYTE
+
+
+def _is_leaf(instrs):
+    """Return whether the function whose code is `instrs` makes no calls.
+    A tail call reloads RETURN before jumping to its callee
+    """
+    for ins in instrs:
+        if ins.op == codegen.BRL or (ins.op == codegen.LD and
+                                     ins.args[0] == codegen.RETURN):
+            return False
+    return True
+
+
+def _free_temps(instrs):
+    """Return the scratch registers the function whose code is `instrs`
+    never mentions, which a leaf can keep its variables in without saving
+    them. The highest numbered come first, as loop-hoist also does
+    """
+    used = set()
+    for ins in instrs:
+        used.add(codegen._writes(ins))
+        used.update(codegen._reads(ins))
+    return [r for r in reversed(codegen.TEMPS) if r not in used]
+
+
+def _function(ctx, start, label, entry, is_main):
+    """Cut down the prologue and epilogue of the function whose code is
+    `ctx.out[start:]` and whose symbol table entry is `entry`, and record on
+    the entry how it has to be called: 'leaf' if it keeps its return address
+    in RETURN, and 'frame' if its caller has to set up a base pointer for it
+    """
+    instrs = ctx.out[start:]
+    # instrs[:2] is the push of the return address
+    if is_main:
+        # main is jumped to, so it has no return address to save
+        del instrs[0]
+        ctx.out[start:] = instrs
+        ctx.report.append("omit-frames: {}: no return address".format(label))
+        return
+    entry['leaf'] = _is_leaf(instrs)
+    entry['frame'] = True
+    if not entry['leaf']:
+        return
+    entry['frame'] = _uses_frame(instrs)
+    out = [] if not entry['frame'] else [instrs[1]]
+    k = 2
+    if not entry['frame']:
+        # Nothing has been pushed yet, so the arguments are where the
+        # caller stored them, just above the stack pointer
+        while k < len(instrs) and _is_param_load(instrs[k]):
+            a = instrs[k].args
+            out.append(codegen._Instr(codegen.LD, (a[0], a[1],
+                                                   codegen.STACK),
+                                      instrs[k].line))
+            k += 1
+    n = len(instrs)
+    while k < n:
+        ins = instrs[k]
+        if _is_return(instrs, k):
+            if entry['frame']:
+                out.append(ins)
+            out.append(codegen._Instr(codegen.BR, (codegen.RETURN,),
+                                      ins.line))
+            k += 3
+            continue
+        out.append(ins)
+        k += 1
+    ctx.out[start:] = out
+    ctx.report.append("omit-frames: {}: leaf{}".format(
+        label, "" if entry['frame'] else ", no frame"))
+
+
+def _is_param_load(ins):
+    return ins.op == codegen.LD and ins.args[2] == codegen.BASE and \
+        isinstance(ins.args[1], int) and ins.args[1] > 0
+
+
+def _uses_frame(instrs):
+    """Return whether the leaf whose code is `instrs` needs a base pointer:
+    it does unless the only uses of it are loads of parameters into
+    registers before anything else is done
+    """
+    k = 2
+    while k < len(instrs) and _is_param_load(instrs[k]):
+        k += 1
+    for ins in instrs[k:]:
+        if codegen.BASE in codegen._reads(ins) or \
+                codegen._writes(ins) == codegen.BASE:
+            return True
+    return False
+
+
+def _is_return(instrs, k):
+    """Return whether `instrs[k:k + 3]` pops the return address and returns
+    to it: addi r31, r31, 4; ld r3, 0(r31); br r3
+    """
+    if k + 2 >= len(instrs):
+        return False
+    pop, ld, br = instrs[k:k + 3]
+    return pop.op == codegen.ADDI and pop.args == (
+        codegen.STACK, codegen.STACK, _WORD_BYTES) and \
+        ld.op == codegen.LD and ld.args == (codegen.BRANCH_TARGET, 0,
+                                            codegen.STACK) and \
+        br.op == codegen.BR and br.args == (codegen.BRANCH_TARGET,)
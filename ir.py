@@ -0,0 +1,456 @@
+"""Three address intermediate representation. Each function is a control flow
+graph of basic blocks of `_Ins` instructions over an unlimited supply of
+temporaries (`_Temp`), which stand for the values that end up in registers.
+Every block ends with exactly one terminator, and variables are not in SSA
+form: a temporary may be assigned any number of times.
+
+Instructions, with `dst` the temporary written, if any:
+
+    param   dst (i,)                    dst <- parameter i
+    copy    dst (a,)                    dst <- a
+    bin     dst (op, a, b)              dst <- a op b, any binary operator
+                                        but && and ||, with the values the
+                                        direct code generator gives them
+    neg     dst (a,)                    dst <- -a
+    not     dst (a,)                    dst <- ~a
+    load    dst (base, offset)          dst <- M[base + offset]
+    store   None (value, base, offset)  M[base + offset] <- value
+    call    dst (func, args)            dst <- func(args), dst may be None
+
+and the terminators:
+
+    jump    None (block,)
+    branch  None (op, a, b, then, else) to `then` if a op b, else to `else`
+    ret     None (value,)               value may be None
+
+Operands are temporaries or int constants. An offset is an int or the label
+of a global variable, `func` is a `syntax._Function`.
+"""
+
+import parser
+import pgo
+import syntax
+
+# Instructions with no effect but writing `dst`, which can be moved, merged
+# or removed freely
+PURE = {'param', 'copy', 'bin', 'neg', 'not', 'load'}
+TERMINATORS = {'jump', 'branch', 'ret'}
+# Index in `args` of each operand of the instructions that have them
+_OPERANDS = {'copy': (0,), 'bin': (1, 2), 'neg': (0,), 'not': (0,),
+             'load': (0,), 'store': (0, 1), 'branch': (1, 2), 'ret': (0,)}
+COMMUTATIVE = {'+', '*', '&', '|', '=='}
+_RELATIONS = {'<', '>', '<=', '>=', '==', '!='}
+
+
+class _Temp:
+    """A temporary. `name` is the variable it holds, if any, for reports
+    """
+    __slots__ = ('id', 'name')
+
+    def __init__(self, id, name=None):
+        self.id = id
+        self.name = name
+
+    def __repr__(self):
+        return "t{}{}".format(self.id, "." + self.name if self.name else "")
+
+
+class _Ins:
+    __slots__ = ('op', 'dst', 'args', 'line')
+
+    def __init__(self, op, dst, args, line=None):
+        self.op = op
+        self.dst = dst
+        self.args = args
+        self.line = line
+
+    def __repr__(self):
+        return "{}{} {}".format("" if self.dst is None else
+                                repr(self.dst) + " = ", self.op, self.args)
+
+
+class _Block:
+    """A basic block. `succs` and `preds` are kept up to date by `_link`, and
+    `cold` blocks are laid out after the rest of the function as out of line
+    code
+    """
+    __slots__ = ('id', 'instrs', 'succs', 'preds', 'cold')
+
+    def __init__(self, id):
+        self.id = id
+        self.instrs = []
+        self.succs = []
+        self.preds = []
+        self.cold = False
+
+    def __repr__(self):
+        return "B{}".format(self.id)
+
+
+class _Function:
+    """The IR of a function, or of the initializer of a global variable.
+    `kind` is 'function', 'main' or 'init', and `blocks` are in the order
+    they are laid out in, the entry block first
+    """
+    __slots__ = ('sym', 'label', 'kind', 'blocks', 'temps', 'block_count')
+
+    def __init__(self, sym, label, kind):
+        self.sym = sym
+        self.label = label
+        self.kind = kind
+        self.blocks = []
+        self.temps = 0
+        self.block_count = 0
+
+
+def _new_temp(fn, name=None):
+    fn.temps += 1
+    return _Temp(fn.temps, name)
+
+
+def _new_block(fn):
+    """Return a new block of `fn`. It only joins the layout once something
+    places it there (see `_start`)
+    """
+    fn.block_count += 1
+    return _Block(fn.block_count)
+
+
+#################################################
+# Instruction Analysis                          #
+#################################################
+
+def _operands(ins):
+    """Return the operands `ins` reads, temporaries and constants
+    """
+    if ins.op == 'call':
+        return ins.args[1]
+    a = ins.args
+    return [a[k] for k in _OPERANDS.get(ins.op, ()) if a[k] is not None]
+
+
+def _uses(ins):
+    """Return the temporaries `ins` reads
+    """
+    return [x for x in _operands(ins) if isinstance(x, _Temp)]
+
+
+def _map_operands(ins, f):
+    """Replace each operand x of `ins` by f(x), in place. Return whether any
+    of them changed
+    """
+    if ins.op == 'call':
+        func, args = ins.args
+        new = tuple(f(x) for x in args)
+        changed = any(x is not y for x, y in zip(args, new))
+        ins.args = func, new
+        return changed
+    positions = _OPERANDS.get(ins.op)
+    if positions is None:
+        return False
+    args = list(ins.args)
+    changed = False
+    for k in positions:
+        if args[k] is not None:
+            x = f(args[k])
+            if x is not args[k]:
+                args[k] = x
+                changed = True
+    ins.args = tuple(args)
+    return changed
+
+
+def _targets(ins):
+    """Return the blocks the terminator `ins` can go to
+    """
+    if ins.op == 'jump':
+        return [ins.args[0]]
+    if ins.op == 'branch':
+        return [ins.args[3], ins.args[4]]
+    return []
+
+
+def _retarget(ins, old, new):
+    """Make the terminator `ins` go to block `new` wherever it went to `old`
+    """
+    if ins.op == 'jump':
+        ins.args = (new,)
+    elif ins.op == 'branch':
+        op, a, b, then, else_ = ins.args
+        ins.args = (op, a, b, new if then is old else then,
+                    new if else_ is old else else_)
+
+
+def _link(fn):
+    """Recompute the successors and predecessors of the blocks of `fn` and
+    drop the blocks that can't be reached from its entry. Return the number
+    of instructions dropped with them
+    """
+    for block in fn.blocks:
+        block.preds = []
+    seen = {fn.blocks[0]}
+    stack = [fn.blocks[0]]
+    while stack:
+        block = stack.pop()
+        block.succs = []
+        for succ in _targets(block.instrs[-1]):
+            if succ not in block.succs:
+                block.succs.append(succ)
+                succ.preds.append(block)
+            if succ not in seen:
+                seen.add(succ)
+                stack.append(succ)
+    dropped = sum(len(b.instrs) for b in fn.blocks if b not in seen)
+    fn.blocks = [b for b in fn.blocks if b in seen]
+    return dropped
+
+
+#################################################
+# Building                                      #
+#################################################
+
+class _Builder:
+    """Where the IR of the function being built is going: `block` is the
+    block instructions are added to and `temps` the temporary of each local.
+    `moved` holds the runs of blocks to lay out after the rest
+    """
+    __slots__ = ('fn', 'block', 'temps', 'opts', 'profile', 'moved', 'line')
+
+    def __init__(self, fn, opts, profile=None):
+        self.fn = fn
+        self.block = None
+        self.temps = {}
+        self.opts = opts
+        self.profile = profile
+        self.moved = []
+        self.line = None
+
+
+def _build_function(fdef, opts, profile=None):
+    """Return the IR of the function `fdef`, not yet linked (see `_link`).
+    `opts` is the set of optimizations on, of which only loop-rotate changes
+    how the IR is built, and the bodies of the ifs and whiles that `profile`
+    says seldom run are laid out of line
+    """
+    sym = fdef.func
+    kind = 'main' if sym.label == parser.MAIN_LABEL else 'function'
+    fn = _Function(sym, sym.label, kind)
+    b = _Builder(fn, opts, profile)
+    b.line = fdef.line
+    _start(b, _new_block(fn))
+    for i, param in enumerate(sym.params):
+        temp = _new_temp(fn, param.name)
+        b.temps[param] = temp
+        _emit(b, 'param', temp, (i,))
+    _statements(b, fdef.body)
+    # Falling off the end of the body is the same as a bare `return`
+    _emit(b, 'ret', None, (None,))
+    for blocks in b.moved:
+        for block in blocks:
+            block.cold = True
+        fn.blocks.extend(blocks)
+    return fn
+
+
+def _build_init(decl, opts):
+    """Return the IR of the code that initializes the global `decl`, not yet
+    linked
+    """
+    fn = _Function(decl.var, decl.var.label, 'init')
+    b = _Builder(fn, opts)
+    b.line = decl.line
+    _start(b, _new_block(fn))
+    value = _expression(b, decl.value)
+    _emit(b, 'store', None, (value, 0, decl.var.label))
+    _emit(b, 'ret', None, (None,))
+    return fn
+
+
+def _emit(b, op, dst, args):
+    b.block.instrs.append(_Ins(op, dst, args, b.line))
+
+
+def _start(b, block):
+    """Lay out `block` next and add instructions to it from now on
+    """
+    b.fn.blocks.append(block)
+    b.block = block
+
+
+def _jump(b, block):
+    _emit(b, 'jump', None, (block,))
+
+
+def _statements(b, body):
+    for stmt in body:
+        b.line = stmt.line
+        if isinstance(stmt, syntax._VarDecl):
+            temp = _new_temp(b.fn, stmt.var.name)
+            b.temps[stmt.var] = temp
+            if stmt.value is not None:
+                _expression(b, stmt.value, temp)
+        elif isinstance(stmt, syntax._Assign):
+            _assign(b, stmt.var, stmt.value)
+        elif isinstance(stmt, syntax._Store):
+            addr = _expression(b, stmt.addr)
+            value = _expression(b, stmt.value)
+            _emit(b, 'store', None, (value, addr, 0))
+        elif isinstance(stmt, syntax._CallStmt):
+            _call(b, stmt.call, None)
+        elif isinstance(stmt, syntax._If):
+            then, after = _new_block(b.fn), _new_block(b.fn)
+            _condition(b, stmt.cond, then, after)
+            first = len(b.fn.blocks)
+            _start(b, then)
+            _statements(b, stmt.body)
+            _jump(b, after)
+            if _cold(b, 'branch', stmt):
+                _move_out_of_line(b, first)
+            _start(b, after)
+        elif isinstance(stmt, syntax._While):
+            _while(b, stmt)
+        elif isinstance(stmt, syntax._Return):
+            value = None
+            if stmt.value is not None:
+                value = _expression(b, stmt.value)
+            _emit(b, 'ret', None, (value,))
+            # Whatever follows in the block can never run
+            _start(b, _new_block(b.fn))
+
+
+def _assign(b, var, value):
+    if isinstance(var, syntax._Global):
+        _emit(b, 'store', None, (_expression(b, value), 0, var.label))
+    else:
+        _expression(b, value, b.temps[var])
+
+
+def _while(b, stmt):
+    body, exit = _new_block(b.fn), _new_block(b.fn)
+    line = b.line
+    if 'loop-rotate' in b.opts:
+        # `if (cond) { do { body } while (cond) }`, so each time around only
+        # runs the test at the bottom
+        _condition(b, stmt.cond, body, exit)
+        first = len(b.fn.blocks)
+        _start(b, body)
+        _statements(b, stmt.body)
+        b.line = line
+        _condition(b, stmt.cond, body, exit)
+    else:
+        head = _new_block(b.fn)
+        _jump(b, head)
+        _start(b, head)
+        _condition(b, stmt.cond, body, exit)
+        first = len(b.fn.blocks)
+        _start(b, body)
+        _statements(b, stmt.body)
+        _jump(b, head)
+    if _cold(b, 'loop', stmt):
+        _move_out_of_line(b, first)
+    _start(b, exit)
+
+
+def _cold(b, kind, stmt):
+    return b.profile is not None and pgo._cold(b.profile, kind,
+                                               b.fn.sym.name, stmt.line)
+
+
+def _move_out_of_line(b, first):
+    """Lay out the blocks from index `first` on after the rest of the
+    function
+    """
+    b.moved.append(b.fn.blocks[first:])
+    del b.fn.blocks[first:]
+
+
+def _condition(b, node, then, else_):
+    """End the current block by going to `then` if `node` is true and to
+    `else_` if it is false. && and || skip their right operand when the left
+    one decides
+    """
+    if isinstance(node, syntax._Binary) and node.op in ('&&', '||'):
+        right = _new_block(b.fn)
+        if node.op == '&&':
+            _condition(b, node.left, right, else_)
+        else:
+            _condition(b, node.left, then, right)
+        _start(b, right)
+        _condition(b, node.right, then, else_)
+    elif isinstance(node, syntax._Unary) and node.op == '!':
+        _condition(b, node.operand, else_, then)
+    elif isinstance(node, syntax._Binary) and node.op in _RELATIONS:
+        a = _expression(b, node.left)
+        c = _expression(b, node.right)
+        _emit(b, 'branch', None, (node.op, a, c, then, else_))
+    elif isinstance(node, syntax._Num):
+        _jump(b, then if node.value != 0 else else_)
+    else:
+        _emit(b, 'branch', None, ('!=', _expression(b, node), 0, then,
+                                  else_))
+
+
+def _expression(b, node, dst=None):
+    """Add the instructions computing `node` and return its operand: a
+    temporary or a constant. If `dst` is given the value is computed into it
+    """
+    if isinstance(node, syntax._Num):
+        return _result(b, dst, node.value)
+    if isinstance(node, syntax._Var):
+        if isinstance(node.var, syntax._Global):
+            dst = dst if dst is not None else _new_temp(b.fn)
+            _emit(b, 'load', dst, (0, node.var.label))
+            return dst
+        return _result(b, dst, b.temps[node.var])
+    if isinstance(node, syntax._Call):
+        dst = dst if dst is not None else _new_temp(b.fn)
+        _call(b, node, dst)
+        return dst
+    if isinstance(node, syntax._Load):
+        addr = _expression(b, node.addr)
+        dst = dst if dst is not None else _new_temp(b.fn)
+        _emit(b, 'load', dst, (addr, 0))
+        return dst
+    if isinstance(node, syntax._Unary):
+        a = _expression(b, node.operand)
+        dst = dst if dst is not None else _new_temp(b.fn)
+        if node.op == '-':
+            _emit(b, 'neg', dst, (a,))
+        elif node.op == '~':
+            _emit(b, 'not', dst, (a,))
+        else:
+            _emit(b, 'bin', dst, ('==', a, 0))
+        return dst
+    if node.op in ('&&', '||'):
+        # -1 when true and 0 when false
+        dst = dst if dst is not None else _new_temp(b.fn)
+        true, false, end = _new_block(b.fn), _new_block(b.fn), \
+            _new_block(b.fn)
+        _condition(b, node, true, false)
+        _start(b, true)
+        _emit(b, 'copy', dst, (-1,))
+        _jump(b, end)
+        _start(b, false)
+        _emit(b, 'copy', dst, (0,))
+        _jump(b, end)
+        _start(b, end)
+        return dst
+    a = _expression(b, node.left)
+    c = _expression(b, node.right)
+    dst = dst if dst is not None else _new_temp(b.fn)
+    _emit(b, 'bin', dst, (node.op, a, c))
+    return dst
+
+
+def _result(b, dst, value):
+    """Return the operand `value`, copied into `dst` if that is given
+    """
+    if dst is None or dst is value:
+        return value
+    _emit(b, 'copy', dst, (value,))
+    return dst
+
+
+def _call(b, node, dst):
+    args = tuple(_expression(b, arg) for arg in node.args)
+    _emit(b, 'call', dst, (node.func, args))
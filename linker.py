@@ -0,0 +1,295 @@
+"""Separate compilation. A source file compiled as an object can be linked
+into any number of programs without being compiled again, and a source can
+use the functions and global variables of the objects it is compiled with
+(see `_declare`) as if it had declared them itself. A file without a main
+is a module, all of whose functions are kept for the programs it may be
+linked into.
+
+An object is the program of one compilation, cut in three: `init`, the code
+of the initializers of its globals that can't be worked out when compiling,
+`code`, its functions, and `data`, the words of its globals. Its labels are
+all its own, and each operand that refers to one has a relocation entry.
+The functions and globals it defines are its exports, and the labels it
+gave to those of other objects its imports:
+
+    {'version': 2, 'init': [instruction], 'code': [instruction],
+     'data': [instruction], 'functions': [[name, label]],
+     'exports': {'functions': {name: {'label': label, 'params': n,
+                                      'frame': bool}},
+                 'globals': {name: label}},
+     'imports': {'functions': {label: name}, 'globals': {label: name}},
+     'relocations': {'init': [[index, operand, label]],
+                     'code': [[index, operand, label]]}}
+
+Object files hold it as JSON, with the instructions as lines of assembly
+(see `assembler`). `_link` gives every label of every object a new name,
+points the imports at the exports they name, lays out the initializers of
+all the objects ahead of the jump to main, their functions after it and
+their data after those (see `compiler._data_section`), and drops the
+functions no program code can reach (see `callgraph`).
+"""
+
+import json
+
+import assembler
+import callgraph
+import codegen
+import compiler
+import error
+import parser
+import syntax
+
+_VERSION = 2
+_PARTS = ('init', 'code', 'data')
+_DIGITS = "0123456789"
+
+
+class _Image:
+    """The program being linked, with what `callgraph._prune` needs of a
+    compilation context
+    """
+    __slots__ = ('out', 'functions', 'unreachable', 'report', 'line',
+                 'label_count')
+
+    def __init__(self):
+        self.out = []
+        self.functions = []
+        self.unreachable = 0
+        self.report = []
+        self.line = None
+        self.label_count = 0
+
+
+def _load(f):
+    """Return the object read from the text file object `f`. Raises
+    `error.LinkError` if it isn't one
+    """
+    try:
+        obj = json.load(f)
+        if obj.get('version') != _VERSION:
+            error._link_error("Unsupported object version {}".format(
+                obj.get('version')))
+        for part in _PARTS:
+            obj[part] = assembler._parse("\n".join(obj[part]))
+    except (ValueError, KeyError, AttributeError,
+            error.AssemblyError) as e:
+        error._link_error("Bad object file: {}".format(e))
+    return obj
+
+
+def _dumps(obj):
+    """Return the text of the object file of `obj`
+    """
+    text = dict(obj)
+    for part in _PARTS:
+        text[part] = [str(ins) for ins in obj[part]]
+    return json.dumps(text, indent=1, sort_keys=True) + "\n"
+
+
+#################################################
+# Compiling                                     #
+#################################################
+
+def _declare(ctx, objects):
+    """Add the exports of `objects` to the global symbol table of `ctx`,
+    under labels of its own
+    """
+    for obj in objects:
+        exports = obj['exports']
+        for name, f in sorted(exports['functions'].items()):
+            _check_new(ctx, name, "function")
+            label = "{}_{}{}".format(parser.FUNCTION_PREFIX, name,
+                                     parser._next_label(ctx))
+            if 'ir' in ctx.opts:
+                entry = syntax._Function(name)
+                entry.label = label
+                entry.params = [syntax._Local("p{}".format(i))
+                                for i in range(f['params'])]
+                entry.entry['frame'] = f['frame']
+            else:
+                entry = {'type': 'function', 'num_param': f['params'],
+                         'offset': label, 'base': codegen.ZERO,
+                         'frame': f['frame']}
+            ctx.symtab[0][name] = entry
+        for name in sorted(exports['globals']):
+            _check_new(ctx, name, "variable")
+            label = parser.GLOBAL_PREFIX + str(parser._next_label(ctx))
+            ctx.symtab[0][name] = syntax._Global(name, label) \
+                if 'ir' in ctx.opts else \
+                {'type': 'global_var', 'offset': label, 'base': codegen.ZERO}
+
+
+def _check_new(ctx, name, kind):
+    if name in ctx.symtab[0]:
+        error._error("Duplicate symbol {}: {}".format(kind, name))
+
+
+def _symbol(entry):
+    """Return (kind, label, parameters, whether it has a frame) of the
+    global symbol table entry `entry` of either parser
+    """
+    if isinstance(entry, dict):
+        if entry['type'] == 'function':
+            return 'functions', entry['offset'], entry['num_param'], \
+                entry.get('frame', True)
+        return 'globals', entry['offset'], None, None
+    if isinstance(entry, syntax._Function):
+        return 'functions', entry.label, len(entry.params), \
+            entry.entry.get('frame', True)
+    return 'globals', entry.label, None, None
+
+
+def _object(ctx, objects=()):
+    """Return the object of the last program compiled by `ctx`, which was
+    compiled with the exports of `objects` declared
+    """
+    out = ctx.out
+    # The jump to main ends the initializers, after the two instructions
+    # setting up the stack (see `compiler._prolog`)
+    jump = next(k for k in range(len(out) - 1)
+                if out[k].op == codegen.LAR and
+                out[k].args == (codegen.PRIMARY, parser.MAIN_LABEL) and
+                out[k + 1].op == codegen.BR)
+    init = out[2:jump]
+    # Up to the data section (see `compiler._data_section`), which is laid
+    # out again when linking
+    end = next((k for k in range(jump + 2, len(out))
+                if out[k].op in codegen._DATA), len(out) - 1)
+    code = out[jump + 2:end]
+    data = [ins for ins in out[end:-1]
+            if ins.op != codegen.DW or ins.args[0] != compiler._PAD_LABEL]
+    relocations = {'init': _relocations(init), 'code': _relocations(code),
+                   'data': []}
+    referenced = {r[2] for part in relocations.values() for r in part}
+    imported = {name for obj in objects
+                for table in obj['exports'].values() for name in table}
+    functions = [(name, label) for name, label, _, _ in ctx.functions]
+    defined = {label for _, label in functions}
+    exports = {'functions': {}, 'globals': {}}
+    imports = {'functions': {}, 'globals': {}}
+    for name, entry in ctx.symtab[0].items():
+        kind, label, params, frame = _symbol(entry)
+        if name in imported:
+            if label in referenced:
+                imports[kind][label] = name
+        elif kind == 'globals':
+            exports[kind][name] = label
+        elif label in defined and label != parser.MAIN_LABEL:
+            exports[kind][name] = {'label': label, 'params': params,
+                                   'frame': frame}
+    return {'version': _VERSION, 'init': init, 'code': code, 'data': data,
+            'functions': functions, 'exports': exports, 'imports': imports,
+            'relocations': relocations}
+
+
+def _relocations(instrs):
+    """Return [index, operand, label] for every operand of `instrs` that
+    refers to a label
+    """
+    return [[k, i, a] for k, ins in enumerate(instrs)
+            if ins.op != codegen.LABEL and ins.op not in codegen._DATA
+            for i, a in enumerate(ins.args)
+            if isinstance(a, str) and a.isidentifier() and
+            not codegen._is_reg(a)]
+
+
+#################################################
+# Linking                                       #
+#################################################
+
+def _link(objects):
+    """Return the assembly of the program made of `objects`, in the order
+    they are given, and lines describing what was dropped. Raises
+    `error.LinkError` if a symbol is defined twice or not at all
+    """
+    image = _Image()
+    renames = []
+    exports = {'functions': {}, 'globals': {}}
+    main = False
+    for obj in objects:
+        rename = {}
+        for ins in obj['init'] + obj['code'] + obj['data']:
+            if ins.op == codegen.LABEL or ins.op in codegen._DATA:
+                label = ins.args[0]
+                if label == parser.MAIN_LABEL:
+                    if main:
+                        error._link_error(
+                            "Duplicate symbol function: " + parser.MAIN)
+                    main = True
+                    rename[label] = label
+                else:
+                    rename[label] = _new_label(image, label)
+        for kind, table in obj['exports'].items():
+            for name, symbol in table.items():
+                if name in exports['functions'] or \
+                        name in exports['globals']:
+                    error._link_error("Duplicate symbol: " + name)
+                label = symbol['label'] if kind == 'functions' else symbol
+                exports[kind][name] = rename[label]
+        renames.append(rename)
+    if not main:
+        error._link_error("No {} function".format(parser.MAIN))
+    for obj, rename in zip(objects, renames):
+        for kind, table in obj['imports'].items():
+            for label, name in table.items():
+                if name not in exports[kind]:
+                    error._link_error("Undefined symbol: " + name)
+                rename[label] = exports[kind][name]
+    compiler._prolog(image)
+    for obj, rename in zip(objects, renames):
+        image.out.extend(_relocate(obj, 'init', rename))
+    codegen._load_primary_address_relative(image, parser.MAIN_LABEL)
+    codegen._br(image, codegen.PRIMARY)
+    for obj, rename in zip(objects, renames):
+        start = len(image.out)
+        image.out.extend(_relocate(obj, 'code', rename))
+        _functions(image, obj, rename, start)
+    callgraph._prune(image)
+    if image.out[-1].op != codegen.STOP:
+        codegen._stop(image)
+    compiler._data_section(image, [ins for obj, rename in zip(objects, renames)
+                                   for ins in _relocate(obj, 'data', rename)])
+    return codegen._format(image.out), image.report
+
+
+def _new_label(image, label):
+    """Return a new label like `label`: the same name, with a number no
+    other label has
+    """
+    image.label_count += 1
+    return label.rstrip(_DIGITS) + str(image.label_count)
+
+
+def _relocate(obj, part, rename):
+    """Return a copy of the instructions of `part` of `obj` with all the
+    labels they define and refer to renamed by `rename`
+    """
+    instrs = [codegen._Instr(ins.op, ins.args, ins.line)
+              for ins in obj[part]]
+    for ins in instrs:
+        if ins.op == codegen.LABEL or ins.op in codegen._DATA:
+            ins.args = (rename[ins.args[0]],) + ins.args[1:]
+    for k, i, label in obj['relocations'][part]:
+        if k >= len(instrs) or i >= len(instrs[k].args) or \
+                instrs[k].args[i] != label:
+            error._link_error("Bad relocation of {}".format(label))
+        if label not in rename:
+            error._link_error("Undefined label: " + label)
+        args = list(instrs[k].args)
+        args[i] = rename[label]
+        instrs[k].args = tuple(args)
+    return instrs
+
+
+def _functions(image, obj, rename, start):
+    """Add the functions of `obj`, whose code starts at `start` in
+    `image.out`, to `image.functions`. Each runs up to the next one, and the
+    last to the end of the code
+    """
+    at = {ins.args[0]: k for k, ins in enumerate(image.out[start:], start)
+          if ins.op == codegen.LABEL}
+    starts = sorted((at[rename[label]], name, rename[label])
+                    for name, label in obj['functions'])
+    ends = [k for k, _, _ in starts[1:]] + [len(image.out)]
+    for (k, name, label), end in zip(starts, ends):
+        image.functions.append((name, label, k, end))
@@ -0,0 +1,201 @@
+"""Loop invariant code motion over the instructions of a function. A loop is
+the code from a label to the last branch back to it. A loop that makes no
+calls leaves every scratch register it never mentions alone, so values that
+can't change while it runs are loaded into those registers once, just
+before the loop, instead of every time around: the addresses of branch
+targets, other `lar` constants, and globals and frame slots the loop never
+stores to.
+
+Code moved out of line (see `parser._move_out_of_line`) is part of every
+loop that branches to it, as it goes back into the loop when it is done.
+"""
+
+import codegen
+
+
+def _function(ctx, start, label, reserved=()):
+    """Hoist the invariants out of the loops of the function whose code is
+    `ctx.out[start:]`, innermost loops first. The registers in `reserved`
+    hold variables, so they are never free
+    """
+    instrs = ctx.out[start:]
+    done = set()
+    loops = hoisted = 0
+    while True:
+        found = [loop for loop in _loops(instrs) if loop[0] not in done]
+        if not found:
+            break
+        # A loop with no other loop inside it
+        head, first, last = min(found, key=lambda x: x[2] - x[1])
+        done.add(head)
+        side = _out_of_line(instrs, first, last, ctx.cold_labels)
+        n = _hoist(instrs, first, last, ctx.live_temps.get(head, 0),
+                   reserved, side)
+        if n:
+            loops += 1
+            hoisted += n
+    ctx.out[start:] = instrs
+    if hoisted:
+        ctx.report.append("loop-hoist: {}: {} values out of {} loops".format(
+            label, hoisted, loops))
+
+
+def _target(instrs, k):
+    """Return the label that the branch at `k` goes to if it is loaded by
+    the `lar` just before it, otherwise None
+    """
+    ins = instrs[k]
+    if ins.op not in codegen._BRANCHES or k == 0:
+        return None
+    prev = instrs[k - 1]
+    if prev.op == codegen.LAR and prev.args[0] == ins.args[0] == \
+            codegen.BRANCH_TARGET:
+        return prev.args[1]
+    return None
+
+
+def _loops(instrs):
+    """Return (label, first, last) for every loop: the label at index `first`
+    that the branch at index `last` goes back to
+    """
+    labels = {}
+    loops = {}
+    for k, ins in enumerate(instrs):
+        if ins.op == codegen.LABEL:
+            labels[ins.args[0]] = k
+            continue
+        target = _target(instrs, k)
+        if target in labels:
+            loops[target] = k
+    return [(head, labels[head], last) for head, last in loops.items()]
+
+
+def _out_of_line(instrs, first, last, heads):
+    """Return the indexes of the out of line code that the loop from `first`
+    to `last` branches to: the code from each label in `heads` up to the
+    next one, or to the end
+    """
+    starts = [k for k, ins in enumerate(instrs)
+              if ins.op == codegen.LABEL and ins.args[0] in heads]
+    if not starts:
+        return []
+    ends = starts[1:] + [len(instrs)]
+    extents = {instrs[k].args[0]: range(k, end)
+               for k, end in zip(starts, ends) if not first <= k <= last}
+    found = []
+    todo = [range(first, last + 1)]
+    while todo:
+        for k in todo.pop():
+            ins = instrs[k]
+            if ins.op == codegen.LAR and ins.args[1] in extents:
+                code = extents.pop(ins.args[1])
+                found.extend(code)
+                todo.append(code)
+    return found
+
+
+def _only_entry(instrs, first, last, side):
+    """Return whether the loop, with the out of line code `side`, can only
+    be entered by falling into its head, so that code put just before the
+    head runs before every entry
+    """
+    side = set(side)
+    labels = {ins.args[0] for ins in instrs[first:last + 1]
+              if ins.op == codegen.LABEL}
+    labels.update(instrs[k].args[0] for k in side
+                  if instrs[k].op == codegen.LABEL)
+    for k, ins in enumerate(instrs):
+        if ins.op == codegen.LAR and ins.args[1] in labels and \
+                not first <= k <= last and k not in side:
+            return False
+    return True
+
+
+def _hoist(instrs, first, last, live, reserved, side=()):
+    """Hoist the invariants of the loop from `first` to `last` in place,
+    leaving alone the first `live` scratch registers, which hold values
+    needed after it, and those in `reserved`, and the registers used by the
+    out of line code `side` it branches to. Return how many values were
+    hoisted
+    """
+    body = instrs[first:last + 1]
+    body.extend(instrs[k] for k in side)
+    used = set(reserved)
+    stored = set()
+    # Whether every store in the loop is to a known global or frame slot,
+    # so loads from the others can't change
+    known_stores = True
+    for ins in body:
+        if ins.op == codegen.BRL:
+            # The callee may use any scratch register
+            return 0
+        used.add(codegen._writes(ins))
+        used.update(codegen._reads(ins))
+        if ins.op == codegen.ST:
+            base = ins.args[2]
+            if (base == codegen.ZERO and isinstance(ins.args[1], str)) or \
+                    base == codegen.BASE:
+                stored.add((ins.args[1], base))
+            elif base != codegen.STACK:
+                known_stores = False
+    free = [r for r in reversed(codegen.TEMPS[live:]) if r not in used]
+    if not free or not _only_entry(instrs, first, last, side):
+        return 0
+    # Count the uses of each invariant value: ('lar', value) is a constant
+    # or address, ('ld', (offset, base)) a load that can't change
+    counts = {}
+    for k in range(first, last + 1):
+        ins = instrs[k]
+        key = _invariant(ins, stored, known_stores)
+        if key is not None:
+            counts[key] = counts.get(key, 0) + 1
+    if not counts:
+        return 0
+    ranked = sorted(counts, key=lambda key: -counts[key])
+    regs = dict(zip(ranked, free))
+    out = []
+    # The loads go with the line of the loop
+    line = instrs[first].line
+    for key, reg in regs.items():
+        kind, value = key
+        if kind == 'lar':
+            out.append(codegen._Instr(codegen.LAR, (reg, value), line))
+        else:
+            out.append(codegen._Instr(codegen.LD, (reg,) + value, line))
+    k = first
+    while k <= last:
+        ins = instrs[k]
+        key = _invariant(ins, stored, known_stores)
+        reg = regs.get(key)
+        if reg is None:
+            out.append(ins)
+        elif ins.op == codegen.LAR and ins.args[0] == \
+                codegen.BRANCH_TARGET and k < last and \
+                _target(instrs, k + 1) is not None:
+            # Branch straight to the register holding the target
+            br = instrs[k + 1]
+            out.append(codegen._Instr(br.op, (reg,) + br.args[1:], br.line))
+            k += 1
+        else:
+            out.append(codegen._Instr(codegen.LA, (ins.args[0], 0, reg),
+                                      ins.line))
+        k += 1
+    # The loads come first, just before the label at the head
+    instrs[first:last + 1] = out
+    return len(regs)
+
+
+def _invariant(ins, stored, known_stores):
+    """Return the key of the invariant value instruction `ins` loads, or
+    None if it doesn't load one
+    """
+    if ins.op == codegen.LAR:
+        return 'lar', ins.args[1]
+    if ins.op == codegen.LD and known_stores:
+        offset, base = ins.args[1], ins.args[2]
+        if (offset, base) in stored:
+            return None
+        if (base == codegen.ZERO and isinstance(offset, str)) or \
+                base == codegen.BASE:
+            return 'ld', (offset, base)
+    return None
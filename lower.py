@@ -0,0 +1,553 @@
+"""Lowering of the IR of a function (see `ir`) to RSRC instructions.
+Temporaries are given registers by coloring the graph of which of them are
+live at the same time, the most used (weighted by how deeply in loops the
+uses are, or by how often the profile says their lines run) first. A
+temporary live across a call can only have a callee save register, and one
+that gets no register lives in a frame slot, loaded into PRIMARY or
+SECONDARY for each use. The frame is laid out as `regalloc` lays
+it out: the return address, the callee save registers used, then the slots.
+"""
+
+import analysis
+import codegen
+import frames
+import ir
+import loops
+import parser
+import pgo
+import regalloc
+import stats
+
+_WORD_BYTES = codegen.WORD // codegen.BYTE
+
+
+class _Lowering:
+    """The function being lowered: the register (`regs`) or frame slot
+    offset (`slots`, from `base`) of each temporary, the callee save
+    registers `saved`, and the label of each block branched to
+    """
+    __slots__ = ('ctx', 'fn', 'regs', 'slots', 'base', 'saved', 'labels',
+                 'end')
+
+    def __init__(self, ctx, fn):
+        self.ctx = ctx
+        self.fn = fn
+        self.regs = {}
+        self.slots = {}
+        self.base = codegen.BASE
+        self.saved = []
+        self.labels = {}
+        self.end = None
+
+
+def _function(ctx, fn, analyses):
+    """Emit the code of `fn`, with `analyses` its `passes._Analyses`. The
+    initializer of a global is emitted inline, and a function is laid out
+    as `parser._function` lays it out
+    """
+    lw = _Lowering(ctx, fn)
+    with stats._phase(ctx, 'regalloc'):
+        lw.regs, spilled = _allocate(fn, analyses,
+                                     pgo._weights(ctx.profile, fn.sym.name))
+    if fn.kind == 'function':
+        lw.saved = sorted({r for r in lw.regs.values()
+                           if r in codegen.CALLEE_SAVE},
+                          key=codegen.CALLEE_SAVE.index)
+    _labels(lw)
+    # The entry code is for the line the function or global is declared on
+    ctx.line = fn.blocks[0].instrs[0].line
+    if fn.kind == 'init':
+        # There is no base pointer before main, so the slots are found from
+        # the stack pointer
+        lw.base = codegen.STACK
+        lw.slots = {t: _WORD_BYTES * (j + 1) for j, t in enumerate(spilled)}
+        _alloc_slots(lw)
+        _blocks(lw)
+        if lw.end is not None:
+            codegen._post_label(ctx, lw.end)
+        if lw.slots:
+            codegen._dealloc_stack(ctx, _WORD_BYTES * len(lw.slots))
+        return
+    # Slots go below the return address and the saved registers
+    lw.slots = {t: -_WORD_BYTES * (2 + len(lw.saved) + j)
+                for j, t in enumerate(spilled)}
+    # Each run of out of line code starts at a block that isn't fallen into
+    ctx.cold_labels.update(
+        lw.labels[block] for k, block in enumerate(fn.blocks)
+        if block.cold and block in lw.labels and
+        not (k and block in fn.blocks[k - 1].succs))
+    codegen._post_label(ctx, fn.label)
+    start = len(ctx.out)
+    codegen._push_ret(ctx)
+    for reg in lw.saved:
+        codegen._push(ctx, reg)
+    _alloc_slots(lw)
+    _blocks(lw)
+    if 'loop-hoist' in ctx.opts:
+        with stats._phase(ctx, 'loop-hoist'):
+            loops._function(ctx, start, fn.label,
+                            sorted(set(lw.regs.values())))
+    if 'omit-frames' in ctx.opts:
+        with stats._phase(ctx, 'omit-frames'):
+            frames._function(ctx, start, fn.label, fn.sym.entry,
+                             fn.kind == 'main')
+    # The label is just before `start`
+    ctx.functions.append((fn.sym.name, fn.label, start - 1, len(ctx.out)))
+    fn.sym.entry['size'] = len(ctx.out) - start
+    ctx.report.append("regalloc: {}: {} temporaries, {} registers{}".format(
+        fn.label, len(lw.regs) + len(spilled), len(set(lw.regs.values())),
+        ", {} spilled".format(len(spilled)) if spilled else ""))
+
+
+def _alloc_slots(lw):
+    if lw.slots:
+        codegen._alloc_stack(lw.ctx, _WORD_BYTES * len(lw.slots))
+
+
+#################################################
+# Register Allocation                           #
+#################################################
+
+def _allocate(fn, analyses, lines=None):
+    """Return (regs, spilled): a dict from the temporaries of `fn` to the
+    registers they are given, and the list of those that get none. Each use
+    counts as the weight of its line in `lines`, if given
+    """
+    live_out = analyses.get('liveness')[1]
+    depths = analyses.get('depths')
+    edges = {}
+    weights = {}
+    across = set()
+    partners = {}
+    for block in fn.blocks:
+        weight = regalloc._LOOP_WEIGHT ** min(depths[block],
+                                              regalloc._MAX_DEPTH)
+        for ins, live in analysis._live_across(block, live_out):
+            if lines is not None:
+                weight = lines.get(ins.line, 0)
+            for t in live:
+                edges.setdefault(t, set())
+            for t in ir._uses(ins):
+                edges.setdefault(t, set())
+                weights[t] = weights.get(t, 0) + weight
+            if ins.op == 'call':
+                across.update(t for t in live if t is not ins.dst)
+            dst = ins.dst
+            if dst is None:
+                continue
+            edges.setdefault(dst, set())
+            weights[dst] = weights.get(dst, 0) + weight
+            src = ins.args[0] if ins.op == 'copy' else None
+            if isinstance(src, ir._Temp):
+                # Giving both the same register makes the copy go away
+                partners.setdefault(dst, []).append(src)
+                partners.setdefault(src, []).append(dst)
+            for t in live:
+                if t is not dst and t is not src:
+                    edges[dst].add(t)
+                    edges[t].add(dst)
+    regs = {}
+    spilled = []
+    anywhere = codegen.TEMPS + codegen.CALLEE_SAVE
+    for t in sorted(edges, key=lambda t: (-weights.get(t, 0), t.id)):
+        allowed = codegen.CALLEE_SAVE if t in across else anywhere
+        taken = {regs[n] for n in edges[t] if n in regs}
+        choices = [regs[p] for p in partners.get(t, ()) if p in regs]
+        choices.extend(allowed)
+        reg = next((r for r in choices
+                    if r in allowed and r not in taken), None)
+        if reg is None:
+            spilled.append(t)
+        else:
+            regs[t] = reg
+    return regs, spilled
+
+
+#################################################
+# Operands                                      #
+#################################################
+
+def _read(lw, x, scratch):
+    """Return a register holding the operand `x`, loading it into `scratch`
+    if it isn't in one
+    """
+    if isinstance(x, int):
+        if x == 0:
+            return codegen.ZERO
+        codegen._load_address_relative(lw.ctx, scratch, x)
+        return scratch
+    reg = lw.regs.get(x)
+    if reg is not None:
+        return reg
+    codegen._load(lw.ctx, scratch, lw.slots[x], lw.base)
+    return scratch
+
+
+def _dst(lw, t):
+    """Return the register to compute the temporary `t` into
+    """
+    return lw.regs.get(t, codegen.PRIMARY)
+
+
+def _written(lw, t, reg):
+    """Store the value of `t`, computed into `reg`, to its slot if it has one
+    """
+    if t in lw.slots:
+        codegen._store(lw.ctx, reg, lw.slots[t], lw.base)
+
+
+#################################################
+# Blocks                                        #
+#################################################
+
+def _labels(lw):
+    """Give a label to every block that is branched to rather than only
+    fallen into
+    """
+    blocks = lw.fn.blocks
+    for k, block in enumerate(blocks):
+        nxt = blocks[k + 1] if k + 1 < len(blocks) else None
+        for _, target in _exits(block.instrs[-1], nxt):
+            if target not in lw.labels:
+                lw.labels[target] = parser.LABEL_PREFIX + \
+                    str(parser._next_label(lw.ctx))
+
+
+def _exits(ins, nxt):
+    """Return how the terminator `ins` leaves its block when `nxt` is laid
+    out after it: a list of ('true', block) for a branch taken when its
+    condition holds, ('false', block) for one taken when it doesn't and
+    ('jump', block) for an unconditional one
+    """
+    if ins.op == 'jump':
+        return [] if ins.args[0] is nxt else [('jump', ins.args[0])]
+    if ins.op != 'branch':
+        return []
+    op, a, b, then, else_ = ins.args
+    if isinstance(a, int) and isinstance(b, int):
+        target = then if codegen._fold_cmp(a, b, op) != 0 else else_
+        return [] if target is nxt else [('jump', target)]
+    if else_ is nxt:
+        return [('true', then)]
+    if then is nxt:
+        return [('false', else_)]
+    return [('true', then), ('jump', else_)]
+
+
+def _blocks(lw):
+    ctx = lw.ctx
+    blocks = lw.fn.blocks
+    for k, block in enumerate(blocks):
+        nxt = blocks[k + 1] if k + 1 < len(blocks) else None
+        if block in lw.labels:
+            codegen._post_label(ctx, lw.labels[block])
+        instrs = block.instrs
+        tail = _tail_callee(lw, block)
+        for ins in instrs[:-2 if tail is not None else -1]:
+            ctx.line = ins.line
+            _instruction(lw, ins)
+        if tail is not None:
+            ctx.line = instrs[-2].line
+            _tail_call(lw, instrs[-2])
+            continue
+        term = instrs[-1]
+        ctx.line = term.line
+        if term.op == 'ret':
+            _return(lw, term, nxt is None)
+            continue
+        exits = _exits(term, nxt)
+        if exits and exits[0][0] != 'jump':
+            reg, op = _test(lw, *term.args[:3])
+            branches = parser._true_branches if exits[0][0] == 'true' \
+                else parser._false_branches
+            codegen._load_branch_address_relative(ctx, lw.labels[exits[0][1]])
+            branches[op](ctx, codegen.BRANCH_TARGET, reg)
+            exits = exits[1:]
+        for _, target in exits:
+            codegen._load_branch_address_relative(ctx, lw.labels[target])
+            codegen._br_def(ctx)
+
+
+#################################################
+# Instructions                                  #
+#################################################
+
+def _instruction(lw, ins):
+    ctx = lw.ctx
+    op, dst, a = ins.op, ins.dst, ins.args
+    if op == 'store':
+        value = _read(lw, a[0], codegen.PRIMARY)
+        base, offset = _address(lw, a[1], a[2], codegen.SECONDARY)
+        codegen._store(ctx, value, offset, base)
+        return
+    if op == 'call':
+        _call(lw, ins)
+        return
+    rd = _dst(lw, dst)
+    if op == 'param':
+        codegen._load(ctx, rd, _WORD_BYTES * (a[0] + 1), codegen.BASE)
+    elif op == 'copy':
+        if isinstance(a[0], int):
+            codegen._load_address_relative(ctx, rd, a[0])
+        else:
+            rs = _read(lw, a[0], rd)
+            if rs != rd:
+                codegen._load_address(ctx, rd, rs, 0)
+    elif op == 'bin':
+        _binary(lw, rd, *a)
+    elif op == 'neg' or op == 'not':
+        if isinstance(a[0], int):
+            value = codegen._wrap(-a[0]) if op == 'neg' else ~a[0]
+            codegen._load_address_relative(ctx, rd, value)
+        elif op == 'neg':
+            codegen._neg(ctx, rd, _read(lw, a[0], codegen.PRIMARY))
+        else:
+            codegen._bitwise_not(ctx, rd, _read(lw, a[0], codegen.PRIMARY))
+    elif op == 'load':
+        base, offset = _address(lw, a[0], a[1], codegen.PRIMARY)
+        codegen._load(ctx, rd, offset, base)
+    _written(lw, dst, rd)
+
+
+def _address(lw, base, offset, scratch):
+    """Return (register, offset) to load from or store to `base + offset`
+    """
+    if isinstance(offset, str):
+        return codegen.ZERO, offset
+    if isinstance(base, int):
+        if codegen._fits_imm(base + offset):
+            return codegen.ZERO, base + offset
+        codegen._load_address_relative(lw.ctx, scratch, base)
+        return scratch, offset
+    return _read(lw, base, scratch), offset
+
+
+def _binary(lw, rd, op, x, y):
+    """Emit `rd <- x op y`, with the same result the direct code generator
+    gives op
+    """
+    ctx = lw.ctx
+    if isinstance(x, int) and isinstance(y, int):
+        value = codegen._fold(op, x, y)
+        if value is not None:
+            codegen._load_address_relative(ctx, rd, value)
+            return
+    if op in ir._RELATIONS:
+        codegen._cmp_diff(ctx, rd, _difference(lw, rd, x, y), op)
+        return
+    const_left = isinstance(x, int)
+    if const_left != isinstance(y, int):
+        c, t = (x, y) if const_left else (y, x)
+        if _has_const_form(lw, op, c, const_left):
+            _binary_const(lw, rd, op, _read(lw, t, codegen.PRIMARY), c,
+                          const_left)
+            return
+    ra = _read(lw, x, codegen.PRIMARY)
+    rb = _read(lw, y, codegen.SECONDARY)
+    if op == '+':
+        codegen._add(ctx, rd, ra, rb)
+    elif op == '-':
+        codegen._sub(ctx, rd, ra, rb)
+    elif op == '*':
+        codegen._mul(ctx, rd, ra, rb)
+    elif op == '/':
+        codegen._div(ctx, rd, ra, rb)
+    elif op == '<<':
+        codegen._shl(ctx, rd, ra, rb)
+    elif op == '>>':
+        codegen._shra(ctx, rd, ra, rb)
+    elif op == '|':
+        codegen._bitwise_or(ctx, rd, ra, rb)
+    elif op == '&':
+        codegen._bitwise_and(ctx, rd, ra, rb)
+
+
+def _has_const_form(lw, op, c, const_left):
+    """Return whether `_binary_const` has a shorter form for op with the
+    constant operand c
+    """
+    strength = 'strength' in lw.ctx.opts
+    if op == '+':
+        return codegen._fits_imm(c)
+    if op == '-':
+        return codegen._fits_imm(c if const_left else -c)
+    if op == '<<' or op == '>>':
+        return not const_left
+    if op == '*':
+        return strength and (c == 0 or codegen._mul_shifts(c) is not None)
+    if op == '/':
+        return strength and not const_left and \
+            codegen._log2(abs(c)) is not None
+    return False
+
+
+def _binary_const(lw, rd, op, reg, c, const_left):
+    """Emit `rd <- reg op c`, or `rd <- c op reg` if `const_left`, for an op
+    `_has_const_form` allows
+    """
+    ctx = lw.ctx
+    if op == '+':
+        codegen._addi(ctx, rd, reg, c)
+    elif op == '-' and not const_left:
+        codegen._addi(ctx, rd, reg, -c)
+    elif op == '-':
+        codegen._neg(ctx, rd, reg)
+        if c:
+            codegen._addi(ctx, rd, rd, c)
+    elif op == '<<':
+        codegen._shift_const(ctx, codegen.SHL, rd, reg, c)
+    elif op == '>>':
+        codegen._shift_const(ctx, codegen.SHRA, rd, reg, c)
+    elif op == '*':
+        codegen._mul_const(ctx, rd, reg, c)
+    else:
+        codegen._div_const(ctx, rd, reg, c)
+
+
+def _difference(lw, rd, x, y):
+    """Emit the wrapped difference x - y, not both constants, and return the
+    register holding it: rd, or the register of x when y is 0
+    """
+    ctx = lw.ctx
+    if isinstance(y, int):
+        rs = _read(lw, x, codegen.PRIMARY)
+        if y == 0:
+            return rs
+        if codegen._fits_imm(-y):
+            codegen._addi(ctx, rd, rs, -y)
+        else:
+            codegen._load_address_relative(ctx, codegen.SECONDARY, y)
+            codegen._sub(ctx, rd, rs, codegen.SECONDARY)
+    elif isinstance(x, int):
+        rs = _read(lw, y, codegen.PRIMARY)
+        if codegen._fits_imm(x):
+            codegen._neg(ctx, rd, rs)
+            if x:
+                codegen._addi(ctx, rd, rd, x)
+        else:
+            codegen._load_address_relative(ctx, codegen.SECONDARY, x)
+            codegen._sub(ctx, rd, codegen.SECONDARY, rs)
+    else:
+        codegen._sub(ctx, rd, _read(lw, x, codegen.PRIMARY),
+                     _read(lw, y, codegen.SECONDARY))
+    return rd
+
+
+def _test(lw, op, x, y):
+    """Emit what the branch on `x op y` tests and return (register, op), op
+    being one that `parser._true_branches` has a branch for
+    """
+    if op in parser._swapped:
+        op = parser._swapped[op]
+        x, y = y, x
+    if (op == '==' or op == '!=') and isinstance(x, int):
+        x, y = y, x
+    return _difference(lw, codegen.PRIMARY, x, y), op
+
+
+#################################################
+# Calls and Returns                             #
+#################################################
+
+def _call(lw, ins):
+    """Emit a call with the calling sequence of `parser._function_call`.
+    Nothing needs saving around it: the temporaries live across it are in
+    callee save registers
+    """
+    ctx = lw.ctx
+    func, args = ins.args
+    size = _WORD_BYTES * len(func.params)
+    codegen._alloc_stack(ctx, size)
+    for i, arg in enumerate(args):
+        codegen._store(ctx, _read(lw, arg, codegen.PRIMARY),
+                       _WORD_BYTES * (i + 1), codegen.STACK)
+    frame = func.entry.get('frame', True)
+    if frame:
+        codegen._push(ctx, codegen.BASE)
+        codegen._load_address(ctx, codegen.BASE, codegen.STACK, _WORD_BYTES)
+    codegen._load_branch_address_relative(ctx, func.label)
+    codegen._brl_def(ctx)
+    if frame:
+        codegen._pop(ctx, codegen.BASE)
+    codegen._dealloc_stack(ctx, size)
+    if ins.dst is not None:
+        rd = _dst(lw, ins.dst)
+        codegen._load_address(ctx, rd, codegen.RETURN_VAL, 0)
+        _written(lw, ins.dst, rd)
+
+
+def _tail_callee(lw, block):
+    """Return the call that ends `block` if it can be made as a jump that
+    reuses our frame, as `parser._tail_callee` decides, otherwise None
+    """
+    fn = lw.fn
+    if 'tail-calls' not in lw.ctx.opts or fn.kind != 'function' or \
+            len(block.instrs) < 2:
+        return None
+    call, ret = block.instrs[-2:]
+    if call.op != 'call' or ret.op != 'ret' or call.dst is None or \
+            ret.args[0] is not call.dst:
+        return None
+    func = call.args[0]
+    if len(func.params) > len(fn.sym.params) or \
+            not func.entry.get('frame', True):
+        return None
+    return call
+
+
+def _tail_call(lw, ins):
+    """Emit a call in tail position as a jump: the arguments are stored over
+    our own parameters and the callee returns straight to our caller
+    """
+    ctx = lw.ctx
+    func, args = ins.args
+    ctx.report.append("tail-calls: {} to {} on line {}".format(
+        lw.fn.sym.name, func.name, ins.line))
+    for i, arg in enumerate(args):
+        codegen._store(ctx, _read(lw, arg, codegen.PRIMARY),
+                       _WORD_BYTES * (i + 1), codegen.BASE)
+    _leave(lw)
+    codegen._pop(ctx, codegen.RETURN)
+    codegen._load_branch_address_relative(ctx, func.label)
+    codegen._br_def(ctx)
+
+
+def _return(lw, ins, last):
+    ctx = lw.ctx
+    kind = lw.fn.kind
+    if kind == 'init':
+        # The code after an initializer is the next one, or the jump to main
+        if not last:
+            if lw.end is None:
+                lw.end = parser.LABEL_PREFIX + str(parser._next_label(ctx))
+            codegen._load_branch_address_relative(ctx, lw.end)
+            codegen._br_def(ctx)
+        return
+    value = ins.args[0]
+    if isinstance(value, int):
+        codegen._load_address_relative(ctx, codegen.RETURN_VAL, value)
+    elif value is not None:
+        rs = _read(lw, value, codegen.RETURN_VAL)
+        if rs != codegen.RETURN_VAL:
+            codegen._load_address(ctx, codegen.RETURN_VAL, rs, 0)
+    if kind == 'main':
+        # main is jumped to rather than called, so leaving it ends the program
+        codegen._stop(ctx)
+        return
+    _leave(lw)
+    codegen._pop(ctx, codegen.BRANCH_TARGET)
+    codegen._br_def(ctx)
+
+
+def _leave(lw):
+    """Emit the code that frees the slots and restores the saved registers,
+    leaving the return address on top of the stack
+    """
+    ctx = lw.ctx
+    if lw.slots:
+        codegen._dealloc_stack(ctx, _WORD_BYTES * len(lw.slots))
+    for n, reg in enumerate(lw.saved):
+        codegen._load(ctx, reg, regalloc._RETURN_ADDR - _WORD_BYTES * (n + 1),
+                      codegen.BASE)
+    if lw.saved:
+        codegen._dealloc_stack(ctx, _WORD_BYTES * len(lw.saved))
@@ -1,39 +1,360 @@
-import parser
-import scanner
-import codegen
+import batch
+import compiler
+import assembler
+import encoder
+import error
+import linker
+import pgo
+import profiler
+import simulator
+import stats
 import argparse
+import glob
+import json
+import os
+import sys
 
 
 def main():
     p = argparse.ArgumentParser(
         description='Compiler or RSRCC that targets the RSRC architecture'
     )
-    p.add_argument("source", type=str, help="source file")
+    p.add_argument("source", type=str, nargs='+',
+                   help="source file, or - to read it from stdin. Several "
+                   + "files, directories or glob patterns compile them all "
+                   + "in batch mode")
+    p.add_argument("-o", dest="output", type=str, default=None,
+                   help="output assembly file (default: stdout), or the "
+                   + "output directory in batch mode (default: next to "
+                   + "each source)")
+    p.add_argument("--image", metavar="FILE",
+                   help="also write the machine code of the program as a "
+                   + "memory image to FILE")
+    p.add_argument("--image-format", choices=('bin', 'hex'), default='bin',
+                   help="format of the --image: flat big endian binary, or "
+                   + "text with one word in hex a line (default: bin)")
+    p.add_argument("-c", dest="object", action="store_true",
+                   help="compile to a relocatable object file for linking "
+                   + "later instead of a program. Without a main function "
+                   + "the source is a module, whose functions are all kept")
+    p.add_argument("-l", dest="objects", action="append", default=[],
+                   metavar="OBJECT",
+                   help="object file whose functions and global variables "
+                   + "the source can use, linked into the program unless "
+                   + "-c")
+    p.add_argument("--link", action="store_true",
+                   help="link the object files given as sources into a "
+                   + "program")
+    p.add_argument("-O", dest="opt_level", type=int, default=0,
+                   help="optimization level, e.g. -O1 (default: 0)")
+    p.add_argument("-f", dest="flags", action="append", default=[],
+                   metavar="[no-]NAME",
+                   choices=compiler.OPTIMIZATIONS + tuple(
+                       "no-" + o for o in compiler.OPTIMIZATIONS),
+                   help="turn one optimization on, or off with no-, on top "
+                   + "of the -O level, e.g. -fno-reg-exprs. One of: "
+                   + ", ".join(compiler.OPTIMIZATIONS))
+    p.add_argument("--peephole-window", type=int, default=None,
+                   help="most instructions the peephole optimizer looks at "
+                   + "between a push and its pop")
+    p.add_argument("--inline-threshold", type=int, default=None,
+                   help="most instructions a function called from more than "
+                   + "one place can compile to and still be inlined "
+                   + "(default: 24)")
+    p.add_argument("--opt-report", action="store_true",
+                   help="print what the optimizers did to stderr")
+    p.add_argument("--stats", action="store_true",
+                   help="print how long each phase of the compiler took, "
+                   + "what it counted and its peak memory to stderr")
+    p.add_argument("--time-phases", action="store_true",
+                   help="print how long each phase of the compiler took to "
+                   + "stderr")
+    p.add_argument("--stats-json", type=str, default=None, metavar="FILE",
+                   help="write the statistics of --stats as JSON to FILE, "
+                   + "or - for stderr")
+    p.add_argument("--run", action="store_true",
+                   help="run the compiled program in the simulator and "
+                   + "print what it executed to stderr")
+    p.add_argument("--profile", action="store_true",
+                   help="run the compiled program and print its flat, call "
+                   + "graph, line and basic block profiles to stderr")
+    p.add_argument("--annotate", type=str, default=None, metavar="FILE",
+                   help="run the compiled program and write its assembly "
+                   + "annotated with how often each instruction ran to "
+                   + "FILE, or - for stderr")
+    p.add_argument("--profile-generate", type=str, default=None,
+                   metavar="FILE",
+                   help="compile the program to count how often its "
+                   + "functions, ifs and whiles run, run it and write the "
+                   + "counts to FILE for --profile-use")
+    p.add_argument("--profile-use", type=str, default=None, metavar="FILE",
+                   help="optimize with the counts --profile-generate wrote "
+                   + "to FILE: inline only the calls that run often, move "
+                   + "the ifs and whiles that seldom run out of line and "
+                   + "give registers to the variables of the lines that "
+                   + "run the most")
+    p.add_argument("--max-steps", type=int, default=None,
+                   help="most instructions --run executes before giving up "
+                   + "(default: 100000000)")
+    p.add_argument("-j", "--jobs", type=int, default=None,
+                   help="worker processes in batch mode (default: one per "
+                   + "CPU)")
+    p.add_argument("--cache-dir", type=str, default=None,
+                   help="batch mode output cache directory (default: "
+                   + "$XDG_CACHE_HOME/rsrcc)")
+    p.add_argument("--cache-size", type=int, default=None,
+                   help="batch mode cache size limit in MiB (default: 64)")
+    p.add_argument("--no-cache", action="store_true",
+                   help="don't use the batch mode output cache")
     args = p.parse_args()
+    if (args.object or args.objects or args.link) and (
+            args.profile or args.annotate is not None or
+            args.profile_generate is not None):
+        print("Can't profile objects or linked programs")
+        sys.exit(1)
+    if args.object and (args.run or args.link or args.image is not None):
+        print("Can't run, link or make an image of the object being "
+              "compiled")
+        sys.exit(1)
+    if args.link:
+        _link(args)
+    elif len(args.source) > 1 or os.path.isdir(args.source[0]) \
+            or glob.has_magic(args.source[0]):
+        _batch(args)
+    else:
+        profile = None
+        if args.profile_use is not None:
+            try:
+                with open(args.profile_use) as f:
+                    profile = pgo._load(f)
+            except (IOError, ValueError) as e:
+                print(e)
+                print("Couldn't read profile {}".format(args.profile_use))
+                sys.exit(1)
+        _single(args, args.source[0], profile, _objects(args.objects))
+
+
+def _options(args):
+    """Keyword arguments for `compiler.Compiler` from the command line
+    """
+    return {'opt_level': args.opt_level,
+            'flags': tuple(args.flags),
+            'peephole_window': args.peephole_window,
+            'inline_threshold': args.inline_threshold}
+
+
+def _objects(paths):
+    """Return the `linker` objects read from the files `paths`
+    """
+    objects = []
+    for path in paths:
+        try:
+            with open(path) as f:
+                objects.append(linker._load(f))
+        except IOError as e:
+            print(e)
+            print("Couldn't open file {}".format(path))
+            sys.exit(1)
+        except error.LinkError as e:
+            print("{}: {}".format(path, e))
+            sys.exit(1)
+    return objects
+
+
+def _single(args, source, profile=None, objects=()):
+    c = compiler.Compiler(profile_generate=args.profile_generate is not None,
+                          profile_use=profile, keep_stats=_keep_stats(args),
+                          **_options(args))
+    try:
+        if source == '-':
+            asm = c.compile_file(sys.stdin.buffer, objects)
+        else:
+            with open(source, "rb") as f:
+                asm = c.compile_file(f, objects)
+    except IOError as e:
+        print(e)
+        print("Couldn't open file {}".format(source))
+        return
+    except error.CompileError as e:
+        print(e)
+        sys.exit()
+    report = c.report
+    if args.object:
+        asm = linker._dumps(linker._object(c, objects))
+    elif objects:
+        try:
+            asm, linked = linker._link(objects + [linker._object(c, objects)])
+        except error.LinkError as e:
+            print(e)
+            sys.exit(1)
+        report = report + linked
+    if args.opt_report:
+        for line in report:
+            print(line, file=sys.stderr)
+    if _keep_stats(args):
+        _stats(args, c.statistics())
+    _write(args, asm)
+    if args.image is not None:
+        _image(args, assembler._parse(asm) if objects else c.out)
+    if args.run or args.profile or args.annotate is not None or \
+            args.profile_generate is not None:
+        _run(args, asm, c, source)
+
+
+def _link(args):
+    try:
+        asm, report = linker._link(_objects(args.source))
+    except error.LinkError as e:
+        print(e)
+        sys.exit(1)
+    if args.opt_report:
+        for line in report:
+            print(line, file=sys.stderr)
+    _write(args, asm)
+    if args.image is not None:
+        _image(args, assembler._parse(asm))
+    if args.run:
+        _run(args, asm, None, None)
+
+
+def _write(args, text):
+    output = args.output if args.output is not None else '-'
     try:
-        with open(args.source, "rb") as f:
-            _prolog()
-            _init(f)
-            parser._program(f)
-            _epilog()
+        if output == '-':
+            sys.stdout.write(text)
+        else:
+            with open(output, "w") as f:
+                f.write(text)
     except IOError as e:
         print(e)
-        print("Couldn't open file {}".format(args.source))
+        print("Couldn't write file {}".format(output))
 
 
-def _init(f):
-    scanner._nchar = f.read(1).decode("utf-8")
+def _image(args, instrs):
+    """Write the memory image of the program `instrs` to the file of
+    --image
+    """
+    try:
+        image = encoder._encode(instrs)
+    except error.AssemblyError as e:
+        print(e)
+        sys.exit(1)
+    binary = args.image_format == 'bin'
+    try:
+        with open(args.image, "wb" if binary else "w") as f:
+            f.write(encoder._binary(image) if binary
+                    else encoder._hex(image))
+    except IOError as e:
+        print(e)
+        print("Couldn't write file {}".format(args.image))
+
+
+def _keep_stats(args):
+    return args.stats or args.time_phases or args.stats_json is not None
+
 
+def _stats(args, s):
+    if args.stats:
+        sys.stderr.write(stats._format(s))
+    elif args.time_phases:
+        sys.stderr.write(stats._format_phases(s))
+    if args.stats_json is not None:
+        text = json.dumps(s, indent=2, sort_keys=True) + "\n"
+        try:
+            if args.stats_json == '-':
+                sys.stderr.write(text)
+            else:
+                with open(args.stats_json, "w") as f:
+                    f.write(text)
+        except IOError as e:
+            print(e)
+            print("Couldn't write file {}".format(args.stats_json))
 
-def _prolog():
-    # Initialize stack pointer and base pointer
-    codegen._load_address_relative(codegen.STACK, 0xFFF8)
-    codegen._load_address_relative(codegen.BASE, 0xFFFC)
+
+def _run(args, asm, c, source):
+    profiling = args.profile or args.annotate is not None
+    try:
+        result = simulator.run(asm, max_steps=args.max_steps,
+                               profile=profiling)
+    except (error.AssemblyError, error.SimulationError) as e:
+        print(e)
+        sys.exit(1)
+    stats = result.stats()
+    print("run: {instructions} instructions, {loads} loads, {stores} stores, "
+          "{cycles} cycles".format(**stats), file=sys.stderr)
+    if args.run:
+        for name, n in sorted(stats['opcodes'].items(), key=lambda x: -x[1]):
+            print("  {}: {}".format(name, n), file=sys.stderr)
+    if args.profile_generate is not None:
+        try:
+            with open(args.profile_generate, "w") as f:
+                pgo._dump(pgo._collect(c, result), f)
+        except IOError as e:
+            print(e)
+            print("Couldn't write file {}".format(args.profile_generate))
+    if not profiling:
+        return
+    prof = profiler.profile(result, c.line_table())
+    lines = _source_lines(source)
+    if args.profile:
+        for text in (prof.format_flat(), prof.format_call_graph(),
+                     prof.format_lines(lines), prof.format_blocks()):
+            sys.stderr.write(text)
+    if args.annotate is not None:
+        text = prof.annotate(lines)
+        try:
+            if args.annotate == '-':
+                sys.stderr.write(text)
+            else:
+                with open(args.annotate, "w") as f:
+                    f.write(text)
+        except IOError as e:
+            print(e)
+            print("Couldn't write file {}".format(args.annotate))
+
+
+def _source_lines(source):
+    """Return the lines of the source file `source` for the profiles, or
+    None if it was read from stdin or can't be read again
+    """
+    if source == '-':
+        return None
+    try:
+        with open(source, "rb") as f:
+            return f.read().decode("utf-8", "replace").splitlines()
+    except IOError:
+        return None
 
 
-def _epilog():
-    print("stop")
-    print("END")
+def _batch(args):
+    if '-' in args.source:
+        print("Can't read stdin in batch mode")
+        sys.exit(1)
+    if args.run or args.profile or args.annotate is not None:
+        print("Can't run programs in batch mode")
+        sys.exit(1)
+    if args.profile_generate is not None or args.profile_use is not None:
+        print("Can't use profiles in batch mode")
+        sys.exit(1)
+    if _keep_stats(args):
+        print("Can't keep statistics in batch mode")
+        sys.exit(1)
+    if args.object or args.objects or args.image is not None:
+        print("Can't compile objects or images in batch mode")
+        sys.exit(1)
+    cache_size = args.cache_size << 20 if args.cache_size is not None \
+        else None
+    try:
+        failed = batch._compile_many(args.source, args.output, args.jobs,
+                                     options=_options(args),
+                                     cache_dir=args.cache_dir,
+                                     cache_size=cache_size,
+                                     use_cache=not args.no_cache)
+    except error.CompileError as e:
+        print(e)
+        sys.exit(1)
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
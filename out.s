@@ -1,7 +1,5 @@
 lar r31, 65528
 lar r30, 65532
-GL0:	.dw	1
-GL1:	.dw	1
 lar r1, MAIN
 br r1
 F_fib2:	
@@ -17,14 +15,13 @@ sub r1, r2, r1
 shra r1, r1, 31
 lar r3, L3
 brzr r3, r1
-addi r31, r31, 0
 ld r1, 4(r30)
 la r19, 0(r1)
+addi r31, r31, 0
 addi r31, r31, 4
 ld r3, 0(r31)
 br r3
 L3:	
-addi r31, r31, 0
 addi r31, r31, -4
 ld r1, 4(r30)
 st r1, 0(r31)
@@ -67,6 +64,7 @@ addi r31, r31, 4
 ld r2, 0(r31)
 add r1, r2, r1
 la r19, 0(r1)
+addi r31, r31, 0
 addi r31, r31, 4
 ld r3, 0(r31)
 br r3
@@ -160,4 +158,6 @@ ld r30, 0(r31)
 addi r31, r31, 8
 addi r31, r31, 8
 stop
+GL0:	.dw	1
+GL1:	.dw	1
 END
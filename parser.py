@@ -3,7 +3,12 @@
 
 import error
 import codegen
+import frames
+import loops
+import pgo
+import regalloc
 import scanner
+import stats
 
 GLOBAL_PREFIX = "GL"
 FUNCTION_PREFIX = "F"
@@ -12,438 +17,1203 @@ MAIN = "main"
 MAIN_LABEL = "MAIN"
 
 _keywords = {'if', 'else', 'while', 'function', 'var', 'return'}
-# Really a stack of symbol tables so that we can track different scopes
-# `_symtab[0]` is the global symbol table
-_symtab = [{}]
-_label_count = 0
+# Most instructions a function can compile to and still be inlined into its
+# callers when it is called from more than one place
+_DEFAULT_INLINE_THRESHOLD = 24
 # Leave one word of space for our return address before storing local vars
 _init_local_offset = -codegen.WORD // codegen.BYTE
-_local_offset = _init_local_offset
 
 
-def _program(f):
-    name = scanner._get_name(f)
+def _program(ctx):
+    if 'inline' in ctx.opts:
+        ctx.calls = scanner._call_counts(ctx.ts)
+    name = scanner._get_name(ctx.ts)
     while name == 'var':
-        _global_var(f)
-        name = scanner._get_name(f)
+        _global_var(ctx)
+        name = scanner._get_name(ctx.ts)
     # After parsing all the global variable declarations we want to jump to
     # main
-    codegen._load_primary_address_relative(MAIN_LABEL)
-    codegen._br(codegen.PRIMARY)
+    codegen._load_primary_address_relative(ctx, MAIN_LABEL)
+    codegen._br(ctx, codegen.PRIMARY)
     while name == 'function':
-        _function(f)
-        name = scanner._get_name(f)
+        _function(ctx)
+        name = scanner._get_name(ctx.ts)
 
 
-def _global_var(f):
-    global _symtab, _keywords
-    identifier = scanner._get_name(f)
-    scanner._skip_white(f)
-    if identifier in _symtab[0]:
-        # Eventually calls sys.exit()
+def _global_var(ctx):
+    ctx.line = scanner._line(ctx.ts)
+    identifier = scanner._get_name(ctx.ts)
+    if identifier in ctx.symtab[0]:
+        # Eventually raises error.CompileError
         error._error("Duplicate symbol variable: " + str(identifier))
     if identifier in _keywords:
         error._error("Variable shadows keyword: " + str(identifier))
-    label = GLOBAL_PREFIX + str(_next_label())
-    codegen._alloc_global(label)
-    _symtab[0][identifier] = {'type': 'global_var', 'offset': label, 'base':
-                              codegen.ZERO}
-    if scanner._nchar == '=':
-        # This variable is initialized
-        scanner._match(f, '=')
-        scanner._skip_white(f)
-        _expression(f)
-        codegen._store_primary_abs(label)
-
-
-def _function(f):
-    global _local_offset
-    identifier = scanner._get_name(f)
-    scanner._skip_white(f)
-    if identifier in _symtab[0]:
-        # Eventually calls sys.exit()
+    label = GLOBAL_PREFIX + str(_next_label(ctx))
+    ctx.symtab[0][identifier] = {'type': 'global_var', 'offset': label,
+                                 'base': codegen.ZERO}
+    if scanner._peek(ctx.ts) != '=':
+        codegen._alloc_global(ctx, label)
+        return
+    # This variable is initialized
+    scanner._match(ctx.ts, '=')
+    value = _expression(ctx)
+    if value is not None:
+        # Known at compile time, so the word holds it from the start
+        codegen._const_global(ctx, label, value)
+        return
+    codegen._alloc_global(ctx, label)
+    codegen._store_primary_abs(ctx, label)
+
+
+def _function(ctx):
+    identifier = scanner._get_name(ctx.ts)
+    if identifier in ctx.symtab[0]:
+        # Eventually raises error.CompileError
         error._error("Duplicate symbol function: " + str(identifier))
-    _symtab[0][identifier] = {'type': 'function'}
-    scanner._match(f, '(')
+    ctx.line = scanner._line(ctx.ts)
+    ctx.symtab[0][identifier] = {'type': 'function'}
+    scanner._match(ctx.ts, '(')
     # Offset from base pointer for the local variables, leave one space for
     # pointer to the parent's bp
     offset = (codegen.WORD // codegen.BYTE)
     # Set local offset to track location of local variables.
-    _local_offset = _init_local_offset
+    ctx.local_offset = _init_local_offset
     local_symbols = {}
-    while scanner._is_valid_identifier_start(scanner._nchar):
-        id = scanner._get_name(f)
+    while scanner._peek_kind(ctx.ts) == scanner.NAME:
+        id = scanner._get_name(ctx.ts)
         if id in local_symbols:
             error._error("Duplicate parameter: " + str(id))
         local_symbols[id] = {'type': 'local_var', 'offset': offset, 'base':
                              codegen.BASE}
-        scanner._skip_white(f)
-        if scanner._nchar == ',':
-            scanner._match(f, ',')
-            scanner._skip_white(f)
+        if scanner._peek(ctx.ts) == ',':
+            scanner._match(ctx.ts, ',')
         else:
             # No more parameters to read
             break
         offset += codegen.WORD // codegen.BYTE
-    _symtab[0][identifier]['num_param'] = len(local_symbols)
+    ctx.symtab[0][identifier]['num_param'] = len(local_symbols)
     # Add our local symbols so that descendant blocks can see them
-    _symtab.append(local_symbols)
-    scanner._match(f, ')')
-    scanner._match(f, '{')
+    ctx.symtab.append(local_symbols)
+    stats._scopes(ctx)
+    scanner._match(ctx.ts, ')')
+    scanner._match(ctx.ts, '{')
+    body = scanner._span_start(ctx.ts)
+    # Locals that are never assigned after their declaration can be replaced
+    # by a constant initializer
+    ctx.assigned = scanner._assigned_names(ctx.ts) \
+        if 'const-fold' in ctx.opts else None
     if identifier == MAIN:
         label = MAIN_LABEL
     else:
-        label = "{}_{}{}".format(FUNCTION_PREFIX, identifier, _next_label())
-    _symtab[0][identifier]['offset'] = label
-    _symtab[0][identifier]['base'] = codegen.ZERO
-    codegen._post_label(label)
+        label = "{}_{}{}".format(FUNCTION_PREFIX, identifier,
+                                 _next_label(ctx))
+    ctx.symtab[0][identifier]['offset'] = label
+    ctx.symtab[0][identifier]['base'] = codegen.ZERO
+    codegen._post_label(ctx, label)
+    ctx.function = identifier
+    ctx.tail_label = None
+    ctx.cold_code = []
+    start = len(ctx.out)
     # Function assembly body starts here
     # Save return address
-    codegen._push_ret()
-    _block(f)
-    scanner._match(f, '}')
+    codegen._push_ret(ctx)
+    outer = pgo._enter(ctx, 'function')
+    if not _block(ctx):
+        # Falling off the end of the body is the same as a bare `return`
+        ctx.line = scanner._line(ctx.ts)
+        _leave(ctx)
+    pgo._leave(ctx, outer)
+    for code in ctx.cold_code:
+        ctx.out.extend(code)
+    if ctx.tail_label is not None:
+        # Calls to itself in tail position jump back to just after the
+        # return address is saved
+        ctx.out.insert(start + 2, codegen._Instr(codegen.LABEL,
+                                                 (ctx.tail_label,)))
+    body = scanner._span(ctx.ts, body)
+    scanner._match(ctx.ts, '}')
     # Remove our local symbol table
-    _symtab.pop()
+    ctx.symtab.pop()
+    # A leaf can keep its variables in the scratch registers it doesn't use
+    free = frames._free_temps(ctx.out[start:]) \
+        if 'omit-frames' in ctx.opts and identifier != MAIN and \
+        frames._is_leaf(ctx.out[start:]) else ()
+    reserved = ()
+    if 'reg-vars' in ctx.opts:
+        with stats._phase(ctx, 'regalloc'):
+            reserved = regalloc._function(ctx, start, label,
+                                          identifier != MAIN, free)
+    if 'loop-hoist' in ctx.opts:
+        with stats._phase(ctx, 'loop-hoist'):
+            loops._function(ctx, start, label, reserved)
+    if 'omit-frames' in ctx.opts:
+        with stats._phase(ctx, 'omit-frames'):
+            frames._function(ctx, start, label, ctx.symtab[0][identifier],
+                             identifier == MAIN)
+    # The label is just before `start`
+    ctx.functions.append((identifier, label, start - 1, len(ctx.out)))
+    if 'inline' in ctx.opts and identifier != MAIN and body is not None:
+        _inlinable(ctx, identifier, list(local_symbols), body,
+                   len(ctx.out) - start)
+
+
+def _inlinable(ctx, identifier, params, body, size):
+    """Keep the source `body` of the function `identifier` for
+    `_inline_call` if its code of `size` instructions is small enough to
+    copy into every caller, or if it is only called from one place
+    """
+    calls = ctx.calls.get(identifier) if ctx.calls is not None else None
+    if size <= ctx.inline_threshold or calls == 1:
+        ctx.symtab[0][identifier]['inline'] = (identifier, params, body)
 
 
-def _block(f):
-    _symtab.append({})
-    scanner._skip_white(f)
+def _block(ctx):
+    """Parse the statements of a block. Return whether it ends by returning
+    """
+    ctx.symtab.append({})
+    stats._scopes(ctx)
+    local_offset = ctx.local_offset
     local_allocations = 0
-    dealloc = True
-    while scanner._nchar != '}':
-        if scanner._is_valid_identifier_start(scanner._nchar):
-            identifier = scanner._get_name(f)
+    returned = False
+    dead = None
+    while scanner._peek(ctx.ts) != '}':
+        ctx.line = scanner._line(ctx.ts)
+        if ctx.counters is not None:
+            pgo._statement(ctx)
+        if scanner._peek_kind(ctx.ts) == scanner.NAME:
+            identifier = scanner._get_name(ctx.ts)
             if identifier == 'if':
-                _if(f)
+                _if(ctx)
             elif identifier == 'while':
-                _while(f)
+                _while(ctx)
             elif identifier == 'var':
                 local_allocations += 1
-                _local_var(f)
+                _local_var(ctx)
             elif identifier == 'break':
                 pass
             elif identifier == 'return':
-                dealloc = False
-                # Dealloc local vars - special case because the code will exit
-                # the block before the "end"
-                codegen._dealloc_stack(local_allocations
-                                       * codegen.WORD // codegen.BYTE)
-                _return(f)
+                returned = True
+                _return(ctx)
+                if dead is None and 'dce' in ctx.opts:
+                    # Nothing after a return can run
+                    dead = _dead_start(ctx)
             else:
                 # Either an assignment or a function call
                 # Look in symbol table to tell which is which
-                entry = _lookup(identifier)
+                entry = _lookup(ctx, identifier)
                 if entry is not None:
                     if entry['type'] == 'local_var' or entry['type'] == \
                             'global_var':
-                        _assignment(f, entry)
+                        _assignment(ctx, entry)
                     elif entry['type'] == 'function':
-                        _function_call(f, entry)
+                        _function_call(ctx, entry)
                 else:
                     error._error("Undeclared identifier: " + str(identifier))
-        elif scanner._nchar == '@':
-            scanner._match(f, '@')
-            _p_assignment(f)
+        elif scanner._peek(ctx.ts) == '@':
+            scanner._match(ctx.ts, '@')
+            _p_assignment(ctx)
         else:
-            error._expected("Identifier or '@', got {}".format(scanner._nchar))
-        scanner._skip_white(f)
-    if dealloc:
+            error._expected("Identifier or '@', got {}".format(
+                scanner._peek(ctx.ts)))
+    if dead is not None:
+        _dead_end(ctx, dead)
+    if not returned:
         # Dealloc local vars to get back to return address
-        codegen._dealloc_stack(local_allocations
+        codegen._dealloc_stack(ctx, local_allocations
                                * codegen.WORD // codegen.BYTE)
-    _symtab.pop()
-
-
-def _if(f):
-    scanner._match(f, '(')
-    _expression(f)
-    scanner._match(f, ')')
-    scanner._match(f, '{')
-    label = LABEL_PREFIX + str(_next_label())
-    codegen._load_branch_address_relative(label)
-    codegen._brzr_def()
-    _block(f)
-    codegen._post_label(label)
-    scanner._match(f, '}')
-    scanner._skip_white(f)
-
-
-def _while(f):
-    label_loop, label_exit = LABEL_PREFIX + str(_next_label()), \
-                             LABEL_PREFIX + str(_next_label())
-    codegen._post_label(label_loop)
-    scanner._match(f, '(')
-    _expression(f)
-    scanner._match(f, ')')
-    scanner._match(f, '{')
-    codegen._load_branch_address_relative(label_exit)
-    codegen._brzr_def()
-    _block(f)
-    codegen._load_branch_address_relative(label_loop)
-    codegen._br_def()
-    scanner._match(f, '}')
-
-
-def _local_var(f):
-    global _local_offset
-    _local_offset -= (codegen.WORD // codegen.BYTE)
-    identifier = scanner._get_name(f)
-    if identifier in _symtab[-1]:
+    # The slots of our locals are free again for the next block
+    ctx.local_offset = local_offset
+    ctx.symtab.pop()
+    return returned
+
+
+def _if(ctx):
+    scanner._match(ctx.ts, '(')
+    label = LABEL_PREFIX + str(_next_label(ctx))
+    if pgo._cold(ctx.profile, 'branch', pgo._source_function(ctx),
+                 ctx.line):
+        _cold_if(ctx, label)
+        return
+    _condition(ctx, label)
+    scanner._match(ctx.ts, ')')
+    scanner._match(ctx.ts, '{')
+    if _always_jumps(ctx, label):
+        _dead_block(ctx)
+    else:
+        outer = pgo._enter(ctx, 'branch')
+        _block(ctx)
+        pgo._leave(ctx, outer)
+    codegen._post_label(ctx, label)
+    scanner._match(ctx.ts, '}')
+
+
+def _cold_if(ctx, label):
+    """Emit an if whose body seldom runs with the body out of line, so that
+    skipping it falls through to `label`
+    """
+    label_body = LABEL_PREFIX + str(_next_label(ctx))
+    _condition(ctx, label_body, True)
+    scanner._match(ctx.ts, ')')
+    scanner._match(ctx.ts, '{')
+    start = len(ctx.out)
+    codegen._post_label(ctx, label_body)
+    outer = pgo._enter(ctx, 'branch')
+    if not _block(ctx):
+        _jump(ctx, label)
+    pgo._leave(ctx, outer)
+    _move_out_of_line(ctx, start, label_body)
+    codegen._post_label(ctx, label)
+    scanner._match(ctx.ts, '}')
+
+
+def _while(ctx):
+    label_loop, label_exit = LABEL_PREFIX + str(_next_label(ctx)), \
+                             LABEL_PREFIX + str(_next_label(ctx))
+    if ctx.temp_depth:
+        # A loop inlined into an expression must leave its operands alone
+        ctx.live_temps[label_loop] = ctx.temp_depth
+    if pgo._cold(ctx.profile, 'loop', pgo._source_function(ctx), ctx.line):
+        _cold_while(ctx, label_loop, label_exit)
+        return
+    if 'loop-rotate' in ctx.opts:
+        _rotated_while(ctx, label_loop, label_exit)
+        return
+    codegen._post_label(ctx, label_loop)
+    scanner._match(ctx.ts, '(')
+    _condition(ctx, label_exit)
+    scanner._match(ctx.ts, ')')
+    scanner._match(ctx.ts, '{')
+    if _always_jumps(ctx, label_exit):
+        _dead_block(ctx)
+    else:
+        line = ctx.line
+        outer = pgo._enter(ctx, 'loop')
+        _block(ctx)
+        pgo._leave(ctx, outer)
+        # Going round again is part of the while
+        ctx.line = line
+        codegen._load_branch_address_relative(ctx, label_loop)
+        codegen._br_def(ctx)
+    codegen._post_label(ctx, label_exit)
+    scanner._match(ctx.ts, '}')
+
+
+def _rotated_while(ctx, label_loop, label_exit):
+    """Emit a while loop as `if (cond) { do { body } while (cond) }`, so
+    each time around only runs the test at the bottom. The condition is
+    parsed a second time from its tokens to emit that test
+    """
+    scanner._match(ctx.ts, '(')
+    cond = scanner._mark(ctx.ts)
+    _condition(ctx, label_exit)
+    scanner._match(ctx.ts, ')')
+    scanner._match(ctx.ts, '{')
+    if _always_jumps(ctx, label_exit):
+        _dead_block(ctx)
+        codegen._post_label(ctx, label_exit)
+        scanner._match(ctx.ts, '}')
+        return
+    codegen._post_label(ctx, label_loop)
+    line = ctx.line
+    outer = pgo._enter(ctx, 'loop')
+    _block(ctx)
+    pgo._leave(ctx, outer)
+    ctx.line = line
+    end = scanner._mark(ctx.ts)
+    scanner._rewind(ctx.ts, cond)
+    _condition(ctx, label_loop, True)
+    scanner._rewind(ctx.ts, end)
+    codegen._post_label(ctx, label_exit)
+    scanner._match(ctx.ts, '}')
+
+
+def _cold_while(ctx, label_loop, label_exit):
+    """Emit a while loop whose body seldom runs as `_rotated_while` does,
+    but with all of it except the first test out of line, so that skipping
+    it falls through to `label_exit`
+    """
+    scanner._match(ctx.ts, '(')
+    cond = scanner._mark(ctx.ts)
+    _condition(ctx, label_loop, True)
+    scanner._match(ctx.ts, ')')
+    scanner._match(ctx.ts, '{')
+    start = len(ctx.out)
+    codegen._post_label(ctx, label_loop)
+    line = ctx.line
+    outer = pgo._enter(ctx, 'loop')
+    _block(ctx)
+    pgo._leave(ctx, outer)
+    ctx.line = line
+    end = scanner._mark(ctx.ts)
+    scanner._rewind(ctx.ts, cond)
+    _condition(ctx, label_loop, True)
+    scanner._rewind(ctx.ts, end)
+    _jump(ctx, label_exit)
+    _move_out_of_line(ctx, start, label_loop)
+    codegen._post_label(ctx, label_exit)
+    scanner._match(ctx.ts, '}')
+
+
+def _move_out_of_line(ctx, start, label):
+    """Move the code emitted from `start` on, which starts at `label`, to
+    the end of the function
+    """
+    ctx.cold_code.append(ctx.out[start:])
+    ctx.cold_labels.add(label)
+    del ctx.out[start:]
+
+
+def _always_jumps(ctx, label):
+    """Return whether the condition just parsed always jumps to `label`, so
+    the code that comes next can never run. If so the jump is removed, as
+    the code up to `label` is
+    """
+    out = ctx.out
+    if 'dce' not in ctx.opts or len(out) < 2 or out[-1].op != codegen.BR or \
+            out[-2].op != codegen.LAR or out[-2].args[1] != label:
+        return False
+    del out[-2:]
+    ctx.unreachable += 2
+    return True
+
+
+def _dead_block(ctx):
+    """Parse a block that can never run and drop its code
+    """
+    dead = _dead_start(ctx)
+    _block(ctx)
+    _dead_end(ctx, dead)
+
+
+def _dead_start(ctx):
+    """Return what `_dead_end` needs to drop the code parsed from here on
+    """
+    return len(ctx.out), len(ctx.report), ctx.tail_label, len(ctx.cold_code)
+
+
+def _dead_end(ctx, dead):
+    """Drop the code parsed since `_dead_start` returned `dead`, along with
+    anything the optimizers said about it
+    """
+    start, report, ctx.tail_label, cold = dead
+    ctx.unreachable += len(ctx.out) - start + sum(
+        len(code) for code in ctx.cold_code[cold:])
+    del ctx.out[start:]
+    del ctx.report[report:]
+    del ctx.cold_code[cold:]
+
+
+def _local_var(ctx):
+    ctx.local_offset -= (codegen.WORD // codegen.BYTE)
+    identifier = scanner._get_name(ctx.ts)
+    if identifier in ctx.symtab[-1]:
         error._error("Repeat local identifier: " + str(identifier))
-    _symtab[-1][identifier] = {'type': 'local_var', 'offset': _local_offset,
-                               'base': codegen.BASE}
+    ctx.symtab[-1][identifier] = {'type': 'local_var',
+                                  'offset': ctx.local_offset,
+                                  'base': codegen.BASE}
     # Allocate space for var on stack
-    codegen._alloc_stack(codegen.WORD // codegen.BYTE)
-    scanner._skip_white(f)
-    if scanner._nchar == '=':
-        scanner._match(f, '=')
-        _expression(f)
-        entry = _symtab[-1][identifier]
-        codegen._store_primary(entry['offset'], entry['base'])
+    codegen._alloc_stack(ctx, codegen.WORD // codegen.BYTE)
+    if scanner._peek(ctx.ts) == '=':
+        scanner._match(ctx.ts, '=')
+        value = _expression(ctx)
+        entry = ctx.symtab[-1][identifier]
+        if value is not None and identifier not in ctx.assigned:
+            # Never assigned again, so every use can just be the constant
+            entry['const'] = value
+        else:
+            _to_primary(ctx, value)
+            codegen._store_primary(ctx, entry['offset'], entry['base'])
 
 
-def _assignment(f, entry):
-    scanner._match(f, '=')
-    _expression(f)
-    codegen._store_primary(entry['offset'], entry['base'])
+def _assignment(ctx, entry):
+    scanner._match(ctx.ts, '=')
+    _to_primary(ctx, _expression(ctx))
+    codegen._store_primary(ctx, entry['offset'], entry['base'])
 
 
-def _p_assignment(f):
-    scanner._match(f, '(')
-    _expression(f)
-    scanner._match(f, ')')
-    codegen._push_primary()
-    scanner._match(f, '=')
-    _expression(f)
-    codegen._pop_secondary()
-    codegen._store_primary(0, codegen.SECONDARY)
+def _p_assignment(ctx):
+    scanner._match(ctx.ts, '(')
+    addr = _expression(ctx)
+    scanner._match(ctx.ts, ')')
+    scanner._match(ctx.ts, '=')
+    if addr is not None and codegen._fits_imm(addr):
+        # Store straight to the absolute address
+        _to_primary(ctx, _expression(ctx))
+        codegen._store_primary(ctx, addr, codegen.ZERO)
+        return
+    _to_primary(ctx, addr)
+    saved = _save_primary(ctx)
+    _to_primary(ctx, _expression(ctx))
+    codegen._store_primary(ctx, 0, _restore(ctx, saved))
 
 
-def _function_call(f, entry):
+def _function_call(ctx, entry):
+    calls = ctx.calls.get(entry['inline'][0]) \
+        if 'inline' in entry and ctx.calls is not None else None
+    if 'inline' in entry and entry['inline'][0] not in \
+            (inlined[0] for inlined in ctx.inlining) and \
+            (calls == 1 or pgo._hot_call(ctx, ctx.frequency)):
+        _inline_call(ctx, entry)
+        return
+    # The callee is free to use the temporaries, so save the ones holding
+    # operands of the expression this call is part of
+    live = codegen.TEMPS[:ctx.temp_depth]
+    for reg in live:
+        codegen._push(ctx, reg)
+    depth, ctx.temp_depth = ctx.temp_depth, 0
     num_param = entry['num_param']
-    codegen._alloc_stack(num_param * codegen.WORD // codegen.BYTE)
+    codegen._alloc_stack(ctx, num_param * codegen.WORD // codegen.BYTE)
+    ctx.pushed += len(live) + num_param
     offset = codegen.WORD // codegen.BYTE
-    scanner._match(f, '(')
+    scanner._match(ctx.ts, '(')
     for i in range(num_param):
-        _expression(f)
-        codegen._store_primary(offset, codegen.STACK)
+        _to_primary(ctx, _expression(ctx))
+        codegen._store_primary(ctx, offset, codegen.STACK)
         offset += codegen.WORD // codegen.BYTE
-        scanner._skip_white(f)
-        if scanner._nchar == ',':
-            scanner._match(f, ',')
+        if scanner._peek(ctx.ts) == ',':
+            scanner._match(ctx.ts, ',')
         else:
             break
-    scanner._match(f, ')')
-    codegen._push(codegen.BASE)
-    # Base pointer points to the thing that was just pushed (address of old
-    # bp) and we need to offset b/c STACK points off end of stack
-    codegen._load_address(codegen.BASE, codegen.STACK, codegen.WORD //
-                          codegen.BYTE)
-    codegen._load_branch_address_relative(entry['offset'])
-    codegen._brl_def()
+    scanner._match(ctx.ts, ')')
+    # A callee without a frame reads its arguments off the stack pointer
+    frame = entry.get('frame', True)
+    if frame:
+        codegen._push(ctx, codegen.BASE)
+        # Base pointer points to the thing that was just pushed (address of
+        # old bp) and we need to offset b/c STACK points off end of stack
+        codegen._load_address(ctx, codegen.BASE, codegen.STACK,
+                              codegen.WORD // codegen.BYTE)
+    codegen._load_branch_address_relative(ctx, entry['offset'])
+    codegen._brl_def(ctx)
     # Clean up the stack: restore rb and remove the args we pushed
-    codegen._pop(codegen.BASE)
-    codegen._dealloc_stack(num_param * codegen.WORD // codegen.BYTE)
+    if frame:
+        codegen._pop(ctx, codegen.BASE)
+    codegen._dealloc_stack(ctx, num_param * codegen.WORD // codegen.BYTE)
+    ctx.pushed -= len(live) + num_param
+    ctx.temp_depth = depth
+    for reg in reversed(live):
+        codegen._pop(ctx, reg)
+
 
+def _inline_call(ctx, entry):
+    """Emit a copy of the body of the function `entry` in place of a call to
+    it, parsed again from its source with the parameters bound to new locals
+    of the caller. A `return` in the copy leaves its value in the return
+    value register and jumps to the end of it, just as a real call would
+    """
+    name, params, (source, line) = entry['inline']
+    ctx.report.append("inline: {} into {} on line {}".format(
+        name, ctx.function, scanner._line(ctx.ts)))
+    ts = scanner._tokenize(source, line, ctx.ts.counts)
+    assigned = scanner._assigned_names(ts) if 'const-fold' in ctx.opts \
+        else None
+    # The locals of the copy go below anything the expression around the
+    # call has pushed
+    local_offset, pushed = ctx.local_offset, ctx.pushed
+    ctx.local_offset -= pushed * codegen.WORD // codegen.BYTE
+    ctx.pushed = 0
+    offset = ctx.local_offset
+    symbols = {}
+    more = True
+    scanner._match(ctx.ts, '(')
+    for param in params:
+        value = _expression(ctx) if more else None
+        if more and value is not None and param not in assigned:
+            # Never assigned in the body, so every use can be the constant
+            symbols[param] = {'type': 'local_var', 'const': value}
+        else:
+            ctx.local_offset -= codegen.WORD // codegen.BYTE
+            codegen._alloc_stack(ctx, codegen.WORD // codegen.BYTE)
+            symbols[param] = {'type': 'local_var',
+                              'offset': ctx.local_offset,
+                              'base': codegen.BASE}
+            if more:
+                _to_primary(ctx, value)
+                codegen._store_primary(ctx, ctx.local_offset, codegen.BASE)
+        if more and scanner._peek(ctx.ts) == ',':
+            scanner._match(ctx.ts, ',')
+        else:
+            more = False
+    scanner._match(ctx.ts, ')')
+    label_exit = LABEL_PREFIX + str(_next_label(ctx))
+    saved = ctx.ts, ctx.symtab, ctx.assigned
+    # The body only sees the globals and its parameters
+    ctx.ts, ctx.symtab, ctx.assigned = ts, [ctx.symtab[0], symbols], assigned
+    ctx.inlining.append((name, label_exit, offset))
+    start = len(ctx.out)
+    line = ctx.line
+    outer = pgo._enter(ctx, 'function')
+    if not _block(ctx):
+        ctx.line = scanner._line(ctx.ts)
+        _leave(ctx)
+    pgo._leave(ctx, outer)
+    scanner._match(ctx.ts, '}')
+    ctx.inlining.pop()
+    ctx.ts, ctx.symtab, ctx.assigned = saved
+    # The rest of the statement with the call is for its own line
+    ctx.line = line
+    ctx.local_offset, ctx.pushed = local_offset, pushed
+    out = ctx.out
+    if len(out) - start >= 2 and out[-1].op == codegen.BR and \
+            out[-2].op == codegen.LAR and out[-2].args[1] == label_exit:
+        # The copy ends by returning, which just falls through to the end
+        del out[-2:]
+    if any(i.op == codegen.LAR and i.args[1] == label_exit
+           for code in [out[start:]] + ctx.cold_code for i in code):
+        codegen._post_label(ctx, label_exit)
 
-def _return(f):
-    scanner._skip_white(f)
-    if scanner._nchar == '(':
-        scanner._match(f, '(')
-        _expression(f)
+
+def _return(ctx):
+    if scanner._peek(ctx.ts) == '(':
+        scanner._match(ctx.ts, '(')
+        entry = _tail_callee(ctx)
+        if entry is not None:
+            _tail_call(ctx, entry)
+            scanner._match(ctx.ts, ')')
+            return
+        value = _expression(ctx)
         # Copy value over to return value register
-        codegen._load_address(codegen.RETURN_VAL, codegen.PRIMARY, 0)
-        scanner._match(f, ')')
-    # Pop the return address into the BRANCH_TARGET register and return to it
-    codegen._pop(codegen.BRANCH_TARGET)
-    codegen._br_def()
-
-
-def _expression(f):
-    _term(f)
-    op = scanner._get_operator(f)
-    while op != "":
-        if op not in scanner._or_ops:
-            # Unget the op chars and reset scanner._nchar
-            f.seek(-len(op) - 1, 1)
-            scanner._nchar = f.read(1).decode("utf-8")
-            # Break out of the loop - not our operator
-            break
-        codegen._push_primary()
-        _term(f)
-        codegen._pop_secondary()
-        # Both branches use the same arguments
-        regs = (codegen.PRIMARY, codegen.PRIMARY, codegen.SECONDARY)
-        if op == '|':
-            # Unpack the regs tuple as args
-            codegen._bitwise_or(*regs)
-        elif op == '||':
-            codegen._logical_or(*regs)
+        if value is not None:
+            codegen._load_address_relative(ctx, codegen.RETURN_VAL, value)
+        else:
+            codegen._load_address(ctx, codegen.RETURN_VAL, codegen.PRIMARY,
+                                  0)
+        scanner._match(ctx.ts, ')')
+    _leave(ctx)
+
+
+def _tail_callee(ctx):
+    """Return the symbol table entry of the function called if the value of
+    the `return` being parsed is just a call that can reuse the frame of the
+    function being parsed, otherwise None
+    """
+    if 'tail-calls' not in ctx.opts or ctx.function == MAIN or \
+            ctx.inlining or scanner._peek_kind(ctx.ts) != scanner.NAME:
+        return None
+    entry = _lookup(ctx, scanner._peek(ctx.ts))
+    ts = ctx.ts
+    if entry is None or entry['type'] != 'function' or \
+            scanner._text(ts, ts.pos + 1) != '(' or \
+            scanner._after_group(ts, ts.pos + 1) != ')':
+        return None
+    this = ctx.symtab[0][ctx.function]
+    if entry is this:
+        return entry
+    # Our caller only made room for our own arguments and set up the base
+    # pointer it expects, and a function that is inlined costs less than
+    # any call
+    if 'inline' in entry or entry['num_param'] > this['num_param'] or \
+            not entry.get('frame', True):
+        return None
+    return entry
+
+
+def _tail_call(ctx, entry):
+    """Emit a call in tail position as a jump. The arguments are all
+    evaluated and then stored over our own parameters, and the callee
+    returns straight to our caller. A call to the function being parsed
+    jumps back to the top of its body, so the recursion becomes a loop
+    """
+    name = scanner._next(ctx.ts)
+    this = entry is ctx.symtab[0][ctx.function]
+    ctx.report.append("tail-calls: {} {} on line {}".format(
+        ctx.function, "into a loop" if this else "to " + name,
+        scanner._line(ctx.ts)))
+    # Constant arguments are stored last. Each of the others but the last
+    # one is saved while the next is evaluated
+    values = []
+    saved = []
+    pending = False
+    scanner._match(ctx.ts, '(')
+    for i in range(entry['num_param']):
+        if pending:
+            saved.append(_save_primary(ctx))
+        value = _expression(ctx)
+        values.append(value)
+        pending = value is None
+        if scanner._peek(ctx.ts) == ',':
+            scanner._match(ctx.ts, ',')
         else:
-            error._expected('| or ||')
-        op = scanner._get_operator(f)
-
-
-def _term(f):
-    _factor(f)
-    op = scanner._get_operator(f)
-    while op != "":
-        if op not in scanner._and_ops:
-            # Unget the op chars and reset scanner._nchar
-            f.seek(-len(op) - 1, 1)
-            scanner._nchar = f.read(1).decode("utf-8")
-            # Break out of the loop - not our operator
             break
-        codegen._push_primary()
-        _factor(f)
-        codegen._pop_secondary()
-        regs = (codegen.PRIMARY, codegen.PRIMARY, codegen.SECONDARY)
-        if op == '&':
-            codegen._bitwise_and(*regs)
-        elif op == '&&':
-            codegen._logical_and(*regs)
+    scanner._match(ctx.ts, ')')
+    if this:
+        # Parameters held in registers are written by storing to their slots
+        base = codegen.BASE
+    else:
+        # The callee reads its arguments from memory, so write them through
+        # a copy of the base pointer that register allocation leaves alone
+        base = codegen.BRANCH_TARGET
+        codegen._load_address(ctx, base, codegen.BASE, 0)
+    word = codegen.WORD // codegen.BYTE
+    for i in reversed(range(len(values))):
+        if values[i] is not None:
+            continue
+        if pending:
+            reg = codegen.PRIMARY
+            pending = False
+        else:
+            reg = _restore(ctx, saved.pop())
+        codegen._store(ctx, reg, word * (i + 1), base)
+    for i, value in enumerate(values):
+        if value is not None:
+            codegen._load_primary_address_relative(ctx, value)
+            codegen._store(ctx, codegen.PRIMARY, word * (i + 1), base)
+    codegen._dealloc_stack(ctx, _init_local_offset - ctx.local_offset)
+    if this:
+        if ctx.tail_label is None:
+            ctx.tail_label = LABEL_PREFIX + str(_next_label(ctx))
+        _jump(ctx, ctx.tail_label)
+        return
+    codegen._pop(ctx, codegen.RETURN)
+    codegen._load_branch_address_relative(ctx, entry['offset'])
+    codegen._br_def(ctx)
+
+
+def _leave(ctx):
+    """Emit the code to return from the function being parsed
+    """
+    if ctx.inlining:
+        # Leaving a function inlined into the one being parsed goes to the
+        # end of its copy, with the stack back as it was before its
+        # parameters were allocated
+        _, label_exit, offset = ctx.inlining[-1]
+        codegen._dealloc_stack(ctx, offset - ctx.local_offset)
+        _jump(ctx, label_exit)
+        return
+    if ctx.function == MAIN:
+        # main is jumped to rather than called, so leaving it ends the program
+        codegen._stop(ctx)
+        return
+    # Dealloc the locals of every enclosing block to get back to the return
+    # address
+    codegen._dealloc_stack(ctx, _init_local_offset - ctx.local_offset)
+    # Pop the return address into the BRANCH_TARGET register and return to it
+    codegen._pop(ctx, codegen.BRANCH_TARGET)
+    codegen._br_def(ctx)
+
+
+# The expression functions below return the value of the expression they
+# parsed when it is a compile time constant, in which case they emit no code,
+# and None when they have left the value in the primary register. Constants
+# are only tracked when optimizing, so at -O0 every literal is loaded as soon
+# as it is parsed
+
+def _expression(ctx):
+    value = _term(ctx)
+    op = scanner._peek_operator(ctx.ts)
+    while op in scanner._or_ops:
+        scanner._next(ctx.ts)
+        if op == '||':
+            value = _logical(ctx, op, value, _term)
+        else:
+            value = _binary(ctx, op, value, _term)
+        op = scanner._peek_operator(ctx.ts)
+    return value
+
+
+def _term(ctx):
+    value = _factor(ctx)
+    op = scanner._peek_operator(ctx.ts)
+    while op in scanner._and_ops:
+        scanner._next(ctx.ts)
+        if op == '&&':
+            value = _logical(ctx, op, value, _factor)
         else:
-            error._expected('& or &&')
-        op = scanner._get_operator(f)
+            value = _binary(ctx, op, value, _factor)
+        op = scanner._peek_operator(ctx.ts)
+    return value
 
 
-def _factor(f):
-    op = scanner._get_operator(f)
+def _factor(ctx):
+    op = scanner._peek_operator(ctx.ts)
     if op in scanner._not_ops:
-        _factor(f)
+        scanner._next(ctx.ts)
+        value = _factor(ctx)
+        if value is not None:
+            if op == '!':
+                return -1 if value == 0 else 0
+            return ~value
         regs = (codegen.PRIMARY, codegen.PRIMARY)
         if op == '~':
-            codegen._bitwise_not(*regs)
+            codegen._bitwise_not(ctx, *regs)
         elif op == '!':
-            codegen._logical_not(*regs)
-    elif op == '':
-        _relation(f)
-    else:
-        # Unget the op chars and reset scanner._nchar
-        f.seek(-len(op) - 1, 1)
-        scanner._nchar = f.read(1).decode("utf-8")
-
-
-def _relation(f):
-    _a_expression(f)
-    op = scanner._get_operator(f)
-    while op != "":
-        if op not in scanner._rel_ops:
-            # Unget the op chars and reset scanner._nchar
-            f.seek(-len(op) - 1, 1)
-            scanner._nchar = f.read(1).decode("utf-8")
-            # Break out of the loop - not our operator
-            break
-        codegen._push_primary()
-        _a_expression(f)
-        codegen._pop_secondary()
-        codegen._cmp_def(op)
-        op = scanner._get_operator(f)
-
-
-def _a_expression(f):
-    _a_term(f)
-    op = scanner._get_operator(f)
-    while op != "":
-        if op not in scanner._add_ops:
-            # Unget the op chars and reset scanner._nchar
-            f.seek(-len(op) - 1, 1)
-            scanner._nchar = f.read(1).decode("utf-8")
-            # Break out of the loop - not our operator
-            break
+            codegen._logical_not(ctx, *regs)
+        return None
+    return _relation(ctx)
+
+
+def _relation(ctx):
+    value = _a_expression(ctx)
+    op = scanner._peek_operator(ctx.ts)
+    while op in scanner._rel_ops:
+        scanner._next(ctx.ts)
+        value = _binary(ctx, op, value, _a_expression)
+        op = scanner._peek_operator(ctx.ts)
+    return value
+
+
+def _a_expression(ctx):
+    value = _a_term(ctx)
+    op = scanner._peek_operator(ctx.ts)
+    while op in scanner._add_ops:
+        scanner._next(ctx.ts)
         # TODO Handle unary ++ and --
-        codegen._push_primary()
-        _a_term(f)
-        codegen._pop_secondary()
-        # Flip order of primary and secondary for - b/c second argument is
-        # the one in primary. + is commutative so it doesn't matter for that
-        # case
-        regs = (codegen.PRIMARY, codegen.SECONDARY, codegen.PRIMARY)
-        if op == '+':
-            codegen._add(*regs)
-        elif op == '-':
-            codegen._sub(*regs)
-        else:
+        if op != '+' and op != '-':
             error._expected('+ or -')
-        op = scanner._get_operator(f)
-
-
-def _a_term(f):
-    _a_factor(f)
-    op = scanner._get_operator(f)
-    while op != "":
-        if op not in scanner._mul_ops:
-            # Unget the op chars and reset scanner._nchar
-            f.seek(-len(op) - 1, 1)
-            scanner._nchar = f.read(1).decode("utf-8")
-            # Break out of the loop - not our operator
-            break
-        codegen._push_primary()
-        _a_factor(f)
-        codegen._pop_secondary()
-        # Flip order for / for same reason as -. * is comm so doesn't matter
-        regs = (codegen.PRIMARY, codegen.SECONDARY, codegen.PRIMARY)
-        if op == '*':
-            codegen._mul(*regs)
-        elif op == '/':
-            codegen._div(*regs)
-        else:
-            error._expected('* or /')
-        op = scanner._get_operator(f)
+        value = _binary(ctx, op, value, _a_term)
+        op = scanner._peek_operator(ctx.ts)
+    return value
+
 
+def _a_term(ctx):
+    value = _a_factor(ctx)
+    op = scanner._peek_operator(ctx.ts)
+    while op in scanner._mul_ops:
+        scanner._next(ctx.ts)
+        value = _binary(ctx, op, value, _a_factor)
+        op = scanner._peek_operator(ctx.ts)
+    return value
 
-def _a_factor(f):
-    op = scanner._get_operator(f)
+
+def _a_factor(ctx):
+    op = scanner._peek_operator(ctx.ts)
     if op in scanner._add_ops:
-        _a_factor(f)
+        scanner._next(ctx.ts)
+        value = _a_factor(ctx)
         if op == '-':
+            if value is not None:
+                return codegen._wrap(-value)
             # Negate the primary reg, if + we don't have to do anything
-            codegen._neg(codegen.PRIMARY, codegen.PRIMARY)
-    elif op == '':
-        if scanner._nchar == '(':
-            scanner._match(f, '(')
-            _expression(f)
-            scanner._match(f, ')')
-        elif scanner._is_valid_identifier_start(scanner._nchar):
-            id = scanner._get_name(f)
-            entry = _lookup(id)
-            if entry is None:
-                error._error("Undeclared identifier: " + str(id))
-            if entry['type'] == 'global_var' or entry['type'] == 'local_var':
-                codegen._load_primary(entry['offset'], entry['base'])
-            elif entry['type'] == 'function':
-                _function_call(f, entry)
-                # Move return value to primary
-                codegen._load_primary_address(codegen.RETURN_VAL, 0)
-            else:
-                error._error("Unknown type of entry: {}".format(str(entry)))
-        elif scanner._is_num(scanner._nchar):
-            n = scanner._get_num(f)
-            codegen._load_primary_address_relative(n)
-        elif scanner._nchar == '@':
-            scanner._match(f, '@')
-            scanner._match(f, '(')
-            _expression(f)
-            scanner._match(f, ')')
-            codegen._load_primary(0, codegen.PRIMARY)
+            codegen._neg(ctx, codegen.PRIMARY, codegen.PRIMARY)
+        return value
+    elif scanner._peek(ctx.ts) == '(':
+        scanner._match(ctx.ts, '(')
+        value = _expression(ctx)
+        scanner._match(ctx.ts, ')')
+        return value
+    elif scanner._peek_kind(ctx.ts) == scanner.NAME:
+        id = scanner._get_name(ctx.ts)
+        entry = _lookup(ctx, id)
+        if entry is None:
+            error._error("Undeclared identifier: " + str(id))
+        if entry['type'] == 'global_var' or entry['type'] == 'local_var':
+            if 'const' in entry:
+                return entry['const']
+            codegen._load_primary(ctx, entry['offset'], entry['base'])
+        elif entry['type'] == 'function':
+            _function_call(ctx, entry)
+            # Move return value to primary
+            codegen._load_primary_address(ctx, codegen.RETURN_VAL, 0)
+        else:
+            error._error("Unknown type of entry: {}".format(str(entry)))
+    elif scanner._peek_kind(ctx.ts) == scanner.NUM:
+        n = scanner._get_num(ctx.ts)
+        if 'const-fold' in ctx.opts:
+            return codegen._wrap(int(n))
+        codegen._load_primary_address_relative(ctx, n)
+    elif scanner._peek(ctx.ts) == '@':
+        scanner._match(ctx.ts, '@')
+        scanner._match(ctx.ts, '(')
+        addr = _expression(ctx)
+        scanner._match(ctx.ts, ')')
+        if addr is not None and codegen._fits_imm(addr):
+            codegen._load_primary(ctx, addr, codegen.ZERO)
+        else:
+            _to_primary(ctx, addr)
+            codegen._load_primary(ctx, 0, codegen.PRIMARY)
+    return None
+
+
+def _to_primary(ctx, value):
+    """Load `value`, as returned by an expression function, into the primary
+    register if it isn't there already
+    """
+    if value is not None:
+        codegen._load_primary_address_relative(ctx, value)
+
+
+def _binary(ctx, op, left, parse):
+    """Parse the right operand of the binary operator `op` with `parse` and
+    emit `left op right`. `left` is the value returned for the left operand
+    """
+    lhs, rhs = _operands(ctx, left, parse)
+    return _combine(ctx, op, lhs, rhs)
+
+
+def _operands(ctx, left, parse):
+    """Parse the right operand of a binary operator with `parse`. Return
+    where both operands are: a register name, or an int for a constant
+    """
+    if left is None:
+        mark = len(ctx.out)
+        saved = _save_primary(ctx)
+        right = parse(ctx)
+        if right is None:
+            return _restore(ctx, saved), codegen.PRIMARY
+        # A constant emits no code, so the left operand never left the
+        # primary register and doesn't need saving
+        del ctx.out[mark:]
+        if saved is not None:
+            ctx.temp_depth -= 1
+        else:
+            ctx.pushed -= 1
+        return codegen.PRIMARY, right
+    right = parse(ctx)
+    return left, codegen.PRIMARY if right is None else right
+
+
+def _combine(ctx, op, lhs, rhs):
+    """Emit `lhs op rhs` for operands as returned by `_operands` into the
+    primary register. Return the value if it is a constant instead
+    """
+    if isinstance(lhs, str):
+        if isinstance(rhs, str):
+            _emit_binary(ctx, op, lhs, rhs)
+        else:
+            _binary_const(ctx, op, lhs, rhs, False)
+        return None
+    if isinstance(rhs, str):
+        _binary_const(ctx, op, rhs, lhs, True)
+        return None
+    value = codegen._fold(op, lhs, rhs)
+    if value is None:
+        # Can't be folded (e.g. division by zero), leave it to run time
+        _to_primary(ctx, rhs)
+        _binary_const(ctx, op, codegen.PRIMARY, lhs, True)
+    return value
+
+
+def _logical(ctx, op, left, parse):
+    """Parse the right operand of `||` or `&&` with `parse` and emit `left op
+    right`, which is -1 when true and 0 when false. The right operand is
+    only run if `left` doesn't decide the result
+    """
+    # The truth of the left operand that decides the result on its own, and
+    # the result it decides
+    decides = op == '||'
+    short = -1 if decides else 0
+    if left is not None:
+        mark = len(ctx.out)
+        right = parse(ctx)
+        if (left != 0) == decides:
+            # The right operand never runs
+            del ctx.out[mark:]
+            return short
+        if right is not None:
+            return -1 if right != 0 else 0
+        codegen._truth(ctx, codegen.PRIMARY, codegen.PRIMARY)
+        return None
+    label_short = LABEL_PREFIX + str(_next_label(ctx))
+    label_end = LABEL_PREFIX + str(_next_label(ctx))
+    _branch_on(ctx, None, decides, label_short)
+    _branch_on(ctx, parse(ctx), decides, label_short)
+    codegen._load_primary_address(ctx, codegen.ZERO, ~short)
+    _jump(ctx, label_end)
+    codegen._post_label(ctx, label_short)
+    codegen._load_primary_address(ctx, codegen.ZERO, short)
+    codegen._post_label(ctx, label_end)
+    return None
+
+
+def _save_primary(ctx):
+    """Save the primary register while another operand is evaluated. With
+    reg-exprs the value is moved to the next free temporary register and
+    that register is returned; otherwise, or once all of them are in use, it
+    is pushed on the stack and None is returned
+    """
+    if 'reg-exprs' in ctx.opts and ctx.temp_depth < len(codegen.TEMPS):
+        reg = codegen.TEMPS[ctx.temp_depth]
+        ctx.temp_depth += 1
+        codegen._load_address(ctx, reg, codegen.PRIMARY, 0)
+        return reg
+    codegen._push_primary(ctx)
+    ctx.pushed += 1
+    return None
+
+
+def _restore(ctx, saved):
+    """Release a value saved by `_save_primary` and return the register it
+    can be read from
+    """
+    if saved is None:
+        codegen._pop_secondary(ctx)
+        ctx.pushed -= 1
+        return codegen.SECONDARY
+    ctx.temp_depth -= 1
+    return saved
+
+
+def _binary_const(ctx, op, reg, c, const_left):
+    """Emit `c op reg` if `const_left`, otherwise `reg op c`, into the
+    primary register, using an immediate operand where op has one
+    """
+    if op == '+' and codegen._fits_imm(c):
+        codegen._addi(ctx, codegen.PRIMARY, reg, c)
+    elif op == '-' and not const_left and codegen._fits_imm(-c):
+        codegen._addi(ctx, codegen.PRIMARY, reg, -c)
+    elif op == '-' and codegen._fits_imm(c):
+        codegen._neg(ctx, codegen.PRIMARY, reg)
+        codegen._addi(ctx, codegen.PRIMARY, codegen.PRIMARY, c)
+    elif op == '<<' and not const_left:
+        codegen._shift_const(ctx, codegen.SHL, codegen.PRIMARY, reg, c)
+    elif op == '>>' and not const_left:
+        codegen._shift_const(ctx, codegen.SHRA, codegen.PRIMARY, reg, c)
+    elif op == '*' and 'strength' in ctx.opts and \
+            codegen._mul_const(ctx, codegen.PRIMARY, reg, c):
+        pass
+    elif op == '/' and not const_left and 'strength' in ctx.opts and \
+            codegen._div_const(ctx, codegen.PRIMARY, reg, c):
+        pass
+    else:
+        codegen._load_address_relative(ctx, codegen.SECONDARY, c)
+        if const_left:
+            _emit_binary(ctx, op, codegen.SECONDARY, reg)
+        else:
+            _emit_binary(ctx, op, reg, codegen.SECONDARY)
+
+
+def _emit_binary(ctx, op, lhs, rhs):
+    """Emit PRIMARY <- lhs op rhs
+    """
+    if op in scanner._rel_ops:
+        codegen._cmp(ctx, codegen.STATUS, lhs, rhs, op)
+    elif op == '+':
+        codegen._add(ctx, codegen.PRIMARY, lhs, rhs)
+    elif op == '-':
+        codegen._sub(ctx, codegen.PRIMARY, lhs, rhs)
+    elif op == '*':
+        codegen._mul(ctx, codegen.PRIMARY, lhs, rhs)
+    elif op == '/':
+        codegen._div(ctx, codegen.PRIMARY, lhs, rhs)
+    elif op == '<<':
+        codegen._shl(ctx, codegen.PRIMARY, lhs, rhs)
+    elif op == '>>':
+        # Values are signed, so shift in copies of the sign bit
+        codegen._shra(ctx, codegen.PRIMARY, lhs, rhs)
+    elif op == '|':
+        codegen._bitwise_or(ctx, codegen.PRIMARY, rhs, lhs)
+    elif op == '&':
+        codegen._bitwise_and(ctx, codegen.PRIMARY, rhs, lhs)
+
+
+# The condition functions below parse the same grammar as the expression
+# functions, but for an `if` or `while` where only the truth of the value
+# matters. Instead of computing it they jump to `label` when the truth is
+# `sense` and fall through otherwise, so comparisons become a subtract and a
+# branch on its result, and && and || skip the right operand when the left
+# one decides. They return `_JUMPED` when they have done so. An operand
+# followed by a bitwise operator is needed as a value, so in that case they
+# return the value as an expression function would and emit no jump
+
+_JUMPED = 'jumped'
+# Branch taken when the difference of the operands of a comparison shows it
+# is true, and the one taken when it shows it is false. > and <= compare
+# the difference the other way round (see `_cond_compare`)
+_true_branches = {'==': codegen._brzr, '!=': codegen._brnz,
+                  '<': codegen._brmi, '>=': codegen._brpl}
+_false_branches = {'==': codegen._brnz, '!=': codegen._brzr,
+                   '<': codegen._brpl, '>=': codegen._brmi}
+_swapped = {'>': '<', '<=': '>='}
+_bitwise_ops = {'|', '&'}
+
+
+def _condition(ctx, label, sense=False):
+    """Parse the condition of an `if` or `while` and jump to `label` when
+    its truth is `sense`
+    """
+    if 'cond-branch' in ctx.opts:
+        _cond_expression(ctx, sense, label)
+        return
+    _branch_on(ctx, _expression(ctx), sense, label)
+
+
+def _cond_expression(ctx, sense, label):
+    return _cond_chain(ctx, sense, label, '||', '|', _cond_term, _term)
+
+
+def _cond_term(ctx, sense, label):
+    return _cond_chain(ctx, sense, label, '&&', '&', _cond_factor, _factor)
+
+
+def _cond_chain(ctx, sense, label, logical, bitwise, cond_parse, parse):
+    """Parse operands with `cond_parse` joined by `logical` (|| or &&) or
+    `bitwise`, the operator of the same precedence. Operands that don't
+    decide the result on their own jump on to the next one. From the first
+    operand that is needed as a value on, the rest are computed with
+    `parse`
+    """
+    start = len(ctx.out)
+    # If every operand jumps to `label` on `sense` then no operand decides
+    # the result by falling through, otherwise each one except the last
+    # jumps on to the next one and falls through to the exit
+    through = sense != (logical == '||')
+    label_exit = None
+    mark = start
+    operands = 1
+    value = cond_parse(ctx, sense, label)
+    op = scanner._peek_operator(ctx.ts)
+    while value is _JUMPED and op == logical:
+        scanner._next(ctx.ts)
+        if through:
+            label_next = LABEL_PREFIX + str(_next_label(ctx))
+            _retarget(ctx, mark, label, label_next)
+            if label_exit is None:
+                label_exit = LABEL_PREFIX + str(_next_label(ctx))
+            _jump(ctx, label_exit)
+            codegen._post_label(ctx, label_next)
+        mark = len(ctx.out)
+        operands += 1
+        value = cond_parse(ctx, sense, label)
+        op = scanner._peek_operator(ctx.ts)
+    if value is not _JUMPED and operands > 1:
+        # The operands before this one jumped, so finish the jumps and turn
+        # them into the value of the whole chain
+        _branch_on(ctx, value, sense, label)
+        if label_exit is not None:
+            codegen._post_label(ctx, label_exit)
+        value = _jumps_to_value(ctx, start, sense, label)
+    elif label_exit is not None:
+        codegen._post_label(ctx, label_exit)
+    if value is _JUMPED:
+        return value
+    while op == logical or op == bitwise:
+        scanner._next(ctx.ts)
+        if op == logical:
+            value = _logical(ctx, op, value, parse)
+        else:
+            value = _binary(ctx, op, value, parse)
+        op = scanner._peek_operator(ctx.ts)
+    return _branch_or_value(ctx, value, sense, label)
+
+
+def _cond_factor(ctx, sense, label):
+    op = scanner._peek_operator(ctx.ts)
+    if op == '!':
+        scanner._next(ctx.ts)
+        value = _cond_factor(ctx, not sense, label)
+        if value is _JUMPED:
+            return value
+        if value is not None:
+            return -1 if value == 0 else 0
+        codegen._logical_not(ctx, codegen.PRIMARY, codegen.PRIMARY)
+        return None
+    if op == '~':
+        return _branch_or_value(ctx, _factor(ctx), sense, label)
+    if scanner._peek(ctx.ts) == '(' and \
+            scanner._after_group(ctx.ts) in ('&&', '||', ')'):
+        # A whole operand in parentheses is a condition too
+        scanner._match(ctx.ts, '(')
+        value = _cond_expression(ctx, sense, label)
+        scanner._match(ctx.ts, ')')
+        return value
+    return _cond_relation(ctx, sense, label)
+
+
+def _cond_relation(ctx, sense, label):
+    value = _a_expression(ctx)
+    op = scanner._peek_operator(ctx.ts)
+    while op in scanner._rel_ops:
+        scanner._next(ctx.ts)
+        lhs, rhs = _operands(ctx, value, _a_expression)
+        following = scanner._peek_operator(ctx.ts)
+        if following not in scanner._rel_ops and \
+                following not in _bitwise_ops:
+            _cond_compare(ctx, op, lhs, rhs, sense, label)
+            return _JUMPED
+        # Compared by the next comparison or used by a bitwise operator, so
+        # this one has to be a value
+        value = _combine(ctx, op, lhs, rhs)
+        op = following
+    return _branch_or_value(ctx, value, sense, label)
+
+
+def _cond_compare(ctx, op, lhs, rhs, sense, label):
+    """Jump to `label` if the truth of `lhs op rhs` is `sense`, branching on
+    the sign or zeroness of their difference
+    """
+    if not isinstance(lhs, str) and not isinstance(rhs, str):
+        _branch_on(ctx, codegen._fold_cmp(lhs, rhs, op), sense, label)
+        return
+    if op in _swapped:
+        # a > b is b - a < 0 and a <= b is b - a >= 0, the same test `_cmp`
+        # makes
+        op = _swapped[op]
+        lhs, rhs = rhs, lhs
+    _combine(ctx, '-', lhs, rhs)
+    codegen._load_branch_address_relative(ctx, label)
+    branches = _true_branches if sense else _false_branches
+    branches[op](ctx, codegen.BRANCH_TARGET, codegen.PRIMARY)
+
+
+def _branch_or_value(ctx, value, sense, label):
+    """Return `value` if a bitwise operator needs it, otherwise jump on it
+    and return `_JUMPED`
+    """
+    if scanner._peek_operator(ctx.ts) in _bitwise_ops:
+        return value
+    _branch_on(ctx, value, sense, label)
+    return _JUMPED
+
+
+def _jumps_to_value(ctx, start, sense, label):
+    """Turn the code emitted from `start` on, which jumps to `label` when
+    something has truth `sense` and falls through otherwise, into code that
+    leaves -1 for true or 0 for false in the primary register instead
+    """
+    label_value = LABEL_PREFIX + str(_next_label(ctx))
+    label_end = LABEL_PREFIX + str(_next_label(ctx))
+    _retarget(ctx, start, label, label_value)
+    codegen._load_primary_address(ctx, codegen.ZERO, 0 if sense else -1)
+    _jump(ctx, label_end)
+    codegen._post_label(ctx, label_value)
+    codegen._load_primary_address(ctx, codegen.ZERO, -1 if sense else 0)
+    codegen._post_label(ctx, label_end)
+    return None
+
+
+def _branch_on(ctx, value, sense, label):
+    """Jump to `label` if the truth of `value`, as returned by an expression
+    function, is `sense`
+    """
+    if value is not None:
+        if (value != 0) == sense:
+            _jump(ctx, label)
+        return
+    codegen._load_branch_address_relative(ctx, label)
+    if sense:
+        codegen._brnz_def(ctx)
     else:
-        # Unget the op chars and reset scanner._nchar
-        f.seek(-len(op), 1)
-        scanner._nchar = f.read(1).decode("utf-8")
+        codegen._brzr_def(ctx)
+
+
+def _jump(ctx, label):
+    codegen._load_branch_address_relative(ctx, label)
+    codegen._br_def(ctx)
+
+
+def _retarget(ctx, start, old, new):
+    """Make the branches emitted from `start` on that go to label `old` go to
+    `new` instead
+    """
+    out = ctx.out
+    for k in range(start, len(out)):
+        i = out[k]
+        if i.op == codegen.LAR and i.args[1] == old:
+            out[k] = codegen._Instr(codegen.LAR, (i.args[0], new), i.line)
 
 
-def _next_label():
-    global _label_count
-    label = _label_count
-    _label_count += 1
+def _next_label(ctx):
+    label = ctx.label_count
+    ctx.label_count += 1
     return label
 
 
-def _lookup(symbol):
+def _lookup(ctx, symbol):
+    if ctx.stats is not None:
+        ctx.stats.lookups += 1
     # Search symbol tables in reverse order so that we find the symbol with
     # this name in the narrowest scope
-    for i in range(len(_symtab)-1, -1, -1):
-        if symbol in _symtab[i]:
-            return _symtab[i][symbol]
+    for i in range(len(ctx.symtab)-1, -1, -1):
+        if symbol in ctx.symtab[i]:
+            return ctx.symtab[i][symbol]
     return None
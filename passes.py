@@ -0,0 +1,744 @@
+"""Pass manager and transforms of the optimizing middle end. With the 'ir'
+optimization on, a program is parsed into a syntax tree (see `syntax`), and
+then each global initializer and function in turn is built into IR (see
+`ir`), transformed, and lowered to RSRC code (see `lower`). Functions are
+compiled in source order, so the callees of a function have all been
+compiled by the time it is (a function can only call itself or one defined
+before it), and their IR can be inlined into it. An initializer that is
+only left storing a constant isn't lowered at all: its global starts out
+holding the constant instead.
+
+A transform is called as `transform(ctx, fn, analyses)` and returns how many
+changes it made to the function `fn`. `analyses` hands out the results of
+the analyses in `analysis`, computed when first asked for and thrown away
+once a transform has changed something.
+"""
+
+import analysis
+import codegen
+import ir
+import lower
+import parser
+import pgo
+import stats
+import syntax
+
+_ANALYSES = {'liveness': analysis._liveness, 'reaching': analysis._reaching,
+             'dominators': analysis._dominators, 'loops': analysis._loops,
+             'depths': analysis._loop_depths}
+# Most times in a row the scalar transforms are run over a function while
+# they keep finding something to do
+_MAX_ROUNDS = 4
+
+
+class _Analyses:
+    """The analyses of one function, kept until `invalidate` is called
+    """
+    __slots__ = ('ctx', 'fn', 'results')
+
+    def __init__(self, ctx, fn):
+        self.ctx = ctx
+        self.fn = fn
+        self.results = {}
+
+    def get(self, name):
+        if name not in self.results:
+            with stats._phase(self.ctx, 'analysis'):
+                self.results[name] = _ANALYSES[name](self.fn)
+        return self.results[name]
+
+    def invalidate(self):
+        self.results = {}
+
+
+class _PassManager:
+    """Runs transforms over the IR of one function, counting the changes
+    each one makes
+    """
+    __slots__ = ('ctx', 'fn', 'analyses', 'stats')
+
+    def __init__(self, ctx, fn):
+        self.ctx = ctx
+        self.fn = fn
+        self.analyses = _Analyses(ctx, fn)
+        self.stats = {}
+
+    def run(self, name, transform):
+        """Run `transform` once, recording its changes under `name` unless
+        that is None. Return the number of changes
+        """
+        with stats._phase(self.ctx, name or 'cleanup'):
+            n = transform(self.ctx, self.fn, self.analyses)
+        if n:
+            self.analyses.invalidate()
+            if name is not None:
+                self.stats[name] = self.stats.get(name, 0) + n
+        return n
+
+    def fixpoint(self, transforms):
+        """Run the (name, transform) pairs `transforms` in order, over and
+        over until they change nothing or `_MAX_ROUNDS` is reached
+        """
+        for _ in range(_MAX_ROUNDS):
+            if not sum([self.run(name, t) for name, t in transforms]):
+                return
+
+
+def _program(ctx, program):
+    """Compile the `syntax._Program` `program` into `ctx.out`. The code is
+    laid out as `parser._program` lays it out
+    """
+    if 'inline' in ctx.opts:
+        ctx.calls = _call_counts(program)
+    if ctx.counters is not None:
+        pgo._instrument(ctx, program)
+    for decl in program.globals:
+        if decl.value is None:
+            codegen._alloc_global(ctx, decl.var.label)
+            continue
+        fn = ir._build_init(decl, ctx.opts)
+        analyses = _optimize(ctx, fn)
+        value = _constant_init(fn)
+        if value is not None:
+            # Known at compile time, so the word holds it from the start
+            codegen._const_global(ctx, decl.var.label, value)
+            continue
+        codegen._alloc_global(ctx, decl.var.label)
+        with stats._phase(ctx, 'codegen'):
+            lower._function(ctx, fn, analyses)
+    # After all the global variable declarations we want to jump to main
+    codegen._load_primary_address_relative(ctx, parser.MAIN_LABEL)
+    codegen._br(ctx, codegen.PRIMARY)
+    for fdef in program.functions:
+        fn = ir._build_function(fdef, ctx.opts, ctx.profile)
+        analyses = _optimize(ctx, fn)
+        fdef.func.ir = fn
+        with stats._phase(ctx, 'codegen'):
+            lower._function(ctx, fn, analyses)
+
+
+def _constant_init(fn):
+    """Return the value the optimized initializer `fn` stores, if it is a
+    constant and that is all `fn` does, otherwise None
+    """
+    if len(fn.blocks) != 1 or len(fn.blocks[0].instrs) != 2:
+        return None
+    store = fn.blocks[0].instrs[0]
+    if store.op != 'store' or not isinstance(store.args[0], int) or \
+            store.args[1:] != (0, fn.label):
+        return None
+    return store.args[0]
+
+
+def _optimize(ctx, fn):
+    """Run the transforms that are on over `fn` and return its analyses
+    """
+    opts = ctx.opts
+    pm = _PassManager(ctx, fn)
+    ctx.unreachable += ir._link(fn)
+    pm.run(None, _cleanup)
+    if 'inline' in opts and fn.kind != 'init':
+        pm.run('inline', _inline)
+    if 'tail-calls' in opts and fn.kind == 'function':
+        pm.run('tail-calls', _tail_recursion)
+    scalar = [(name, t) for name, t in _SCALAR if name in opts]
+    scalar.append((None, _cleanup))
+    pm.fixpoint(scalar)
+    if 'loop-hoist' in opts:
+        hoisted = pm.run('loop-hoist', _loop_hoist)
+        # Blocks may have been added in front of loops for the hoisted code
+        pm.analyses.invalidate()
+        pm.run(None, _cleanup)
+        if hoisted:
+            pm.fixpoint(scalar)
+    if pm.stats:
+        ctx.report.append("ir: {}: {}".format(fn.label, ", ".join(
+            "{} {}".format(name, n) for name, n in pm.stats.items())))
+    return pm.analyses
+
+
+def _call_counts(program):
+    """Return a dict of the number of calls to each function in `program`,
+    by name
+    """
+    counts = {}
+    stack = [decl.value for decl in program.globals]
+    stack.extend(fdef.body for fdef in program.functions)
+    while stack:
+        node = stack.pop()
+        if node is None:
+            continue
+        if isinstance(node, list):
+            stack.extend(node)
+            continue
+        if isinstance(node, syntax._Call):
+            counts[node.func.name] = counts.get(node.func.name, 0) + 1
+        for field in node.__slots__:
+            if field != 'line':
+                value = getattr(node, field)
+                if isinstance(value, list) or hasattr(value, '__slots__') \
+                        and not isinstance(value, (syntax._Global,
+                                                   syntax._Local,
+                                                   syntax._Function)):
+                    stack.append(value)
+    return counts
+
+
+#################################################
+# Control Flow                                  #
+#################################################
+
+def _cleanup(ctx, fn, analyses):
+    """Tidy the control flow graph: branches with one target become jumps,
+    jumps to blocks that only jump on go straight to where those go, and a
+    block only ever entered from the one before it is merged into it. Not an
+    optimization as such, so it is always run
+    """
+    changes = 0
+    for block in fn.blocks:
+        term = block.instrs[-1]
+        if term.op == 'branch' and term.args[3] is term.args[4]:
+            block.instrs[-1] = ir._Ins('jump', None, (term.args[3],),
+                                       term.line)
+            changes += 1
+    forward = {}
+    for block in fn.blocks[1:]:
+        if len(block.instrs) == 1 and block.instrs[0].op == 'jump':
+            forward[block] = block.instrs[0].args[0]
+    for block in fn.blocks:
+        term = block.instrs[-1]
+        for target in ir._targets(term):
+            final = target
+            seen = set()
+            while final in forward and final not in seen:
+                seen.add(final)
+                final = forward[final]
+            if final is not target and final not in seen:
+                ir._retarget(term, target, final)
+                changes += 1
+    before = list(fn.blocks)
+    ir._link(fn)
+    for block in before:
+        if block not in fn.blocks and block not in forward:
+            ctx.unreachable += len(block.instrs)
+    merged = True
+    while merged:
+        merged = False
+        for block in fn.blocks:
+            term = block.instrs[-1]
+            if term.op != 'jump':
+                continue
+            succ = term.args[0]
+            if succ is block or succ is fn.blocks[0] or \
+                    len(succ.preds) != 1:
+                continue
+            block.instrs[-1:] = succ.instrs
+            fn.blocks.remove(succ)
+            ir._link(fn)
+            changes += 1
+            merged = True
+            break
+    return changes + len(before) - len(fn.blocks)
+
+
+def _split_entry(fn):
+    """Move everything in the entry block after the parameters into a new
+    block of its own, and return that block
+    """
+    entry = fn.blocks[0]
+    k = 0
+    while entry.instrs[k].op == 'param':
+        k += 1
+    body = ir._new_block(fn)
+    body.instrs = entry.instrs[k:]
+    entry.instrs = entry.instrs[:k] + [ir._Ins('jump', None, (body,))]
+    fn.blocks.insert(1, body)
+    ir._link(fn)
+    return body
+
+
+#################################################
+# Scalar Transforms                             #
+#################################################
+
+def _const_fold(ctx, fn, analyses):
+    """Replace each temporary whose reaching definitions all assign it the
+    same constant by that constant, and fold the instructions whose
+    operands are then known. A branch that can only go one way becomes a
+    jump
+    """
+    reach = analyses.get('reaching')
+    changes = 0
+    branches = 0
+    for block in fn.blocks:
+        defs = analysis._defs_by_temp(reach[block])
+
+        def const(x):
+            if not isinstance(x, ir._Temp) or x not in defs:
+                return x
+            values = set()
+            for d in defs[x]:
+                if d.op != 'copy' or not isinstance(d.args[0], int):
+                    return x
+                values.add(d.args[0])
+            return values.pop() if len(values) == 1 else x
+
+        for ins in block.instrs:
+            changed = ir._map_operands(ins, const)
+            if _fold(ins):
+                changed = True
+                branches += ins.op == 'jump'
+            changes += changed
+            if ins.dst is not None:
+                defs[ins.dst] = {ins}
+    if branches:
+        ctx.unreachable += ir._link(fn)
+    return changes
+
+
+def _fold(ins):
+    """Fold `ins` in place if its operands allow it. Return whether it
+    changed
+    """
+    op, a = ins.op, ins.args
+    if op == 'bin':
+        o, x, y = a
+        if isinstance(x, int) and isinstance(y, int):
+            value = codegen._fold(o, x, y)
+            if value is None:
+                # Division by zero is left to run time
+                return False
+            ins.op, ins.args = 'copy', (value,)
+            return True
+        same = _identity(o, x, y)
+        if same is not None:
+            ins.op, ins.args = 'copy', same
+            return True
+    elif (op == 'neg' or op == 'not') and isinstance(a[0], int):
+        ins.op = 'copy'
+        ins.args = (codegen._wrap(-a[0]) if op == 'neg' else ~a[0],)
+        return True
+    elif op == 'branch' and isinstance(a[1], int) and isinstance(a[2], int):
+        taken = codegen._fold_cmp(a[1], a[2], a[0]) != 0
+        ins.op, ins.args = 'jump', (a[3] if taken else a[4],)
+        return True
+    return False
+
+
+# Operand that leaves the other one unchanged on either side (left only for
+# - and !=, which is a - b), and one that makes the result itself
+_NEUTRAL = {'+': 0, '-': 0, '!=': 0, '|': 0, '*': 1, '&': -1, '/': 1}
+_ABSORBING = {'*': 0, '&': 0, '|': -1}
+
+
+def _identity(op, x, y):
+    """Return (v,) if `x op y` is just the operand v whatever the value of
+    the other one, otherwise None
+    """
+    if op == '<<' or op == '>>':
+        if isinstance(y, int) and y & (codegen.WORD - 1) == 0:
+            return x,
+        if isinstance(x, int) and x == 0:
+            return 0,
+        return None
+    if isinstance(y, int):
+        if y == _NEUTRAL.get(op):
+            return x,
+        if y == _ABSORBING.get(op):
+            return y,
+    if isinstance(x, int) and op in ir.COMMUTATIVE:
+        if x == _NEUTRAL.get(op):
+            return y,
+        if x == _ABSORBING.get(op):
+            return x,
+    return None
+
+
+def _copy_prop(ctx, fn, analyses):
+    """Replace the reads of a temporary that was copied from another one by
+    reads of that one, wherever the copy is sure to have been the last
+    assignment to either (available copies)
+    """
+    copies = set()
+    involving = {}
+    for block in fn.blocks:
+        for ins in block.instrs:
+            if ins.op == 'copy' and isinstance(ins.args[0], ir._Temp) and \
+                    ins.args[0] is not ins.dst:
+                copies.add(ins)
+                involving.setdefault(ins.dst, set()).add(ins)
+                involving.setdefault(ins.args[0], set()).add(ins)
+    if not copies:
+        return 0
+
+    def transfer(block, avail):
+        for ins in block.instrs:
+            if ins.dst is not None:
+                avail -= involving.get(ins.dst, set())
+                if ins in copies:
+                    avail.add(ins)
+        return avail
+
+    entry = fn.blocks[0]
+    avail_in = {block: set(copies) for block in fn.blocks}
+    avail_in[entry] = set()
+    avail_out = {block: transfer(block, set(avail_in[block]))
+                 for block in fn.blocks}
+    changed = True
+    while changed:
+        changed = False
+        for block in fn.blocks:
+            if block is entry:
+                continue
+            in_ = set(copies)
+            for pred in block.preds:
+                in_ &= avail_out[pred]
+            if in_ != avail_in[block]:
+                avail_in[block] = in_
+                avail_out[block] = transfer(block, set(in_))
+                changed = True
+    changes = 0
+    for block in fn.blocks:
+        avail = set(avail_in[block])
+        for ins in block.instrs:
+            sources = {c.dst: c.args[0] for c in avail}
+            if sources and ir._map_operands(
+                    ins, lambda x: sources.get(x, x)
+                    if isinstance(x, ir._Temp) else x):
+                changes += 1
+            if ins.dst is not None:
+                avail -= involving.get(ins.dst, set())
+                if ins in copies and ins.args[0] is not ins.dst:
+                    avail.add(ins)
+    return changes
+
+
+def _cse(ctx, fn, analyses):
+    """Common subexpression elimination within each block (local value
+    numbering). A value computed again is copied from the temporary already
+    holding it instead, and a load from where a store has just been made is
+    replaced by the value stored
+    """
+    changes = 0
+    for block in fn.blocks:
+        # Expression key to the operand holding its value
+        table = {}
+        for ins in block.instrs:
+            key = _key(ins)
+            if key is not None:
+                known = table.get(key)
+                if known is not None and known is not ins.dst:
+                    ins.op, ins.args = 'copy', (known,)
+                    changes += 1
+                    key = None
+            if ins.op == 'store':
+                value, base, offset = ins.args
+                label = base == 0 and isinstance(offset, str)
+                for k in [k for k in table if k[0] == 'load' and
+                          (not label or k[2] == offset or
+                           not isinstance(k[2], str))]:
+                    del table[k]
+                table[('load', base, offset)] = value
+            elif ins.op == 'call':
+                for k in [k for k in table if k[0] == 'load']:
+                    del table[k]
+            dst = ins.dst
+            if dst is not None:
+                for k in [k for k, v in table.items()
+                          if v is dst or dst in k]:
+                    del table[k]
+                if key is not None and dst not in key:
+                    table[key] = dst
+    return changes
+
+
+def _key(ins):
+    """Return a key that is equal for instructions computing the same value
+    from the same operands, or None if `ins` isn't one to look up
+    """
+    op, a = ins.op, ins.args
+    if op == 'bin':
+        o, x, y = a
+        if o in ir.COMMUTATIVE and _rank(y) < _rank(x):
+            x, y = y, x
+        return o, x, y
+    if op == 'neg' or op == 'not':
+        return op, a[0]
+    if op == 'load':
+        return 'load', a[0], a[1]
+    return None
+
+
+def _rank(x):
+    return (0, x) if isinstance(x, int) else (1, x.id)
+
+
+def _dead_code(ctx, fn, analyses):
+    """Remove the instructions with no effect but writing a temporary that
+    is never read afterwards
+    """
+    live_out = analyses.get('liveness')[1]
+    removed = 0
+    for block in fn.blocks:
+        live = set(live_out[block])
+        kept = []
+        for ins in reversed(block.instrs):
+            dst = ins.dst
+            if ins.op in ir.PURE and (dst not in live or (
+                    ins.op == 'copy' and ins.args[0] is dst)):
+                removed += 1
+                continue
+            if dst is not None:
+                if dst not in live:
+                    # A call is still made for what else it does
+                    ins.dst = None
+                    removed += 1
+                live.discard(dst)
+            live.update(ir._uses(ins))
+            kept.append(ins)
+        kept.reverse()
+        block.instrs = kept
+    return removed
+
+
+_SCALAR = (('const-fold', _const_fold), ('copy-prop', _copy_prop),
+           ('cse', _cse), ('dce', _dead_code))
+
+
+#################################################
+# Loops                                         #
+#################################################
+
+def _loop_hoist(ctx, fn, analyses):
+    """Loop invariant code motion: move the instructions of each loop whose
+    value is the same every time around into a block run once before it,
+    innermost loops first
+    """
+    if _add_preheaders(fn):
+        analyses.invalidate()
+    hoisted = 0
+    for header, body in analyses.get('loops'):
+        outside = [p for p in header.preds if p not in body]
+        if len(outside) != 1:
+            continue
+        n = _hoist(fn, header, body, outside[0], analyses)
+        if n:
+            hoisted += n
+            analyses.invalidate()
+    return hoisted
+
+
+def _add_preheaders(fn):
+    """Give every loop a preheader: a block that only goes to its header,
+    and that every edge into the loop from outside goes through. Return
+    whether any had to be added
+    """
+    added = False
+    for header, body in analysis._loops(fn):
+        outside = [p for p in header.preds if p not in body]
+        if not outside or (len(outside) == 1 and
+                           len(outside[0].succs) == 1):
+            continue
+        pre = ir._new_block(fn)
+        pre.instrs = [ir._Ins('jump', None, (header,))]
+        pre.cold = header.cold
+        for pred in outside:
+            ir._retarget(pred.instrs[-1], header, pre)
+        fn.blocks.insert(fn.blocks.index(header), pre)
+        ir._link(fn)
+        added = True
+    return added
+
+
+def _hoist(fn, header, body, pre, analyses):
+    """Move the invariant instructions of the loop `body` into its
+    preheader `pre`. Return how many were moved
+    """
+    live_in = analyses.get('liveness')[0]
+    idom = analyses.get('dominators')
+    defs = {}
+    calls = False
+    stores = False
+    stored = set()
+    for block in body:
+        for ins in block.instrs:
+            if ins.dst is not None:
+                defs[ins.dst] = defs.get(ins.dst, 0) + 1
+            if ins.op == 'call':
+                calls = True
+            elif ins.op == 'store':
+                value, base, offset = ins.args
+                if base == 0 and isinstance(offset, str):
+                    stored.add(offset)
+                else:
+                    stores = True
+    exits = [(block, succ) for block in body for succ in block.succs
+             if succ not in body]
+    order = [block for block in fn.blocks if block in body]
+    moved = 0
+    changed = True
+    while changed:
+        changed = False
+        for block in order:
+            for ins in list(block.instrs):
+                if not _invariant(ins, defs, calls, stores, stored):
+                    continue
+                dst = ins.dst
+                if defs[dst] != 1 or dst in live_in[header]:
+                    continue
+                if not all(analysis._dominates(idom, block, e)
+                           for e, _ in exits) and \
+                        any(dst in live_in[s] for _, s in exits):
+                    # The value may be needed after the loop when the loop
+                    # has left before computing it
+                    continue
+                block.instrs.remove(ins)
+                pre.instrs.insert(len(pre.instrs) - 1, ins)
+                del defs[dst]
+                moved += 1
+                changed = True
+    return moved
+
+
+def _invariant(ins, defs, calls, stores, stored):
+    """Return whether `ins` computes the same value every time around a
+    loop in which the temporaries in `defs` are assigned, and can be run
+    before it even if it wouldn't have been
+    """
+    op = ins.op
+    if op not in ir.PURE or op == 'param':
+        return False
+    if any(isinstance(x, ir._Temp) and x in defs for x in ir._operands(ins)):
+        return False
+    if op == 'bin' and ins.args[0] == '/':
+        # Division by zero can't be allowed to happen earlier
+        return isinstance(ins.args[2], int) and ins.args[2] != 0
+    if op == 'load':
+        if calls:
+            return False
+        base, offset = ins.args
+        if base == 0 and isinstance(offset, str):
+            return not stores and offset not in stored
+        return not stores and not stored
+    return True
+
+
+#################################################
+# Calls                                         #
+#################################################
+
+def _tail_recursion(ctx, fn, analyses):
+    """Turn the calls a function makes to itself in tail position into
+    jumps back to the top of its body, assigning the arguments to the
+    parameters, so the recursion becomes a loop
+    """
+    sites = [block for block in fn.blocks if _tail_call(block, fn.sym)]
+    if not sites:
+        return 0
+    top = _split_entry(fn)
+    params = {ins.args[0]: ins.dst for ins in fn.blocks[0].instrs
+              if ins.op == 'param'}
+    for block in sites:
+        call = block.instrs[-2]
+        ctx.report.append("tail-calls: {} into a loop on line {}".format(
+            fn.sym.name, call.line))
+        args = call.args[1]
+        # All the arguments are read before any parameter is assigned
+        values = [ir._new_temp(fn) for _ in args]
+        code = [ir._Ins('copy', t, (a,), call.line)
+                for t, a in zip(values, args)]
+        code.extend(ir._Ins('copy', params[i], (t,), call.line)
+                    for i, t in enumerate(values) if i in params)
+        code.append(ir._Ins('jump', None, (top,), call.line))
+        block.instrs[-2:] = code
+    ir._link(fn)
+    return len(sites)
+
+
+def _tail_call(block, callee=None):
+    """Return whether `block` ends by returning the value of a call (to
+    `callee`, if given)
+    """
+    instrs = block.instrs
+    if len(instrs) < 2 or instrs[-1].op != 'ret' or instrs[-2].op != 'call':
+        return False
+    call = instrs[-2]
+    return call.dst is not None and instrs[-1].args[0] is call.dst and \
+        (callee is None or call.args[0] is callee)
+
+
+def _inline(ctx, fn, analyses):
+    """Replace calls to small functions, unless the profile says they seldom
+    run, and to those only called from one place, with a copy of their IR.
+    Calls in the copies are left alone
+    """
+    calls = [ins for block in fn.blocks for ins in block.instrs
+             if ins.op == 'call' and _inlinable(ctx, fn, ins)]
+    for call in calls:
+        block = next(b for b in fn.blocks
+                     if any(ins is call for ins in b.instrs))
+        _inline_call(ctx, fn, block, call)
+    return len(calls)
+
+
+def _inlinable(ctx, fn, call):
+    callee = call.args[0]
+    if callee is fn.sym or callee.ir is None:
+        return False
+    size = callee.entry.get('size')
+    return (size is not None and size <= ctx.inline_threshold and
+            pgo._hot_call(ctx, pgo._line_runs(ctx.profile, fn.sym.name,
+                                              call.line))) or \
+        ctx.calls.get(callee.name) == 1
+
+
+def _inline_call(ctx, fn, block, call):
+    """Replace `call`, in `block`, by a copy of the IR of its callee. The
+    parameters of the copy are assigned the arguments, and a return assigns
+    its value to the temporary the call wrote and goes on to the code after
+    the call
+    """
+    callee = call.args[0]
+    ctx.report.append("inline: {} into {} on line {}".format(
+        callee.name, fn.sym.name, call.line))
+    k = next(i for i, ins in enumerate(block.instrs) if ins is call)
+    after = ir._new_block(fn)
+    after.instrs = block.instrs[k + 1:]
+    src = callee.ir
+    blocks = {b: ir._new_block(fn) for b in src.blocks}
+    for new in [after] + list(blocks.values()):
+        new.cold = block.cold
+    temps = {}
+
+    def rename(x):
+        if not isinstance(x, ir._Temp):
+            return x
+        if x not in temps:
+            temps[x] = ir._new_temp(fn, x.name)
+        return temps[x]
+
+    args = call.args[1]
+    for b in src.blocks:
+        code = blocks[b].instrs
+        for ins in b.instrs:
+            if ins.op == 'param':
+                if ins.args[0] < len(args):
+                    code.append(ir._Ins('copy', rename(ins.dst),
+                                        (args[ins.args[0]],), call.line))
+                continue
+            if ins.op == 'ret':
+                if call.dst is not None and ins.args[0] is not None:
+                    code.append(ir._Ins('copy', call.dst,
+                                        (rename(ins.args[0]),), ins.line))
+                code.append(ir._Ins('jump', None, (after,), ins.line))
+                continue
+            new = ir._Ins(ins.op, rename(ins.dst), ins.args, ins.line)
+            ir._map_operands(new, rename)
+            for target in ir._targets(new):
+                ir._retarget(new, target, blocks[target])
+            code.append(new)
+    block.instrs[k:] = [ir._Ins('jump', None, (blocks[src.blocks[0]],),
+                                call.line)]
+    pos = fn.blocks.index(block) + 1
+    fn.blocks[pos:pos] = [blocks[b] for b in src.blocks] + [after]
+    ir._link(fn)
@@ -0,0 +1,262 @@
+"""Peephole optimizer over the instruction list built by codegen. It removes
+the redundant stack traffic that the one pass code generator produces, e.g.
+a push of the primary register that is popped again a few instructions later
+without the stack having been touched in between.
+"""
+
+import codegen
+
+# Maximum number of instructions allowed between a push and its pop
+_DEFAULT_WINDOW = 8
+_STACK_WORD = codegen.WORD // codegen.BYTE
+
+
+def _optimize(instrs, window=_DEFAULT_WINDOW):
+    """Optimize the list `instrs` until no rule applies any more. Return the
+    new list and a dict of the number of instructions each rule removed
+    """
+    stats = {'push/pop': 0, 'simplify': 0, 'dead move': 0, 'stack adjust': 0}
+    while True:
+        instrs, removed = _push_pop(instrs, window)
+        if removed:
+            stats['push/pop'] += removed
+            continue
+        instrs, removed = _dead_move(instrs, window)
+        if removed:
+            stats['dead move'] += removed
+            continue
+        instrs, removed = _simplify(instrs)
+        if removed:
+            stats['simplify'] += removed
+            continue
+        instrs, removed, moved = _sink_stack_adjust(instrs)
+        stats['stack adjust'] += removed
+        if not removed and not moved:
+            return instrs, stats
+
+
+def _is_stack_adjust(i, c=None):
+    return i.op == codegen.ADDI and i.args[0] == codegen.STACK and \
+        i.args[1] == codegen.STACK and (c is None or i.args[2] == c)
+
+
+def _push_pop(instrs, window):
+    """st X, 0(r31); addi r31, r31, -4; S; addi r31, r31, 4; ld Y, 0(r31)
+    becomes la Y, 0(X); S when S leaves the stack and Y alone
+    """
+    out = []
+    removed = 0
+    i = 0
+    n = len(instrs)
+    while i < n:
+        ins = instrs[i]
+        if ins.op == codegen.ST and ins.args[1] == 0 and \
+                ins.args[2] == codegen.STACK and i + 1 < n and \
+                _is_stack_adjust(instrs[i + 1], -_STACK_WORD):
+            pop = _find_pop(instrs, i + 2, window)
+            if pop is not None:
+                src, dst = ins.args[0], instrs[pop + 1].args[0]
+                if src != dst:
+                    out.append(codegen._Instr(codegen.LA, (dst, 0, src),
+                                              instrs[pop + 1].line))
+                    removed -= 1
+                out.extend(instrs[i + 2:pop])
+                removed += 4
+                i = pop + 2
+                continue
+        out.append(ins)
+        i += 1
+    return out, removed
+
+
+def _find_pop(instrs, start, window):
+    """Return the index of the `addi r31, r31, 4; ld Y, 0(r31)` pop that
+    matches a push ending just before `start`, or None if there isn't one
+    that can be removed
+    """
+    end = min(start + window + 1, len(instrs) - 1)
+    for k in range(start, end):
+        ins = instrs[k]
+        if _is_stack_adjust(ins, _STACK_WORD):
+            ld = instrs[k + 1]
+            if ld.op != codegen.LD or ld.args[1] != 0 or \
+                    ld.args[2] != codegen.STACK:
+                return None
+            dst = ld.args[0]
+            # The popped value is moved into Y before S runs, so S can't use
+            # Y at all
+            for s in instrs[start:k]:
+                if codegen._writes(s) == dst or dst in codegen._reads(s):
+                    return None
+            return k
+        if ins.op in codegen._BARRIERS or ins.op == codegen.ST or \
+                codegen._writes(ins) == codegen.STACK or \
+                codegen.STACK in codegen._reads(ins):
+            return None
+    return None
+
+
+def _is_dead(instrs, start, reg, window):
+    """Return whether `reg` is overwritten before it is read again, looking
+    at no more than `window` instructions from `start`. The temporaries
+    don't survive a call, so a call kills them
+    """
+    for ins in instrs[start:start + window]:
+        if reg in codegen._reads(ins):
+            return False
+        if ins.op == codegen.BRL:
+            return reg in codegen.TEMPS
+        if ins.op in codegen._BARRIERS:
+            return False
+        if codegen._writes(ins) == reg:
+            return True
+    return False
+
+
+def _dead_move(instrs, window):
+    """Forward the moves the code generator leaves around variables held in
+    registers, when the register moved from or to is dead afterwards:
+    la A, 0(B); S reading A                   S reading B instead
+    A <- ...; la B, 0(A)                      B <- ...
+    """
+    out = []
+    removed = 0
+    i = 0
+    n = len(instrs)
+    while i < n:
+        ins = instrs[i]
+        a = ins.args
+        if i + 1 < n and ins.op not in codegen._BARRIERS and \
+                ins.op != codegen.ST:
+            nxt = instrs[i + 1]
+            dst = a[0]
+            if ins.op == codegen.LA and a[1] == 0 and \
+                    a[2] != codegen.ZERO and dst != a[2] and \
+                    nxt.op not in codegen._BARRIERS and \
+                    dst in codegen._reads(nxt) and \
+                    (codegen._writes(nxt) == dst or
+                     _is_dead(instrs, i + 2, dst, window)):
+                out.append(codegen._replace_reads(nxt, dst, a[2]))
+                removed += 1
+                i += 2
+                continue
+            if nxt.op == codegen.LA and nxt.args[1] == 0 and \
+                    nxt.args[2] == dst and nxt.args[0] != dst and \
+                    _is_dead(instrs, i + 2, dst, window):
+                out.append(codegen._Instr(ins.op, (nxt.args[0],) + a[1:],
+                                          ins.line))
+                removed += 1
+                i += 2
+                continue
+        out.append(ins)
+        i += 1
+    return out, removed
+
+
+def _simplify(instrs):
+    """Remove no-op instructions and fold adjacent pairs:
+    addi A, A, 0 / la A, 0(A)                 removed
+    addi A, A, a; addi A, A, b                addi A, A, a+b
+    la A, 0(B); la B, 0(A)                    la A, 0(B)
+    st X, c(B); ld Y, c(B)                    st X, c(B); la Y, 0(X)
+    X <- ...; la Y, 0(X); X <- (not X)        Y <- ...; X <- (not X)
+    """
+    out = []
+    removed = 0
+    for ins in instrs:
+        op, a = ins.op, ins.args
+        if (op == codegen.ADDI and a[0] == a[1] and a[2] == 0) or \
+                (op == codegen.LA and a[0] == a[2] and a[1] == 0):
+            removed += 1
+            continue
+        prev = out[-1] if out else None
+        if prev is not None:
+            p_op, p = prev.op, prev.args
+            if op == codegen.ADDI and p_op == codegen.ADDI and \
+                    a[0] == a[1] == p[0] == p[1]:
+                out.pop()
+                c = p[2] + a[2]
+                if c != 0:
+                    out.append(codegen._Instr(codegen.ADDI, (a[0], a[0], c),
+                                              prev.line))
+                    removed += 1
+                else:
+                    removed += 2
+                continue
+            if op == codegen.LA and p_op == codegen.LA and a[1] == 0 and \
+                    p[1] == 0 and a[0] == p[2] and a[2] == p[0]:
+                removed += 1
+                continue
+            if op == codegen.LD and p_op == codegen.ST and a[1] == p[1] and \
+                    a[2] == p[2]:
+                if a[0] != p[0]:
+                    out.append(codegen._Instr(codegen.LA, (a[0], 0, p[0]),
+                                              ins.line))
+                else:
+                    removed += 1
+                continue
+            if len(out) > 1 and p_op == codegen.LA and p[1] == 0 and \
+                    p[2] != codegen.ZERO and p[0] != p[2]:
+                dead = p[2]
+                def_ = out[-2]
+                if codegen._writes(ins) == dead and \
+                        dead not in codegen._reads(ins) and \
+                        codegen._writes(def_) == dead:
+                    # The moved register is overwritten straight away, so
+                    # compute the value into the move's target instead
+                    out[-2] = codegen._Instr(def_.op,
+                                             (p[0],) + def_.args[1:],
+                                             def_.line)
+                    out.pop()
+                    removed += 1
+        out.append(ins)
+    return out, removed
+
+
+def _sink_stack_adjust(instrs):
+    """Move each `addi r31, r31, c` down past instructions that only use r31
+    as a base register (adjusting their offsets), merging it with any other
+    stack adjustment it meets. Return the new list, the number of
+    instructions removed and whether anything moved
+    """
+    out = []
+    removed = 0
+    moved = False
+    pending = None
+    # Source line of the last adjustment merged into `pending`
+    line = None
+    for ins in instrs:
+        if _is_stack_adjust(ins):
+            if pending is None:
+                pending = ins.args[2]
+            else:
+                pending += ins.args[2]
+                removed += 1
+            line = ins.line
+            continue
+        if pending is not None:
+            op, a = ins.op, ins.args
+            if op in (codegen.LD, codegen.ST, codegen.LA) and \
+                    a[2] == codegen.STACK and a[0] != codegen.STACK and \
+                    isinstance(a[1], int):
+                out.append(codegen._Instr(op, (a[0], a[1] + pending, a[2]),
+                                          ins.line))
+                moved = True
+                continue
+            if op not in codegen._BARRIERS and \
+                    codegen._writes(ins) != codegen.STACK and \
+                    codegen.STACK not in codegen._reads(ins):
+                out.append(ins)
+                moved = True
+                continue
+            if pending != 0:
+                out.append(codegen._Instr(codegen.ADDI, (
+                    codegen.STACK, codegen.STACK, pending), line))
+            else:
+                removed += 1
+            pending = None
+        out.append(ins)
+    if pending is not None and pending != 0:
+        out.append(codegen._Instr(codegen.ADDI, (
+            codegen.STACK, codegen.STACK, pending), line))
+    return out, removed, moved
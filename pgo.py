@@ -0,0 +1,230 @@
+"""Profile guided optimization. A program compiled to generate a profile
+counts, in words of its own, the calls to each function and the times the
+body of each if and while runs. The words follow the stop at the end of the
+program, where they are never run as instructions, and once it has run
+`_collect` reads them back as the profile:
+
+    {'functions': {function: calls},
+     'branches': {"function:line": [times reached, times the body ran]},
+     'loops': {"function:line": [times reached, times the body ran]},
+     'lines': {"function:line": times run}}
+
+The lines are those of the statements, keyed by the function whose source
+they are in, so the code a function was inlined into counts towards it.
+
+Compiling with a profile steers the optimizers: a call that seldom runs is
+not inlined, the body of an if or while that seldom runs is moved out of
+line so that skipping it falls through, and registers go to the variables
+used on the lines that run the most times per call.
+"""
+
+import json
+
+import codegen
+import syntax
+
+_PREFIX = "PF"
+# An if or while whose body runs less than this share of the times it is
+# reached is cold. Jumping out of line to its body and back takes two taken
+# branches, where branching around it in line takes one every time it is
+# skipped
+_COLD = 1 / 3
+# Share of all the calls the program makes that a call site needs to make
+# to be worth inlining
+_HOT_CALLS = 0.01
+_TABLES = ('functions', 'branches', 'loops', 'lines')
+
+
+def _load(f):
+    """Return the profile read from the text file object `f`. Raises
+    ValueError if it isn't one
+    """
+    profile = json.load(f)
+    if not isinstance(profile, dict):
+        raise ValueError("Expected a JSON object")
+    for table in _TABLES:
+        if not isinstance(profile.get(table), dict):
+            raise ValueError("Expected an object of {}".format(table))
+    for table in ('branches', 'loops'):
+        for key, counts in profile[table].items():
+            if not isinstance(counts, list) or len(counts) != 2 or \
+                    not all(isinstance(n, int) for n in counts):
+                raise ValueError("Expected [reached, ran] for {} {}".format(
+                    table, key))
+    for table in ('functions', 'lines'):
+        for key, n in profile[table].items():
+            if not isinstance(n, int):
+                raise ValueError("Expected a count for {} {}".format(
+                    table, key))
+    return profile
+
+
+def _dump(profile, f):
+    json.dump(profile, f, indent=2, sort_keys=True)
+    f.write("\n")
+
+
+def _key(function, line):
+    return "{}:{}".format(function, line)
+
+
+#################################################
+# Generating                                    #
+#################################################
+
+def _source_function(ctx):
+    return ctx.inlining[-1][0] if ctx.inlining else ctx.function
+
+
+def _enter(ctx, kind):
+    """Start the body of a function, if or while (`kind` 'function',
+    'branch' or 'loop'), on `ctx.line`: count the times it runs when
+    generating a profile, and look up how often it does when using one.
+    Return what `_leave` needs to go back to the code around it
+    """
+    saved = ctx.region, ctx.frequency
+    function = _source_function(ctx)
+    if ctx.counters is not None:
+        label = _counter(ctx, kind, function, ctx.line, ctx.region)
+        codegen._load_primary_abs(ctx, label)
+        codegen._addi(ctx, codegen.PRIMARY, codegen.PRIMARY, 1)
+        codegen._store_primary_abs(ctx, label)
+        ctx.region = label
+    if ctx.profile is not None:
+        ctx.frequency = _runs(ctx.profile, kind, function, ctx.line)
+    return saved
+
+
+def _leave(ctx, saved):
+    ctx.region, ctx.frequency = saved
+
+
+def _statement(ctx):
+    """Count the statement on `ctx.line` as run whenever the body it is in
+    is
+    """
+    if ctx.region is not None:
+        ctx.counted.setdefault((_source_function(ctx), ctx.line),
+                               set()).add(ctx.region)
+
+
+def _counter(ctx, kind, function, line, parent):
+    """Return the label of a new counter of the times the body of `kind` on
+    `line` of `function` runs, inside the body counted by `parent`
+    """
+    label = _PREFIX + str(len(ctx.counters))
+    ctx.counters.append((label, kind, function, line, parent))
+    return label
+
+
+def _words(ctx):
+    """Emit the words of the counters, which must come after the last
+    instruction the program runs
+    """
+    if ctx.counters is not None:
+        for counter in ctx.counters:
+            codegen._alloc_global(ctx, counter[0])
+
+
+def _instrument(ctx, program):
+    """Add counters to the bodies of the functions, ifs and whiles of the
+    `syntax._Program` `program`, as `_enter` adds them to the code of the
+    direct code generator
+    """
+    for fdef in program.functions:
+        label = _counter(ctx, 'function', fdef.func.name, fdef.line, None)
+        _instrument_body(ctx, fdef.func.name, fdef.body, label, fdef.line)
+
+
+def _instrument_body(ctx, function, body, region, line):
+    for stmt in body:
+        ctx.counted.setdefault((function, stmt.line), set()).add(region)
+        if isinstance(stmt, (syntax._If, syntax._While)):
+            kind = 'branch' if isinstance(stmt, syntax._If) else 'loop'
+            label = _counter(ctx, kind, function, stmt.line, region)
+            _instrument_body(ctx, function, stmt.body, label, stmt.line)
+    var = syntax._Global(region, region)
+    body.insert(0, syntax._Assign(var, syntax._Binary(
+        '+', syntax._Var(var, line), syntax._Num(1, line), line), line))
+
+
+def _collect(ctx, result):
+    """Return the profile made by running the program compiled by `ctx`
+    with counters, from the `simulator.Result` of the run
+    """
+    value = {counter[0]: result.value(counter[0]) for counter in ctx.counters}
+    profile = {'functions': {}, 'branches': {}, 'loops': {}, 'lines': {}}
+    for label, kind, function, line, parent in ctx.counters:
+        if kind == 'function':
+            functions = profile['functions']
+            functions[function] = functions.get(function, 0) + value[label]
+            continue
+        table = profile['branches' if kind == 'branch' else 'loops']
+        reached, ran = table.get(_key(function, line), (0, 0))
+        table[_key(function, line)] = [reached + value[parent],
+                                       ran + value[label]]
+    for (function, line), regions in ctx.counted.items():
+        profile['lines'][_key(function, line)] = sum(value[r]
+                                                     for r in regions)
+    return profile
+
+
+#################################################
+# Using                                         #
+#################################################
+
+def _runs(profile, kind, function, line):
+    """Return the times the body of `kind` on `line` of `function` ran, or
+    None if the profile doesn't know it
+    """
+    if kind == 'function':
+        return profile['functions'].get(function)
+    counts = profile['branches' if kind == 'branch' else 'loops'].get(
+        _key(function, line))
+    return counts[1] if counts is not None else None
+
+
+def _cold(profile, kind, function, line):
+    """Return whether `profile` says the body of the if or while (`kind`
+    'branch' or 'loop') on `line` of `function` seldom runs when it is
+    reached
+    """
+    if profile is None:
+        return False
+    table = profile['branches' if kind == 'branch' else 'loops']
+    counts = table.get(_key(function, line))
+    return counts is not None and counts[0] > 0 and \
+        counts[1] < _COLD * counts[0]
+
+
+def _hot_call(ctx, runs):
+    """Return whether a call that ran `runs` times, or an unknown number if
+    None, is worth inlining
+    """
+    if ctx.profile is None or runs is None:
+        return True
+    return runs > 0 and runs >= _HOT_CALLS * sum(
+        ctx.profile['functions'].values())
+
+
+def _line_runs(profile, function, line):
+    if profile is None:
+        return None
+    return profile['lines'].get(_key(function, line))
+
+
+def _weights(profile, function):
+    """Return a dict from each line to the times it ran for each call to
+    `function`, for weighing the uses of variables, or None if the profile
+    doesn't know how often `function` is called
+    """
+    calls = profile['functions'].get(function) if profile is not None \
+        else None
+    if not calls:
+        return None
+    weights = {}
+    for key, runs in profile['lines'].items():
+        line = int(key.rpartition(':')[2])
+        # Lines inlined from other functions count as well
+        weights[line] = weights.get(line, 0) + runs / calls
+    return weights
@@ -0,0 +1,211 @@
+"""Execution profiles of compiled programs. What a profiled `simulator.run`
+counted for each word of the program is attributed, through the line table
+of the compiler (see `compiler.Compiler.line_table`), to the function, the
+source line and the basic block of the instruction there. Calls are found
+among the jumps the run counted: every brl is one, and so is every br to
+the first instruction of a function, which is how a call in tail position
+goes.
+"""
+
+import codegen
+import simulator
+
+# Name the code before the first function is profiled under
+_START = "<start>"
+_COUNTS = ('instructions', 'loads', 'stores', 'cycles')
+_ENDS_BLOCK = {codegen.BR, codegen.BRL, codegen.BRZR, codegen.BRNZ,
+               codegen.BRPL, codegen.BRMI, codegen.STOP}
+
+
+class Profile:
+    """The counts of a profiled run by function (`functions`, which also
+    counts the calls to each) and by (function, line) (`lines`), each a dict
+    of `_COUNTS`. `blocks` has a (function, name, line, times entered,
+    counts) for each basic block that ran, in program order, and `calls`
+    maps each (caller, callee) to the number of calls
+    """
+    __slots__ = ('result', 'table', 'functions', 'lines', 'blocks', 'calls')
+
+    def __init__(self, result, table):
+        self.result = result
+        self.table = table
+        self.functions = {}
+        self.lines = {}
+        self.blocks = []
+        self.calls = {}
+
+    def format_flat(self):
+        """Return the flat profile: the counts of each function, the most
+        cycles first
+        """
+        total = max(self.result.cycles(), 1)
+        out = ["Flat profile:",
+               "   cycles      %  instructions     loads    stores     calls"
+               "  function"]
+        for name, c in sorted(self.functions.items(),
+                              key=lambda x: (-x[1]['cycles'], x[0])):
+            out.append("{:>9} {:>5.1f}% {:>13} {:>9} {:>9} {:>9}  {}".format(
+                c['cycles'], 100.0 * c['cycles'] / total, c['instructions'],
+                c['loads'], c['stores'], c['calls'], name))
+        return "\n".join(out) + "\n"
+
+    def format_call_graph(self):
+        """Return the call graph profile: for each function, the most cycles
+        first, the calls made to it by each caller (<-) and by it to each
+        callee (->)
+        """
+        total = max(self.result.cycles(), 1)
+        out = ["Call graph:"]
+        for name, c in sorted(self.functions.items(),
+                              key=lambda x: (-x[1]['cycles'], x[0])):
+            out.append("{}: {} calls, {:.1f}% of cycles".format(
+                name, c['calls'], 100.0 * c['cycles'] / total))
+            for (caller, callee), n in sorted(self.calls.items()):
+                if callee == name:
+                    out.append("    <- {} {}".format(caller, n))
+            for (caller, callee), n in sorted(self.calls.items()):
+                if caller == name:
+                    out.append("    -> {} {}".format(callee, n))
+        return "\n".join(out) + "\n"
+
+    def format_lines(self, source=None):
+        """Return the counts of each source line that ran, the most cycles
+        first, with the text of the line from the list `source` if given
+        """
+        out = ["Lines:",
+               "   cycles  instructions     loads    stores  function:line"]
+        for (name, line), c in sorted(
+                self.lines.items(),
+                key=lambda x: (-x[1]['cycles'], x[0][0], x[0][1] or 0)):
+            text = _source_line(source, line)
+            out.append("{:>9} {:>13} {:>9} {:>9}  {}:{}{}".format(
+                c['cycles'], c['instructions'], c['loads'], c['stores'],
+                name, line if line is not None else "?",
+                "  " + text if text else ""))
+        return "\n".join(out) + "\n"
+
+    def format_blocks(self):
+        """Return the counts of each basic block that ran, in program order
+        """
+        out = ["Basic blocks:",
+               "  entered  instructions    cycles  block (function:line)"]
+        for name, block, line, entered, c in self.blocks:
+            out.append("{:>9} {:>13} {:>9}  {} ({}:{})".format(
+                entered, c['instructions'], c['cycles'], block, name,
+                line if line is not None else "?"))
+        return "\n".join(out) + "\n"
+
+    def annotate(self, source=None):
+        """Return the assembly of the program with the times each
+        instruction ran, and each conditional branch there went to its
+        target, before it. Each run of instructions for a source line starts
+        with a comment giving the line, and its text from the list `source`
+        if given
+        """
+        program, result = self.result.program, self.result
+        hits = [0] * len(program.instrs)
+        taken = [0] * len(program.instrs)
+        for w, k in enumerate(program.words):
+            hits[k] += result.hits[w]
+            taken[k] += result.taken[w]
+        out = []
+        last = None
+        for k, ins in enumerate(program.instrs):
+            line = self.table[k][1] if k < len(self.table) else None
+            if line is not None and line != last:
+                text = _source_line(source, line)
+                out.append("{:>22}; line {}{}".format(
+                    "", line, ": " + text if text else ""))
+                last = line
+            text = str(ins).rstrip()
+            if ins.op in (codegen.LABEL, codegen.END):
+                out.append("{:>22}{}".format("", text))
+            else:
+                out.append("{:>10} {:>10} {}".format(
+                    hits[k], taken[k] if ins.op in codegen._BRANCHES and
+                    ins.op != codegen.BR else "", text))
+        return "\n".join(out) + "\n"
+
+
+def profile(result, table):
+    """Return the `Profile` of `result`, the `simulator.Result` of a profiled
+    run, with `table` the line table of the program run
+    """
+    p = Profile(result, table)
+    program = result.program
+    code, words, hits = program.code, program.words, result.hits
+    owners = [table[k][0] or _START for k in words]
+    lines = [table[k][1] for k in words]
+    counts = [_counts(result, w) if hits[w] else None
+              for w in range(len(words))]
+    for w, c in enumerate(counts):
+        if c is None:
+            continue
+        _add(p.functions.setdefault(owners[w], _new_counts(calls=0)), c)
+        _add(p.lines.setdefault((owners[w], lines[w]), _new_counts()), c)
+    # The first word of each function
+    entries = {w for w in range(len(words))
+               if w == 0 or owners[w] != owners[w - 1]}
+    for (site, target), n in (result.jumps or {}).items():
+        if code[site][0] == codegen.BRL or target in entries:
+            key = owners[site], owners[target]
+            p.calls[key] = p.calls.get(key, 0) + n
+            p.functions.setdefault(owners[target],
+                                   _new_counts(calls=0))['calls'] += n
+    p.blocks = _blocks(program, hits, owners, lines, counts)
+    return p
+
+
+def _counts(result, w):
+    n = result.hits[w]
+    op = result.program.code[w][0]
+    return {'instructions': n, 'loads': n if op == codegen.LD else 0,
+            'stores': n if op == codegen.ST else 0,
+            'cycles': result._cycles_at(w)}
+
+
+def _new_counts(**extra):
+    counts = dict.fromkeys(_COUNTS, 0)
+    counts.update(extra)
+    return counts
+
+
+def _add(total, counts):
+    for key in _COUNTS:
+        total[key] += counts[key]
+
+
+def _blocks(program, hits, owners, lines, counts):
+    """Return the (function, name, line, times entered, counts) of each
+    basic block that ran. A block starts at a label or after a branch, and
+    one with no label of its own is named by its offset from the last one
+    """
+    # The last of the labels at each word, the one nearest its code
+    at = {address // simulator._WORD_BYTES: label
+          for label, address in program.labels.items()}
+    blocks = []
+    # The last label and the word it is at
+    label, base = _START, 0
+    start = 0
+    for w in range(len(program.words) + 1):
+        if w == len(program.words) or (w > start and (
+                w in at or program.code[w - 1][0] in _ENDS_BLOCK)):
+            if hits[start]:
+                block = _new_counts()
+                for c in counts[start:w]:
+                    if c is not None:
+                        _add(block, c)
+                name = label if start in at else "{}+{}".format(
+                    label, (start - base) * simulator._WORD_BYTES)
+                blocks.append((owners[start], name, lines[start],
+                               hits[start], block))
+            start = w
+        if w in at:
+            label, base = at[w], w
+    return blocks
+
+
+def _source_line(source, line):
+    if source is None or line is None or not 0 < line <= len(source):
+        return ""
+    return source[line - 1].strip()
@@ -0,0 +1,148 @@
+"""Register allocation for the variables of a function. Once a function has
+been parsed, the parameters and locals it uses most (weighted by how deeply
+in loops the uses are, or by how often the profile says the lines they are
+used on run) are moved from their frame slots into the callee save
+registers, and only the registers actually handed out are saved and
+restored around the body.
+"""
+
+import codegen
+import pgo
+
+_WORD_BYTES = codegen.WORD // codegen.BYTE
+# Offset of the return address from the base pointer. The saved registers go
+# below it, then the locals
+_RETURN_ADDR = -_WORD_BYTES
+# How many times more a use inside a loop counts than one outside it, and
+# the deepest nesting that still adds to that
+_LOOP_WEIGHT = 8
+_MAX_DEPTH = 4
+# Weighted uses a variable needs before it is worth a register: saving and
+# restoring one takes a store and a load, and the moves left behind in place
+# of its loads and stores are not all removed. A parameter has to be loaded
+# into its register as well
+_SAVE_COST = 3
+_PARAM_COST = 1
+
+
+def _function(ctx, start, label, saves, free=()):
+    """Allocate registers to the variables of the function whose code is
+    `ctx.out[start:]`. `saves` is whether the callee save registers used
+    have to be saved for the caller. The registers in `free` are handed out
+    first, and never need saving. Return the registers handed out
+    """
+    instrs = ctx.out[start:]
+    weights = _slot_weights(instrs, pgo._weights(ctx.profile, ctx.function))
+    cost = _SAVE_COST if saves else 0
+    free = list(free)
+    callee_save = list(codegen.CALLEE_SAVE)
+    # Weighted uses less the cost of loading a parameter, highest first
+    gains = sorted(((weight - (_PARAM_COST if offset > 0 else 0), offset)
+                    for offset, weight in weights.items()),
+                   key=lambda x: (-x[0], x[1]))
+    regs = {}
+    for gain, offset in gains:
+        if free and gain > 0:
+            regs[offset] = free.pop(0)
+        elif callee_save and gain - cost > 0:
+            regs[offset] = callee_save.pop(0)
+    if not regs:
+        return []
+    ctx.out[start:] = _rewrite(instrs, regs, saves)
+    ctx.report.append("reg-vars: {}: {}".format(label, ", ".join(
+        "{}({}) in {}".format(offset, codegen.BASE, reg)
+        for offset, reg in sorted(regs.items(), key=lambda x: x[1]))))
+    return list(regs.values())
+
+
+def _is_slot(i):
+    return (i.op == codegen.LD or i.op == codegen.ST) and \
+        i.args[2] == codegen.BASE
+
+
+def _loop_depths(instrs):
+    """Return how many loops each instruction is in. A loop is the code from
+    a label to a branch back to it
+    """
+    labels = {}
+    starts = [0] * (len(instrs) + 1)
+    for k, ins in enumerate(instrs):
+        if ins.op == codegen.LABEL:
+            labels[ins.args[0]] = k
+        elif ins.op in codegen._BRANCHES and k > 0:
+            prev = instrs[k - 1]
+            if prev.op == codegen.LAR and prev.args[0] == ins.args[0] and \
+                    prev.args[1] in labels:
+                starts[labels[prev.args[1]]] += 1
+                starts[k + 1] -= 1
+    depths = []
+    depth = 0
+    for k in range(len(instrs)):
+        depth += starts[k]
+        depths.append(depth)
+    return depths
+
+
+def _slot_weights(instrs, lines=None):
+    """Return a dict from the offset of every frame slot used to the
+    weighted number of times it is loaded or stored. Each use counts as the
+    weight of its line in `lines`, if given
+    """
+    weights = {}
+    for ins, depth in zip(instrs, _loop_depths(instrs)):
+        if _is_slot(ins):
+            offset = ins.args[1]
+            weights[offset] = weights.get(offset, 0) + (
+                _LOOP_WEIGHT ** min(depth, _MAX_DEPTH) if lines is None
+                else lines.get(ins.line, 0))
+    return weights
+
+
+def _rewrite(instrs, regs, saves):
+    """Turn the loads and stores of the slots in `regs` into moves to and
+    from their registers, and save and restore those registers if `saves`
+    """
+    saved = sorted((reg for reg in regs.values()
+                    if reg in codegen.CALLEE_SAVE),
+                   key=codegen.CALLEE_SAVE.index) if saves else []
+    # The saved registers push the locals further down the frame
+    shift = -_WORD_BYTES * len(saved)
+    restore = [codegen._Instr(codegen.LD, (reg, _RETURN_ADDR - _WORD_BYTES *
+                                           (n + 1), codegen.BASE))
+               for n, reg in enumerate(saved)]
+    if saved:
+        restore.append(codegen._Instr(codegen.ADDI, (
+            codegen.STACK, codegen.STACK, _WORD_BYTES * len(saved))))
+    # instrs[:2] is the push of the return address
+    out = instrs[:2]
+    line = instrs[0].line if instrs else None
+    for reg in saved:
+        out.append(codegen._Instr(codegen.ST, (reg, 0, codegen.STACK), line))
+        out.append(codegen._Instr(codegen.ADDI, (
+            codegen.STACK, codegen.STACK, -_WORD_BYTES), line))
+    for offset, reg in regs.items():
+        if offset > 0:
+            out.append(codegen._Instr(codegen.LD, (reg, offset,
+                                                   codegen.BASE), line))
+    for ins in instrs[2:]:
+        op, a = ins.op, ins.args
+        if _is_slot(ins):
+            reg = regs.get(a[1])
+            if reg is None:
+                if a[1] < _RETURN_ADDR:
+                    ins = codegen._Instr(op, (a[0], a[1] + shift, a[2]),
+                                         ins.line)
+            elif op == codegen.LD:
+                ins = codegen._Instr(codegen.LA, (a[0], 0, reg), ins.line)
+            else:
+                ins = codegen._Instr(codegen.LA, (reg, 0, a[0]), ins.line)
+        elif op == codegen.LD and a[1:] == (0, codegen.STACK) and \
+                a[0] in (codegen.BRANCH_TARGET, codegen.RETURN) and restore:
+            # Popping the return address (into RETURN for a tail call), the
+            # saved registers come off the stack first
+            pop = out.pop()
+            out.extend(codegen._Instr(r.op, r.args, pop.line)
+                       for r in restore)
+            out.append(pop)
+        out.append(ins)
+    return out
@@ -1,11 +1,26 @@
 """Functions that scan the input to find tokens which
 are then passed on to the parser.
+
+The source is tokenized with a single master regex into a compact token
+array (kind, start offset, length and line of every token). The parser walks
+that array with one token of lookahead instead of reading the file a byte at
+a time, so a stream such as stdin can be tokenized a chunk at a time.
 """
 
+import mmap
+import re
+import time
+from array import array
+
 import error
 
-_line = 1
-_nchar = 0
+# Token kinds
+EOF = 0
+NAME = 1
+NUM = 2
+OP = 3
+PUNCT = 4
+
 _or_ops = {'|', '||'}
 _and_ops = {'&', '&&'}
 _not_ops = {'~', '!'}
@@ -14,104 +29,349 @@ _add_ops = {'+', '-', '++', '--'}
 _mul_ops = {'*', '/', '>>', '<<'}
 _operators = _or_ops.union(_and_ops, _not_ops, _rel_ops, _add_ops, _mul_ops)
 
+# Alternatives are tried in order, so longer operators have to come before
+# their one character prefixes. The group number of each alternative is the
+# token kind it produces (see `_group_kinds`).
+_token_re = re.compile(rb"""
+      (?P<white>[ \t\r\f\v]+)
+    | (?P<newline>\n)
+    | (?P<name>[_A-Za-z][_A-Za-z0-9]*)
+    | (?P<num>[0-9]+)
+    | (?P<op>\|\||&&|<=|>=|==|!=|\+\+|--|>>|<<|[|&~!<>+\-*/])
+    | (?P<punct>[=(){},@])
+    | (?P<bad>.)
+""", re.VERBOSE | re.DOTALL)
+_WHITE, _NEWLINE, _NAME, _NUM, _OP, _PUNCT, _BAD = range(1, 8)
+_group_kinds = {_NAME: NAME, _NUM: NUM, _OP: OP, _PUNCT: PUNCT}
+_OPEN_BRACE = ord('{')
+_CLOSE_BRACE = ord('}')
 
-def _get_name(f):
-    global _nchar
-    _skip_white(f)
-    if _nchar == '':
-        return ''
-    if not _is_valid_identifier_start(_nchar):
-        # Eventually calls sys.exit()
-        error._expected(("Identifier beginning [alpha or _], got {} on "
-                        + "line {}").format(_nchar, _line))
-    id = ""
-    while _is_valid_identifier(_nchar):
-        id += _nchar
-        _nchar = f.read(1).decode("utf-8")
-    return id
 
+class _Tokens:
+    """Token array for one source file. Token `i` is the bytes
+    `data[starts[i]:starts[i] + lengths[i]]` of kind `kinds[i]` found on line
+    `lines[i]`. The array always ends with an EOF token.
 
-def _get_num(f):
-    """Returns the next number as a str
+    When the tokens come from a stream, `source` is the file object still
+    being read and the array only holds the tokens of the latest chunk of
+    lines; `rest` is a trailing partial line carried over to the next chunk.
+    `counts` is what the scanner has done for it, and may be shared with
+    other arrays.
     """
-    global _nchar
-    _skip_white(f)
-    if _nchar == '':
-        return ''
-    if not _is_num(_nchar):
-        # Eventually calls sys.exit()
-        error._expected("Number")
-    n = ""
-    while _is_num(_nchar):
-        n += _nchar
-        _nchar = f.read(1).decode("utf-8")
-    return n
+    __slots__ = ('data', 'kinds', 'starts', 'lengths', 'lines', 'pos',
+                 'source', 'rest', 'counts')
+
+    def __init__(self, data, counts=None):
+        self.data = data
+        self.kinds = array('B')
+        self.starts = array('L')
+        self.lengths = array('L')
+        self.lines = array('L')
+        self.pos = 0
+        self.source = None
+        self.rest = b''
+        self.counts = counts if counts is not None else _Counts()
 
 
-def _get_operator(f):
-    """Match the longest operator possible and return it. If no operator is
-    matched, return the empty string
+class _Counts:
+    """The characters scanned, tokens found, times the parser went back to
+    an earlier token and seconds spent scanning (see `stats`)
     """
-    global _nchar, _operators
-    _skip_white(f)
-    op = ""
-    if _nchar == '':
-        return ''
-    while __some_prefix(op + _nchar, _operators):
-        op += _nchar
-        _nchar = f.read(1).decode("utf-8")
-    return op
+    __slots__ = ('characters', 'tokens', 'rewinds', 'seconds')
+
+    def __init__(self):
+        self.characters = 0
+        self.tokens = 0
+        self.rewinds = 0
+        self.seconds = 0.0
+
+
+# Bytes read from a stream at a time
+_CHUNK_SIZE = 1 << 16
 
 
-def __some_prefix(s, st):
-    """Return whether str s is a prefix of some element in st
+def _open(f):
+    """Tokenize the file object `f`, memory mapping it when possible so the
+    source is never copied byte by byte
     """
-    if s == '':
-        return False
-    for e in st:
-        if e.startswith(s):
-            return True
-    return False
+    try:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        # Not a regular file (a pipe, or an empty file which can't be
+        # mapped), so read it as a stream instead
+        return _stream(f)
+    return _tokenize(data)
 
 
-def _match(f, c):
-    global _nchar
-    _skip_white(f)
-    if _nchar == c:
-        _nchar = f.read(1).decode("utf-8")
+def _tokenize(data, line=1, counts=None):
+    """Split the bytes-like `data`, which starts on line `line`, into a
+    `_Tokens` array, counting what it took in `counts` if given
+    """
+    ts = _Tokens(data, counts)
+    _scan(ts, data, line)
+    return ts
+
+
+def _stream(f):
+    """Tokenize the binary file object `f` (e.g. stdin) as it is read. Only
+    one chunk of whole lines is held at a time, so the input never has to be
+    seekable or fit in memory
+    """
+    ts = _Tokens(b'')
+    ts.source = f
+    _refill(ts, 1)
+    return ts
+
+
+def _refill(ts, line):
+    """Replace the tokens in `ts` with those of the next chunk of `ts.source`
+    that has any, starting at line number `line`
+    """
+    while True:
+        chunk = ts.source.read(_CHUNK_SIZE)
+        if not chunk:
+            # End of the stream, whatever is left is the last line
+            data, ts.rest, ts.source = ts.rest, b'', None
+        else:
+            data = ts.rest + chunk
+            # Tokens never span lines, so only scan up to the last newline
+            cut = data.rfind(b'\n') + 1
+            data, ts.rest = data[:cut], data[cut:]
+        ts.data = data
+        ts.pos = 0
+        line = _scan(ts, data, line)
+        if ts.source is None or len(ts.kinds) > 1:
+            return
+
+
+def _scan(ts, data, line):
+    """Fill the arrays of `ts` with the tokens in `data`, the first of which
+    is on line `line`. Return the line number at the end of `data`
+    """
+    began = time.perf_counter()
+    kinds, starts, lengths, lines = ts.kinds, ts.starts, ts.lengths, ts.lines
+    del kinds[:], starts[:], lengths[:], lines[:]
+    for m in _token_re.finditer(data):
+        group = m.lastindex
+        if group == _WHITE:
+            continue
+        if group == _NEWLINE:
+            line += 1
+            continue
+        if group == _BAD:
+            error._error("Unexpected character {} on line {}".format(
+                repr(m.group().decode("utf-8", "replace")), line))
+        start = m.start()
+        kinds.append(_group_kinds[group])
+        starts.append(start)
+        lengths.append(m.end() - start)
+        lines.append(line)
+    kinds.append(EOF)
+    starts.append(len(data))
+    lengths.append(0)
+    lines.append(line)
+    counts = ts.counts
+    counts.characters += len(data)
+    counts.tokens += len(kinds) - 1
+    counts.seconds += time.perf_counter() - began
+    return line
+
+
+def _extend(ts):
+    """Read more of the stream behind `ts` into memory, keeping the current
+    token and everything after it. Each call at least doubles the amount
+    held, so reading a long block this way stays linear
+    """
+    start = ts.starts[ts.pos]
+    line = ts.lines[ts.pos]
+    kept = ts.data[start:] + ts.rest
+    chunk = ts.source.read(max(_CHUNK_SIZE, len(kept)))
+    if not chunk:
+        data, ts.rest, ts.source = kept, b'', None
     else:
-        error._expected(c)
+        data = kept + chunk
+        cut = data.rfind(b'\n') + 1
+        data, ts.rest = data[:cut], data[cut:]
+    ts.data = data
+    ts.pos = 0
+    _scan(ts, data, line)
+
+
+def _block_end(ts):
+    """Return the index of the `}` closing the block the current token is in
+    (or of the EOF token if it is never closed), reading the rest of the
+    block into memory first if it comes from a stream
+    """
+    while True:
+        depth = 1
+        kinds, starts, data = ts.kinds, ts.starts, ts.data
+        for i in range(ts.pos, len(kinds) - 1):
+            if kinds[i] == PUNCT:
+                c = data[starts[i]]
+                if c == _OPEN_BRACE:
+                    depth += 1
+                elif c == _CLOSE_BRACE:
+                    depth -= 1
+                    if depth == 0:
+                        return i
+        if ts.source is None:
+            return len(kinds) - 1
+        _extend(ts)
+
+
+def _assigned_names(ts):
+    """Return the set of names assigned to by `name = ...` statements (not
+    `var name = ...` declarations) from the current token to the end of the
+    block it is in
+    """
+    end = _block_end(ts)
+    kinds = ts.kinds
+    names = set()
+    for i in range(ts.pos, end):
+        if kinds[i] == NAME and kinds[i + 1] == PUNCT and \
+                _text(ts, i + 1) == '=' and \
+                not (i > ts.pos and _text(ts, i - 1) == 'var'):
+            names.add(_text(ts, i))
+    return names
 
 
-def _skip_white(f):
-    global _nchar, _line
-    while _is_white(_nchar):
-        if _nchar == '\n':
-            _line += 1
-        _nchar = f.read(1).decode("utf-8")
+def _after_group(ts, start=None):
+    """Return the text of the token after the `)` matching the `(` that is
+    token `start` (the current token by default), or None if it isn't in
+    memory yet
+    """
+    depth = 0
+    kinds = ts.kinds
+    for i in range(ts.pos if start is None else start, len(kinds) - 1):
+        if kinds[i] == PUNCT:
+            c = _text(ts, i)
+            if c == '(':
+                depth += 1
+            elif c == ')':
+                depth -= 1
+                if depth == 0:
+                    return _text(ts, i + 1)
+    return None
 
 
-# Methods for testing what type of character an input is
+def _call_counts(ts):
+    """Return a dict of the number of times each name is followed by `(`
+    other than where a function is declared, or None if the tokens come
+    from a stream and aren't all in memory
+    """
+    if ts.source is not None:
+        return None
+    kinds = ts.kinds
+    counts = {}
+    for i in range(len(kinds) - 1):
+        if kinds[i] == NAME and kinds[i + 1] == PUNCT and \
+                _text(ts, i + 1) == '(' and \
+                not (i > 0 and _text(ts, i - 1) == 'function'):
+            name = _text(ts, i)
+            counts[name] = counts.get(name, 0) + 1
+    return counts
 
-def _is_alpha(a):
-    return a.isalpha()
 
+def _span_start(ts):
+    """Return where the current token starts, to pass to `_span`
+    """
+    return ts.data, ts.starts[ts.pos], ts.lines[ts.pos]
 
-def _is_alphanum(a):
-    return a.isalnum()
 
+def _span(ts, start):
+    """Return the source from the token `start` was taken at up to and
+    including the current token as (bytes, line of its first token), or
+    None if a stream has moved on past that token since
+    """
+    data, first, line = start
+    if ts.data is not data:
+        return None
+    return bytes(data[first:ts.starts[ts.pos] + ts.lengths[ts.pos]]), line
 
-def _is_num(a):
-    return a.isdigit()
 
+def _mark(ts):
+    """Return the position of the current token to go back to with
+    `_rewind`. The rest of the block the current token is in is read into
+    memory first if it comes from a stream, so the position stays valid
+    until the parser leaves that block
+    """
+    if ts.source is not None:
+        _block_end(ts)
+    return ts.pos
 
-def _is_valid_identifier(a):
-    return _is_alphanum(a) or a == '_'
 
+def _rewind(ts, pos):
+    ts.counts.rewinds += 1
+    ts.pos = pos
 
-def _is_valid_identifier_start(a):
-    return _is_alpha(a) or a == '_'
+
+def _text(ts, i):
+    start = ts.starts[i]
+    return ts.data[start:start + ts.lengths[i]].decode("utf-8")
+
+
+def _peek(ts):
+    """Return the text of the current token without consuming it. This is the
+    empty string at the end of the input
+    """
+    return _text(ts, ts.pos)
+
+
+def _peek_kind(ts):
+    return ts.kinds[ts.pos]
+
+
+def _line(ts):
+    """Line number of the current token
+    """
+    return ts.lines[ts.pos]
+
+
+def _next(ts):
+    """Consume the current token and return its text
+    """
+    text = _peek(ts)
+    if ts.kinds[ts.pos] != EOF:
+        ts.pos += 1
+        if ts.kinds[ts.pos] == EOF and ts.source is not None:
+            _refill(ts, ts.lines[ts.pos])
+    return text
 
 
-def _is_white(a):
-    return a.isspace()
+def _get_name(ts):
+    kind = _peek_kind(ts)
+    if kind == EOF:
+        return ''
+    if kind != NAME:
+        # Eventually raises error.CompileError
+        error._expected(("Identifier beginning [alpha or _], got {} on "
+                        + "line {}").format(_peek(ts), _line(ts)))
+    return _next(ts)
+
+
+def _get_num(ts):
+    """Returns the next number as a str
+    """
+    kind = _peek_kind(ts)
+    if kind == EOF:
+        return ''
+    if kind != NUM:
+        # Eventually raises error.CompileError
+        error._expected("Number")
+    return _next(ts)
+
+
+def _peek_operator(ts):
+    """Return the next token if it is an operator without consuming it.
+    Otherwise, return the empty string
+    """
+    if _peek_kind(ts) != OP:
+        return ''
+    return _peek(ts)
+
+
+def _match(ts, c):
+    if _peek(ts) == c:
+        _next(ts)
+    else:
+        error._expected(c)
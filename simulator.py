@@ -0,0 +1,382 @@
+"""RSRC instruction set simulator, for running and timing compiled programs
+without the hardware. The assembly text is read back (see `assembler`) and
+every word of the program image is predecoded into an (opcode, a, b, c)
+tuple of small ints, which the inner loop dispatches on: the common opcodes
+are tested in order of how often compiled code runs them, and the rest are
+looked up in a table of handlers. Registers hold unsigned 32 bit values and
+memory is a flat array of words. The words holding instructions read as 0,
+since the program is run from its predecoded form rather than from memory,
+and those of a `.dc` start out holding its constant.
+
+Only the number of times each instruction runs and each conditional branch
+is taken are counted while the program runs; the counts per opcode, the
+loads and stores and the cycles are all worked out from those afterwards.
+A profiled run also counts where each br and brl went, for `profiler`.
+Cycles are modelled for a simple five stage pipeline: each instruction
+issues in one cycle, except that mul and div take longer, an instruction
+reading the register the ld just before it loads waits for it, and a taken
+branch throws away the instructions fetched after it.
+"""
+
+import array
+
+import assembler
+import codegen
+import error
+
+_WORD_BYTES = codegen.WORD // codegen.BYTE
+_MASK = (1 << codegen.WORD) - 1
+_SIGN = 1 << (codegen.WORD - 1)
+# Bytes of memory simulated, from address 0. The compiled code puts the
+# stack at the top of the first 64KiB
+_DEFAULT_MEMORY = 1 << 16
+# Most instructions run before a program is taken to be stuck in a loop
+_DEFAULT_MAX_STEPS = 10 ** 8
+# Register the results of instructions writing r0 go to, so r0 stays 0
+_DISCARD = 32
+# Predecoded opcodes besides codegen's: shifts by a register, and a word of
+# data, which runs as a nop
+_SHR_REG, _SHRA_REG, _SHL_REG, _DATA = range(len(codegen._names),
+                                             len(codegen._names) + 4)
+_SHIFT_BY_REG = {codegen.SHR: _SHR_REG, codegen.SHRA: _SHRA_REG,
+                 codegen.SHL: _SHL_REG}
+# Cycles each instruction takes beyond the first
+_EXTRA_CYCLES = {codegen.MUL: 3, codegen.DIV: 31}
+_LOAD_USE_STALL = 1
+_TAKEN_BRANCH = 2
+
+
+class Program:
+    """An assembled program: the instructions `instrs` read back from the
+    assembly, the address of each label, and for each word of the image the
+    index in `instrs` of what is there (`words`) and its predecoded form
+    (`code`)
+    """
+    __slots__ = ('instrs', 'labels', 'words', 'code')
+
+    def __init__(self, instrs, labels, words, code):
+        self.instrs = instrs
+        self.labels = labels
+        self.words = words
+        self.code = code
+
+
+class Result:
+    """What running a `Program` did. `hits` counts the times the instruction
+    at each word ran and `taken` the times a conditional branch there went
+    to its target. In a profiled run `jumps` counts the times each br or brl
+    went from one word to another by (from, to), and is None otherwise.
+    `regs` and `memory` are as the program left them
+    """
+    __slots__ = ('program', 'regs', 'memory', 'hits', 'taken', 'jumps',
+                 'steps')
+
+    def __init__(self, program, regs, memory, hits, taken, jumps, steps):
+        self.program = program
+        self.regs = regs
+        self.memory = memory
+        self.hits = hits
+        self.taken = taken
+        self.jumps = jumps
+        self.steps = steps
+
+    def word(self, address):
+        """Return the signed value of the word at `address`
+        """
+        return _signed(self.memory[address // _WORD_BYTES])
+
+    def value(self, label):
+        """Return the signed value of the word `label` names
+        """
+        return self.word(self.program.labels[label])
+
+    def counts(self):
+        """Return a dict from each opcode run to how many times it was
+        """
+        counts = {}
+        instrs, words = self.program.instrs, self.program.words
+        for w, n in enumerate(self.hits):
+            if n:
+                name = codegen._names[instrs[words[w]].op]
+                counts[name] = counts.get(name, 0) + n
+        return counts
+
+    def loads(self):
+        return self._count(codegen.LD)
+
+    def stores(self):
+        return self._count(codegen.ST)
+
+    def _count(self, op):
+        code = self.program.code
+        return sum(n for w, n in enumerate(self.hits) if code[w][0] == op)
+
+    def cycles(self):
+        """Return the cycles the run took on the modelled pipeline
+        """
+        return sum(self._cycles_at(w) for w, n in enumerate(self.hits) if n)
+
+    def _cycles_at(self, w):
+        """Return the cycles spent on the instruction at word `w`
+        """
+        program = self.program
+        code, instrs, words = program.code, program.instrs, program.words
+        n = self.hits[w]
+        op = code[w][0]
+        cycles = n * (1 + _EXTRA_CYCLES.get(op, 0)) + \
+            _TAKEN_BRANCH * self.taken[w]
+        if op == codegen.BR or op == codegen.BRL:
+            cycles += n * _TAKEN_BRANCH
+        elif op == codegen.LD and w + 1 < len(code) and \
+                instrs[words[w]].args[0] in \
+                codegen._reads(instrs[words[w + 1]]):
+            cycles += n * _LOAD_USE_STALL
+        return cycles
+
+    def stats(self):
+        """Return the counts of the run as a dict
+        """
+        return {'instructions': self.steps, 'loads': self.loads(),
+                'stores': self.stores(), 'cycles': self.cycles(),
+                'opcodes': self.counts()}
+
+
+def _signed(v):
+    return v - (1 << codegen.WORD) if v & _SIGN else v
+
+
+#################################################
+# Predecoding                                   #
+#################################################
+
+def assemble(text):
+    """Return the `Program` the assembly `text` is. Raises
+    `error.AssemblyError` if it can't be
+    """
+    instrs = assembler._parse(text)
+    labels, words = assembler._layout(instrs)
+    code = [_predecode(instrs[k], labels) for k in words]
+    return Program(instrs, labels, words, code)
+
+
+def _predecode(ins, labels):
+    op, a = ins.op, ins.args
+    if op in codegen._DATA:
+        return _DATA, 0, 0, 0
+    if op == codegen.STOP:
+        return op, 0, 0, 0
+    if op == codegen.LAR:
+        return op, _dst(a[0]), _value(a[1], labels) & _MASK, 0
+    if op == codegen.LA or op == codegen.LD:
+        return op, _dst(a[0]), _reg(a[2]), _value(a[1], labels)
+    if op == codegen.ST:
+        return op, _reg(a[0]), _reg(a[2]), _value(a[1], labels)
+    if op in codegen._ALU3:
+        return op, _dst(a[0]), _reg(a[1]), _reg(a[2])
+    if op == codegen.ADDI:
+        return op, _dst(a[0]), _reg(a[1]), _value(a[2], labels)
+    if op == codegen.NEG or op == codegen.NOT:
+        return op, _dst(a[0]), _reg(a[1]), 0
+    if op in codegen._SHIFTS:
+        if codegen._is_reg(a[2]):
+            return _SHIFT_BY_REG[op], _dst(a[0]), _reg(a[1]), _reg(a[2])
+        return op, _dst(a[0]), _reg(a[1]), a[2] & (codegen.WORD - 1)
+    if op == codegen.BR:
+        return op, _reg(a[0]), 0, 0
+    if op == codegen.BRL:
+        return op, _dst(a[0]), _reg(a[1]), 0
+    # Conditional branches: to rb if rc passes the test
+    return op, _reg(a[0]), _reg(a[1]), 0
+
+
+def _reg(x):
+    if not codegen._is_reg(x) or int(x[1:]) >= codegen.WORD:
+        error._asm_error("Expected a register, got {}".format(x))
+    return int(x[1:])
+
+
+def _dst(x):
+    return _reg(x) or _DISCARD
+
+
+def _value(x, labels):
+    if isinstance(x, int):
+        return x
+    if x not in labels:
+        error._asm_error("Undefined label: {}".format(x))
+    return labels[x]
+
+
+#################################################
+# Execution                                     #
+#################################################
+
+def run(program, max_steps=None, memory_bytes=None, profile=False):
+    """Run `program`, a `Program` or assembly text, from address 0 until it
+    stops, and return its `Result`, with the jumps counted if `profile`.
+    Raises `error.SimulationError` if it goes wrong or runs more than
+    `max_steps` instructions
+    """
+    if not isinstance(program, Program):
+        program = assemble(program)
+    max_steps = max_steps if max_steps is not None else _DEFAULT_MAX_STEPS
+    memory_bytes = memory_bytes if memory_bytes is not None \
+        else _DEFAULT_MEMORY
+    code = program.code
+    if len(code) * _WORD_BYTES > memory_bytes:
+        raise error.SimulationError("Program of {} bytes doesn't fit in {} "
+                                    "bytes of memory".format(
+                                        len(code) * _WORD_BYTES,
+                                        memory_bytes))
+    memory = array.array('I', bytes(memory_bytes))
+    instrs = program.instrs
+    for w, k in enumerate(program.words):
+        if instrs[k].op == codegen.DC:
+            memory[w] = instrs[k].args[1] & _MASK
+    regs = [0] * (_DISCARD + 1)
+    hits = [0] * len(code)
+    taken = [0] * len(code)
+    jumps = {} if profile else None
+    steps = _execute(code, regs, memory, hits, taken, jumps, max_steps)
+    regs.pop()
+    return Result(program, regs, memory, hits, taken, jumps, steps)
+
+
+def _mul(R, a, b, c):
+    R[a] = (R[b] * R[c]) & _MASK
+
+
+def _div(R, a, b, c):
+    b, c = _signed(R[b]), _signed(R[c])
+    q = abs(b) // abs(c)
+    R[a] = (q if (b < 0) == (c < 0) else -q) & _MASK
+
+
+def _and(R, a, b, c):
+    R[a] = R[b] & R[c]
+
+
+def _shr(R, a, b, c):
+    R[a] = R[b] >> c
+
+
+def _shl(R, a, b, c):
+    R[a] = (R[b] << c) & _MASK
+
+
+def _shr_reg(R, a, b, c):
+    _shr(R, a, b, R[c] & (codegen.WORD - 1))
+
+
+def _shra_reg(R, a, b, c):
+    R[a] = (_signed(R[b]) >> (R[c] & (codegen.WORD - 1))) & _MASK
+
+
+def _shl_reg(R, a, b, c):
+    _shl(R, a, b, R[c] & (codegen.WORD - 1))
+
+
+# Handlers of the opcodes compiled code runs least
+_HANDLERS = {codegen.MUL: _mul, codegen.DIV: _div, codegen.AND: _and,
+             codegen.SHR: _shr, codegen.SHL: _shl, _SHR_REG: _shr_reg,
+             _SHRA_REG: _shra_reg, _SHL_REG: _shl_reg}
+
+
+def _execute(code, R, memory, hits, taken, jumps, max_steps):
+    """Run `code` from address 0 until a stop, counting in `hits`, `taken`
+    and `jumps` unless it is None. Return the number of instructions run
+    """
+    LAR, LA, LD, ST, ADD, ADDI, SUB, NEG, NOT, OR, SHRA, BR, BRL, BRZR, \
+        BRNZ, BRPL, BRMI, STOP = codegen.LAR, codegen.LA, codegen.LD, \
+        codegen.ST, codegen.ADD, codegen.ADDI, codegen.SUB, codegen.NEG, \
+        codegen.NOT, codegen.OR, codegen.SHRA, codegen.BR, codegen.BRL, \
+        codegen.BRZR, codegen.BRNZ, codegen.BRPL, codegen.BRMI, codegen.STOP
+    M, S, W = _MASK, _SIGN, 1 << codegen.WORD
+    handlers = _HANDLERS
+    pc = 0
+    n = 0
+    try:
+        while True:
+            op, a, b, c = code[pc]
+            hits[pc] += 1
+            pc += 1
+            n += 1
+            if op == ADDI:
+                R[a] = (R[b] + c) & M
+            elif op == LD:
+                R[a] = memory[((R[b] + c) & M) >> 2]
+            elif op == ST:
+                memory[((R[b] + c) & M) >> 2] = R[a]
+            elif op == LAR:
+                R[a] = b
+            elif op == LA:
+                R[a] = (R[b] + c) & M
+            elif op >= BR and op <= BRMI:
+                if op == BRZR:
+                    if R[b]:
+                        continue
+                elif op == BRNZ:
+                    if not R[b]:
+                        continue
+                elif op == BRPL:
+                    if R[b] & S:
+                        continue
+                elif op == BRMI:
+                    if not R[b] & S:
+                        continue
+                elif op == BRL:
+                    target = R[b]
+                    if jumps is not None:
+                        key = pc - 1, target >> 2
+                        jumps[key] = jumps.get(key, 0) + 1
+                    R[a] = pc << 2
+                    pc = target >> 2
+                    if n > max_steps:
+                        break
+                    continue
+                if op != BR:
+                    taken[pc - 1] += 1
+                    pc = R[a] >> 2
+                elif jumps is not None:
+                    key = pc - 1, R[a] >> 2
+                    jumps[key] = jumps.get(key, 0) + 1
+                    pc = key[1]
+                else:
+                    pc = R[a] >> 2
+                if n > max_steps:
+                    break
+            elif op == ADD:
+                R[a] = (R[b] + R[c]) & M
+            elif op == SUB:
+                R[a] = (R[b] - R[c]) & M
+            elif op == SHRA:
+                v = R[b]
+                R[a] = ((v - W if v & S else v) >> c) & M
+            elif op == NEG:
+                R[a] = -R[b] & M
+            elif op == NOT:
+                R[a] = R[b] ^ M
+            elif op == OR:
+                R[a] = R[b] | R[c]
+            elif op == STOP:
+                return n
+            elif op == _DATA:
+                if memory[pc - 1]:
+                    raise error.SimulationError(
+                        "Ran into data at address {}".format(
+                            (pc - 1) * _WORD_BYTES))
+            else:
+                handlers[op](R, a, b, c)
+    except IndexError:
+        if (op == LD or op == ST) and \
+                ((R[b] + c) & M) >> 2 >= len(memory):
+            raise error.SimulationError(
+                "Memory access out of range by the instruction at address "
+                "{}".format((pc - 1) * _WORD_BYTES))
+        raise error.SimulationError(
+            "Ran off the program at address {}".format(pc * _WORD_BYTES))
+    except ZeroDivisionError:
+        raise error.SimulationError(
+            "Division by zero at address {}".format((pc - 1) * _WORD_BYTES))
+    raise error.SimulationError("Still running after {} instructions".format(
+        max_steps))
@@ -0,0 +1,172 @@
+"""Statistics a compiler keeps about its own work, for finding where the time
+goes on large programs. A `compiler.Compiler` made with `keep_stats=True`
+times each phase of every compilation, counts what the scanner and the
+symbol tables did and traces the peak memory allocated. `_collect` returns
+it all as a dict, which dumps as JSON:
+
+    {'seconds': total, 'phases': {phase: seconds}, 'characters': n,
+     'tokens': n, 'rewinds': n, 'lookups': n, 'scope_depth': n,
+     'instructions': n, 'opcodes': {opcode: n}, 'peak_bytes': n}
+
+The time of a phase leaves out that of the phases run inside it, and that
+of the scanner, which runs whenever the parser needs tokens from a stream.
+The direct code generator emits code as it parses, so its 'parse' is code
+generation as well. Tracing memory slows everything down, so the times are
+for comparing with each other and with other runs keeping statistics.
+"""
+
+import contextlib
+import time
+import tracemalloc
+
+import codegen
+
+# Phase the time outside every other phase goes to
+_OTHER = 'other'
+_SCAN = 'scan'
+_NO_PHASE = contextlib.nullcontext()
+
+
+class _Stats:
+    """The statistics of one compilation. `phase` is the phase running since
+    `since`, and `outer` the phases it is inside, innermost last. `scanned`
+    is the scanner time already given to a phase
+    """
+    __slots__ = ('start', 'phases', 'phase', 'since', 'outer', 'scanned',
+                 'traced', 'lookups', 'scope_depth', 'seconds', 'peak')
+
+    def __init__(self):
+        self.start = self.since = None
+        self.phases = {}
+        self.phase = _OTHER
+        self.outer = []
+        self.scanned = 0.0
+        # Whether we started tracing memory, so have to stop it again
+        self.traced = False
+        self.lookups = 0
+        # Most symbol tables on the stack at once
+        self.scope_depth = 0
+        self.seconds = None
+        self.peak = None
+
+
+def _start(ctx):
+    """Start timing and tracing a compilation by `ctx`, if it keeps
+    statistics
+    """
+    s = ctx.stats
+    if s is None:
+        return
+    s.traced = not tracemalloc.is_tracing()
+    if s.traced:
+        tracemalloc.start()
+    s.scope_depth = len(ctx.symtab)
+    s.start = s.since = time.perf_counter()
+
+
+class _Phase:
+    """Times the code in a `with` block as the phase `name`
+    """
+    __slots__ = ('ctx', 'name')
+
+    def __init__(self, ctx, name):
+        self.ctx = ctx
+        self.name = name
+
+    def __enter__(self):
+        s = self.ctx.stats
+        _charge(self.ctx)
+        s.outer.append(s.phase)
+        s.phase = self.name
+
+    def __exit__(self, *exc):
+        s = self.ctx.stats
+        _charge(self.ctx)
+        s.phase = s.outer.pop()
+        return False
+
+
+def _phase(ctx, name):
+    """Return a context manager timing the code in it as the phase `name`
+    if `ctx` keeps statistics
+    """
+    if ctx.stats is None:
+        return _NO_PHASE
+    return _Phase(ctx, name)
+
+
+def _scopes(ctx):
+    """Note the number of symbol tables on the stack
+    """
+    s = ctx.stats
+    if s is not None and len(ctx.symtab) > s.scope_depth:
+        s.scope_depth = len(ctx.symtab)
+
+
+def _charge(ctx):
+    """Add the time since the last charge to the phase running, less any the
+    scanner spent
+    """
+    s = ctx.stats
+    now = time.perf_counter()
+    scanned = ctx.ts.counts.seconds if ctx.ts is not None else 0.0
+    scan = scanned - s.scanned
+    s.phases[s.phase] = s.phases.get(s.phase, 0.0) + now - s.since - scan
+    if scan:
+        s.phases[_SCAN] = s.phases.get(_SCAN, 0.0) + scan
+    s.since, s.scanned = now, scanned
+
+
+def _finish(ctx):
+    """Stop timing and tracing the compilation by `ctx`
+    """
+    s = ctx.stats
+    _charge(ctx)
+    s.seconds = time.perf_counter() - s.start
+    s.peak = tracemalloc.get_traced_memory()[1]
+    if s.traced:
+        tracemalloc.stop()
+
+
+def _collect(ctx):
+    """Return the statistics of the last compilation by `ctx`
+    """
+    s = ctx.stats
+    counts = ctx.ts.counts
+    opcodes = {}
+    for ins in ctx.out:
+        if ins.op != codegen.LABEL and ins.op not in codegen._DATA and \
+                ins.op != codegen.END:
+            name = codegen._names[ins.op]
+            opcodes[name] = opcodes.get(name, 0) + 1
+    return {'seconds': round(s.seconds, 6),
+            'phases': {name: round(t, 6) for name, t in s.phases.items()},
+            'characters': counts.characters, 'tokens': counts.tokens,
+            'rewinds': counts.rewinds, 'lookups': s.lookups,
+            'scope_depth': s.scope_depth,
+            'instructions': sum(opcodes.values()), 'opcodes': opcodes,
+            'peak_bytes': s.peak}
+
+
+def _format_phases(stats):
+    """Return the times of the phases in `stats`, the longest first
+    """
+    total = max(stats['seconds'], 1e-9)
+    out = ["Phases:"]
+    for name, t in sorted(stats['phases'].items(), key=lambda x: -x[1]):
+        out.append("  {:<12} {:>10.6f}s {:>5.1f}%".format(
+            name, t, 100.0 * t / total))
+    out.append("  {:<12} {:>10.6f}s".format("total", stats['seconds']))
+    return "\n".join(out) + "\n"
+
+
+def _format(stats):
+    """Return all of `stats` as text
+    """
+    out = [_format_phases(stats) + "Counts:"]
+    for key in ('characters', 'tokens', 'rewinds', 'lookups', 'scope_depth',
+                'peak_bytes', 'instructions'):
+        out.append("  {:<12} {:>10}".format(key, stats[key]))
+    for name, n in sorted(stats['opcodes'].items(), key=lambda x: -x[1]):
+        out.append("    {:<10} {:>10}".format(name, n))
+    return "\n".join(out) + "\n"
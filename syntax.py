@@ -0,0 +1,474 @@
+"""Parser that turns the tokens of a program into an abstract syntax tree for
+the optimizing middle end (see `ir`). It accepts the same language as
+`parser` and raises the same errors, but emits no code. Names are resolved to
+the symbol objects below as they are parsed, so nothing after this needs a
+symbol table.
+"""
+
+import codegen
+import error
+import parser
+import scanner
+import stats
+
+
+#################################################
+# Symbols                                       #
+#################################################
+
+class _Global:
+    """A global variable, stored in the word at `label`
+    """
+    __slots__ = ('name', 'label')
+
+    def __init__(self, name, label):
+        self.name = name
+        self.label = label
+
+
+class _Local:
+    """A parameter or local variable of a function
+    """
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class _Function:
+    """A function. `entry` records how it has to be called once it has been
+    compiled, as the symbol table entries of `parser` do (see `frames`), and
+    `ir` is its optimized IR, kept for inlining
+    """
+    __slots__ = ('name', 'label', 'params', 'entry', 'ir')
+
+    def __init__(self, name):
+        self.name = name
+        self.label = None
+        self.params = []
+        self.entry = {}
+        self.ir = None
+
+
+#################################################
+# Nodes                                         #
+#################################################
+
+class _Program:
+    __slots__ = ('globals', 'functions')
+
+    def __init__(self):
+        self.globals = []
+        self.functions = []
+
+
+class _GlobalDecl:
+    __slots__ = ('var', 'value', 'line')
+
+    def __init__(self, var, value, line):
+        self.var = var
+        self.value = value
+        self.line = line
+
+
+class _FunctionDef:
+    __slots__ = ('func', 'body', 'line')
+
+    def __init__(self, func, body, line):
+        self.func = func
+        self.body = body
+        self.line = line
+
+
+class _VarDecl:
+    __slots__ = ('var', 'value', 'line')
+
+    def __init__(self, var, value, line):
+        self.var = var
+        self.value = value
+        self.line = line
+
+
+class _Assign:
+    __slots__ = ('var', 'value', 'line')
+
+    def __init__(self, var, value, line):
+        self.var = var
+        self.value = value
+        self.line = line
+
+
+class _Store:
+    """`@(addr) = value`
+    """
+    __slots__ = ('addr', 'value', 'line')
+
+    def __init__(self, addr, value, line):
+        self.addr = addr
+        self.value = value
+        self.line = line
+
+
+class _CallStmt:
+    __slots__ = ('call', 'line')
+
+    def __init__(self, call, line):
+        self.call = call
+        self.line = line
+
+
+class _If:
+    __slots__ = ('cond', 'body', 'line')
+
+    def __init__(self, cond, body, line):
+        self.cond = cond
+        self.body = body
+        self.line = line
+
+
+class _While:
+    __slots__ = ('cond', 'body', 'line')
+
+    def __init__(self, cond, body, line):
+        self.cond = cond
+        self.body = body
+        self.line = line
+
+
+class _Return:
+    __slots__ = ('value', 'line')
+
+    def __init__(self, value, line):
+        self.value = value
+        self.line = line
+
+
+class _Num:
+    __slots__ = ('value', 'line')
+
+    def __init__(self, value, line):
+        self.value = value
+        self.line = line
+
+
+class _Var:
+    __slots__ = ('var', 'line')
+
+    def __init__(self, var, line):
+        self.var = var
+        self.line = line
+
+
+class _Call:
+    """A call to `func`. There may be fewer `args` than parameters, in which
+    case the rest are left as whatever is in their slots
+    """
+    __slots__ = ('func', 'args', 'line')
+
+    def __init__(self, func, args, line):
+        self.func = func
+        self.args = args
+        self.line = line
+
+
+class _Load:
+    """`@(addr)`
+    """
+    __slots__ = ('addr', 'line')
+
+    def __init__(self, addr, line):
+        self.addr = addr
+        self.line = line
+
+
+class _Unary:
+    """`-`, `~` or `!` applied to `operand`
+    """
+    __slots__ = ('op', 'operand', 'line')
+
+    def __init__(self, op, operand, line):
+        self.op = op
+        self.operand = operand
+        self.line = line
+
+
+class _Binary:
+    """Any binary operator, including the comparisons and `&&` and `||`
+    """
+    __slots__ = ('op', 'left', 'right', 'line')
+
+    def __init__(self, op, left, right, line):
+        self.op = op
+        self.left = left
+        self.right = right
+        self.line = line
+
+
+#################################################
+# Parser                                        #
+#################################################
+
+def _program(ctx):
+    """Parse the tokens `ctx.ts` into a `_Program`
+    """
+    program = _Program()
+    name = scanner._get_name(ctx.ts)
+    while name == 'var':
+        program.globals.append(_global_var(ctx))
+        name = scanner._get_name(ctx.ts)
+    while name == 'function':
+        program.functions.append(_function(ctx))
+        name = scanner._get_name(ctx.ts)
+    return program
+
+
+def _global_var(ctx):
+    line = scanner._line(ctx.ts)
+    identifier = scanner._get_name(ctx.ts)
+    if identifier in ctx.symtab[0]:
+        # Eventually raises error.CompileError
+        error._error("Duplicate symbol variable: " + str(identifier))
+    if identifier in parser._keywords:
+        error._error("Variable shadows keyword: " + str(identifier))
+    var = _Global(identifier, parser.GLOBAL_PREFIX +
+                  str(parser._next_label(ctx)))
+    ctx.symtab[0][identifier] = var
+    value = None
+    if scanner._peek(ctx.ts) == '=':
+        scanner._match(ctx.ts, '=')
+        value = _expression(ctx)
+    return _GlobalDecl(var, value, line)
+
+
+def _function(ctx):
+    line = scanner._line(ctx.ts)
+    identifier = scanner._get_name(ctx.ts)
+    if identifier in ctx.symtab[0]:
+        # Eventually raises error.CompileError
+        error._error("Duplicate symbol function: " + str(identifier))
+    func = _Function(identifier)
+    ctx.symtab[0][identifier] = func
+    scanner._match(ctx.ts, '(')
+    params = {}
+    while scanner._peek_kind(ctx.ts) == scanner.NAME:
+        id = scanner._get_name(ctx.ts)
+        if id in params:
+            error._error("Duplicate parameter: " + str(id))
+        params[id] = _Local(id)
+        if scanner._peek(ctx.ts) == ',':
+            scanner._match(ctx.ts, ',')
+        else:
+            # No more parameters to read
+            break
+    func.params = list(params.values())
+    ctx.symtab.append(params)
+    stats._scopes(ctx)
+    scanner._match(ctx.ts, ')')
+    scanner._match(ctx.ts, '{')
+    if identifier == parser.MAIN:
+        func.label = parser.MAIN_LABEL
+    else:
+        func.label = "{}_{}{}".format(parser.FUNCTION_PREFIX, identifier,
+                                      parser._next_label(ctx))
+    body = _block(ctx)
+    scanner._match(ctx.ts, '}')
+    ctx.symtab.pop()
+    return _FunctionDef(func, body, line)
+
+
+def _block(ctx):
+    """Parse the statements of a block up to its closing `}` and return them
+    as a list
+    """
+    ctx.symtab.append({})
+    stats._scopes(ctx)
+    body = []
+    while scanner._peek(ctx.ts) != '}':
+        line = scanner._line(ctx.ts)
+        if scanner._peek_kind(ctx.ts) == scanner.NAME:
+            identifier = scanner._get_name(ctx.ts)
+            if identifier == 'if':
+                body.append(_if(ctx, line))
+            elif identifier == 'while':
+                body.append(_while(ctx, line))
+            elif identifier == 'var':
+                body.append(_local_var(ctx, line))
+            elif identifier == 'break':
+                pass
+            elif identifier == 'return':
+                body.append(_return(ctx, line))
+            else:
+                entry = _lookup(ctx, identifier)
+                if entry is None:
+                    error._error("Undeclared identifier: " + str(identifier))
+                if isinstance(entry, _Function):
+                    body.append(_CallStmt(_call(ctx, entry, line), line))
+                else:
+                    scanner._match(ctx.ts, '=')
+                    body.append(_Assign(entry, _expression(ctx), line))
+        elif scanner._peek(ctx.ts) == '@':
+            scanner._match(ctx.ts, '@')
+            scanner._match(ctx.ts, '(')
+            addr = _expression(ctx)
+            scanner._match(ctx.ts, ')')
+            scanner._match(ctx.ts, '=')
+            body.append(_Store(addr, _expression(ctx), line))
+        else:
+            error._expected("Identifier or '@', got {}".format(
+                scanner._peek(ctx.ts)))
+    ctx.symtab.pop()
+    return body
+
+
+def _if(ctx, line):
+    scanner._match(ctx.ts, '(')
+    cond = _expression(ctx)
+    scanner._match(ctx.ts, ')')
+    scanner._match(ctx.ts, '{')
+    body = _block(ctx)
+    scanner._match(ctx.ts, '}')
+    return _If(cond, body, line)
+
+
+def _while(ctx, line):
+    scanner._match(ctx.ts, '(')
+    cond = _expression(ctx)
+    scanner._match(ctx.ts, ')')
+    scanner._match(ctx.ts, '{')
+    body = _block(ctx)
+    scanner._match(ctx.ts, '}')
+    return _While(cond, body, line)
+
+
+def _local_var(ctx, line):
+    identifier = scanner._get_name(ctx.ts)
+    if identifier in ctx.symtab[-1]:
+        error._error("Repeat local identifier: " + str(identifier))
+    # In scope from here on, so its own initializer already refers to it
+    var = _Local(identifier)
+    ctx.symtab[-1][identifier] = var
+    value = None
+    if scanner._peek(ctx.ts) == '=':
+        scanner._match(ctx.ts, '=')
+        value = _expression(ctx)
+    return _VarDecl(var, value, line)
+
+
+def _return(ctx, line):
+    value = None
+    if scanner._peek(ctx.ts) == '(':
+        scanner._match(ctx.ts, '(')
+        if scanner._peek(ctx.ts) != ')':
+            value = _expression(ctx)
+        scanner._match(ctx.ts, ')')
+    return _Return(value, line)
+
+
+def _call(ctx, func, line):
+    """Parse the arguments of a call to `func`
+    """
+    args = []
+    scanner._match(ctx.ts, '(')
+    for _ in func.params:
+        if scanner._peek(ctx.ts) == ')':
+            break
+        args.append(_expression(ctx))
+        if scanner._peek(ctx.ts) == ',':
+            scanner._match(ctx.ts, ',')
+        else:
+            break
+    scanner._match(ctx.ts, ')')
+    return _Call(func, args, line)
+
+
+# The expression functions below follow those of `parser`, level for level
+
+def _expression(ctx):
+    return _chain(ctx, scanner._or_ops, _term)
+
+
+def _term(ctx):
+    return _chain(ctx, scanner._and_ops, _factor)
+
+
+def _chain(ctx, ops, parse):
+    """Parse operands with `parse` joined, left to right, by the operators
+    in `ops`
+    """
+    node = parse(ctx)
+    op = scanner._peek_operator(ctx.ts)
+    while op in ops:
+        line = scanner._line(ctx.ts)
+        scanner._next(ctx.ts)
+        node = _Binary(op, node, parse(ctx), line)
+        op = scanner._peek_operator(ctx.ts)
+    return node
+
+
+def _factor(ctx):
+    op = scanner._peek_operator(ctx.ts)
+    if op in scanner._not_ops:
+        line = scanner._line(ctx.ts)
+        scanner._next(ctx.ts)
+        return _Unary(op, _factor(ctx), line)
+    return _chain(ctx, scanner._rel_ops, _a_expression)
+
+
+def _a_expression(ctx):
+    node = _a_term(ctx)
+    op = scanner._peek_operator(ctx.ts)
+    while op in scanner._add_ops:
+        line = scanner._line(ctx.ts)
+        scanner._next(ctx.ts)
+        if op != '+' and op != '-':
+            error._expected('+ or -')
+        node = _Binary(op, node, _a_term(ctx), line)
+        op = scanner._peek_operator(ctx.ts)
+    return node
+
+
+def _a_term(ctx):
+    return _chain(ctx, scanner._mul_ops, _a_factor)
+
+
+def _a_factor(ctx):
+    line = scanner._line(ctx.ts)
+    op = scanner._peek_operator(ctx.ts)
+    if op in scanner._add_ops:
+        scanner._next(ctx.ts)
+        node = _a_factor(ctx)
+        # Unary +, ++ and -- leave the value alone
+        return _Unary('-', node, line) if op == '-' else node
+    if scanner._peek(ctx.ts) == '(':
+        scanner._match(ctx.ts, '(')
+        node = _expression(ctx)
+        scanner._match(ctx.ts, ')')
+        return node
+    kind = scanner._peek_kind(ctx.ts)
+    if kind == scanner.NAME:
+        id = scanner._get_name(ctx.ts)
+        entry = _lookup(ctx, id)
+        if entry is None:
+            error._error("Undeclared identifier: " + str(id))
+        if isinstance(entry, _Function):
+            return _call(ctx, entry, line)
+        return _Var(entry, line)
+    if kind == scanner.NUM:
+        return _Num(codegen._wrap(int(scanner._get_num(ctx.ts))), line)
+    if scanner._peek(ctx.ts) == '@':
+        scanner._match(ctx.ts, '@')
+        scanner._match(ctx.ts, '(')
+        addr = _expression(ctx)
+        scanner._match(ctx.ts, ')')
+        return _Load(addr, line)
+    error._expected("Expression, got {} on line {}".format(
+        scanner._peek(ctx.ts), line))
+
+
+def _lookup(ctx, symbol):
+    if ctx.stats is not None:
+        ctx.stats.lookups += 1
+    for i in range(len(ctx.symtab) - 1, -1, -1):
+        if symbol in ctx.symtab[i]:
+            return ctx.symtab[i][symbol]
+    return None